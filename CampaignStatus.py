@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+This script prints the status of a campaign: per primary/site/energy/zenith bin the number of runs
+pending, running, done and failed, the core-hours spent and the expected time until the bin is finished.
+
+It only reads the bin_counters table of the campaign index, which the index keeps up to date whenever a run
+changes its state (see CampaignIndex.py), so it takes the same time for a thousand or a million runs.
+The states of the runs are counted as
+    pending     written (the files of the run are written, it is not submitted yet)
+    running     submitted (set by the Submitter)
+    done        verified (OutputVerifier) or archived (RunArchiver)
+    failed      failed (the submission, the watchdog or the OutputVerifier) or rejected (PreflightChecker)
+The core-hours are the ones measured by the RuntimeAggregator, the predicted core-hours the ones of the
+thinning policy. The ETA of a bin is the time its pending and running runs take at the rate at which its runs
+were done so far (from the first submission of the bin to the last run done).
+
+How to run:
+    python3 CampaignStatus.py --dirSimulations /path/to/sims/
+    python3 CampaignStatus.py --dirSimulations /path/to/sims/ --json    (e.g. for monitoring)
+"""
+import json
+import os
+import sys
+import time
+
+from utils.CampaignIndex import CampaignIndex
+
+# the state of a run in the index and the column of the status it is counted in, other states are pending
+categories = {
+    "written": "pending",
+    "submitted": "running",
+    "verified": "done",
+    "archived": "done",
+    "failed": "failed",
+    "rejected": "failed",
+}
+statusColumns = ["pending", "running", "done", "failed"]
+
+
+def binStatus(rows, now):
+    """
+    Returns the status of a bin from its rows of bin_counters (one per state)
+    """
+    status = {column: 0 for column in statusColumns}
+    status["core_hours"], status["predicted_core_hours"] = 0., 0.
+    start, end = None, None
+    for row in rows:
+        category = categories.get(row["state"], "pending")
+        status[category] += row["n"]
+        status["core_hours"] += row["core_hours"]
+        if category in ("pending", "running"):
+            status["predicted_core_hours"] += row["predicted_core_hours"]
+        # the runs of the bin are submitted from start on and done until end
+        if category in ("running", "done") and row["first_entered"] is not None:
+            start = row["first_entered"] if start is None else min(start, row["first_entered"])
+        if category == "done" and row["last_entered"] is not None:
+            end = row["last_entered"] if end is None else max(end, row["last_entered"])
+    status["start"], status["end"] = start, end
+    status["eta_seconds"] = eta(status, now)
+    return status
+
+
+def eta(status, now):
+    """
+    Returns the seconds until the pending and running runs are done, 0 if there are none and None if unknown
+    """
+    remaining = status["pending"] + status["running"]
+    if remaining == 0:
+        return 0.
+    if not status["done"] or status["start"] is None or status["end"] is None or status["end"] <= status["start"]:
+        return None
+    rate = status["done"] / (status["end"] - status["start"])
+    # the time since the last run done is already part of the wait
+    return max(remaining / rate - (now - status["end"]), 0.)
+
+
+def campaignStatus(index, now=None):
+    """
+    Returns the status of all bins and of the whole campaign (total) as a dictionary
+    """
+    now = time.time() if now is None else now
+    bins = {}
+    for row in index.getBinCounters():
+        key = (row["primary_particle"], row["site"], row["log10_E1"], row["zenith_bin"])
+        bins.setdefault(key, []).append(row)
+
+    status = {"time": now, "bins": [], "total": binStatus([row for rows in bins.values() for row in rows], now)}
+    for (primary, site, log10_E1, zenith_bin), rows in sorted(bins.items()):
+        binInfo = {"primary_particle": primary, "site": site, "log10_E1": log10_E1, "zenith_bin": zenith_bin}
+        binInfo.update(binStatus(rows, now))
+        status["bins"].append(binInfo)
+    return status
+
+
+def formatDuration(seconds):
+    if seconds is None:
+        return "-"
+    hours, seconds = divmod(int(round(seconds)), 3600)
+    if hours >= 48:
+        return f"{hours / 24.:.1f}d"
+    return f"{hours}:{seconds // 60:02d}h"
+
+
+def printStatus(status):
+    print(f"{'primary':>7} {'site':>10} {'log10_E':>8} {'zenith':>7} {'pending':>9} {'running':>9} {'done':>9} "
+          f"{'failed':>8} {'core-h':>10} {'pred. core-h left':>18} {'ETA':>8}")
+    for binInfo in status["bins"] + [dict(status["total"], primary_particle="", site="total", log10_E1="", zenith_bin="")]:
+        print(f"{binInfo['primary_particle']:>7} {binInfo['site'] or '-':>10} {binInfo['log10_E1']:>8} {binInfo['zenith_bin']:>7} "
+              f"{binInfo['pending']:>9d} {binInfo['running']:>9d} {binInfo['done']:>9d} {binInfo['failed']:>8d} "
+              f"{binInfo['core_hours']:>10.1f} {binInfo['predicted_core_hours']:>18.1f} {formatDuration(binInfo['eta_seconds']):>8}")
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Prints the runs pending/running/done/failed, the core-hours and the ETA per bin of a campaign"
+    )
+    parser.add_argument(
+        "--dirSimulations",
+        type=str,
+        required=True,
+        help="Directory where the simulation are stored (with the campaign_index.sqlite)",
+    )
+    parser.add_argument(
+        "--json",
+        action="store_true",
+        help="print the status as JSON",
+    )
+    args = parser.parse_args()
+
+    indexPath = os.path.join(args.dirSimulations, "campaign_index.sqlite")
+    if not os.path.isfile(indexPath):
+        sys.exit(f"No campaign index in {args.dirSimulations}")
+    index = CampaignIndex(indexPath)
+    status = campaignStatus(index)
+    index.close()
+
+    if args.json:
+        print(json.dumps(status, indent=1))
+    else:
+        printStatus(status)
@@ -30,16 +30,24 @@ import random
 import subprocess
 
 from utils.FileWriter import FileWriter
-from utils.SimulationMaker import SimulationMaker
+from utils.SimulationMaker import SimulationMaker, claimedRuns, interleave, mergePlans
 from utils.Submitter import Submitter
+from utils.ExecutionBackends import getBackend
+from utils.CampaignConfig import loadConfig
+from utils.CampaignIndex import CampaignIndex
+from utils.Logger import getLogger, setupLogging
+from utils.StageTimer import timer
+
+logger = getLogger(__name__)
 
 def __checkInputs(args):
     """
     This function should check some basic things before the starting the simulation.
         energyEnd > energyStart
         energyEnd <= 10_000 otherwise the numbering is not unique anymore 
-        primary is in the keys of the pimIdDict
+        every primary is in the keys of the pimIdDict
         check if the corsika given is correct 
+        the antenna file exists
         maybe a warning if seed value is over 900_000_000
         
     seedValue = int((runNumber + self.primIdDict[self.primary]*1_000_000) % 900_000_001) 
@@ -50,15 +58,23 @@ def __checkInputs(args):
     if not args.energyEnd <= 10_000:
         sys.exit('The energy End value MUST be less then 10.000!! The seed number is not unique otherwise!')
     
-    if args.primary not in args.primIdDict.keys():
-        sys.exit('The primary chosen is not in the primIdDict in the mainCorsikaSim. \nBe sure that the --primary is correct.\
-            \nIf so, update the args.primIdDict in the mainCorsikaSim.')
+    for primary in args.primary:
+        if primary not in args.primIdDict.keys():
+            sys.exit(f'The primary {primary} is not in the primIdDict in the mainCorsikaSim. \nBe sure that the --primary is correct.\
+                \nIf so, update the args.primIdDict in the mainCorsikaSim.')
     
-    if not os.path.isfile(f"{args.pathCorsika}/{args.corsikaExe}"): 
+    # a dry run only plans the campaign and the fake backend runs nothing, so they can also be done where corsika is not installed
+    if not args.dryRun and args.backend != "fake" and not os.path.isfile(f"{args.pathCorsika}/{args.corsikaExe}"): 
         sys.exit('The corsikaExe does not exist or the pathCorsika is wrong.\
             \nCheck them, please!')
     
-    if args.primIdDict[args.primary]*1_000_000 > 900_000_001:
+    if args.rankCalibration and args.claim:
+        sys.exit('The calibration showers of --rankCalibration are not part of the shared plan, do not use --claim with it!')
+
+    if not os.path.isfile(args.pathAntennas):
+        sys.exit(f'The antenna file {args.pathAntennas} does not exist. Check the --pathAntennas, please!')
+
+    if max(args.primIdDict[primary] for primary in args.primary)*1_000_000 > 900_000_001:
         import warnings
         warnings.warn("The program is not stopped, \
             but aware that the Corsika seed number is exceeding 900.000.000 (the max allowed value)")
@@ -72,9 +88,9 @@ def mainCorsikaSim(args):
     Defines the indexing of the primaries. This can be updated if needed in the future. 
     Checks if the inputs given are consistent with the script 
     Defines the energy range
-    Calls a bunch of classes 
+    Calls a bunch of classes, one FileWriter and SimulationMaker per primary and site
     Finally: 
-    start spawning and checking multiple simulations.
+    start spawning and checking multiple simulations, taking the runs of all primaries and sites in turn.
     """
     # This is a dictionary, with keys the Corsika numbering of primary, 
     # and values the arbitrary numbering used in this script for all primary particle. 
@@ -88,6 +104,14 @@ def mainCorsikaSim(args):
         2814: 5,      # Silicon (Si)
                 }
 
+    # Loads the campaign config file (physics constants, slurm settings, corsika path) once for the whole run
+    config = loadConfig(args.config)
+    # --pathCorsika and --corsikaExe override the values of the config file
+    if args.pathCorsika is None:
+        args.pathCorsika = config["corsika"]["path"]
+    if args.corsikaExe is None:
+        args.corsikaExe = config["corsika"]["exe"]
+
     # Checks if the input given are consistent with the structure of the script
     __checkInputs(args)
     
@@ -101,49 +125,233 @@ def mainCorsikaSim(args):
                 decimals=1 # the rounding has to have one single decimal point for the folder. 
     )
     
-    fW = FileWriter(
-        username=args.username,                 # User name on server
-        dirRun=args.pathCorsika,
-        dirSimulations=args.dirSimulations,
-        primary=args.primary,                   # 1 is gamma, 14 is proton, 402 is He, 1608 is Oxygen, 5626 is Fe
-        primIdDict = args.primIdDict,
-
-        zenithStart = args.zenithStart,
-        zenithEnd = args.zenithEnd,
-        
-        # zenith =args.zenith,
-        obslev =args.obslev,
+    # Cost-bounded choice of THIN and ECTMAX per bin, if a budget is given in the config file
+    thinningPolicy = None
+    if config["thinningPolicy"]["budgetCoreHours"] > 0:
+        # imported only when used, to keep the startup of the driver fast (see benchmarks/importTime.py)
+        from utils.ThinningPolicy import ThinningPolicy
+        thinningPolicy = ThinningPolicy(
+            budgetCoreHours=config["thinningPolicy"]["budgetCoreHours"],
+            thinLevels=config["thinningPolicy"]["thinLevels"],
+            ectmaxLevels=config["thinningPolicy"]["ectmaxLevels"],
+            fixedThin=config["physics"]["thin"],
+            fixedEctmax=config["physics"]["parallelEctmax"],
+            calibrationTable=config["thinningPolicy"]["calibrationTable"] or None,
+        )
 
-        pathAntennas=args.pathAntennas,
-    )
+    # Time window and resolution of the .reas files from the antenna distances of each run (see TimeResolutionPolicy.py)
+    timeResolutionPolicy = None
+    if config["timeResolutionPolicy"]["enabled"]:
+        from utils.TimeResolutionPolicy import TimeResolutionPolicy
+        timeResolutionPolicy = TimeResolutionPolicy()
 
-    simMaker = SimulationMaker(
-        startNumber=args.startNumber, 
-        endNumber=args.endNumber, 
-        energies=energies, 
-        fW=fW, # The fileWriter class 
-        pathCorsika = args.pathCorsika,
-        corsikaExe = args.corsikaExe,
+    # Number of MPI ranks of each shower from the calibrated scaling of its bin (see RankScaling.py).
+    # The calibration showers set their ranks themselves.
+    rankScaling = None
+    if config["rankScaling"]["enabled"] and not args.rankCalibration:
+        from utils.RankScaling import RankScaling
+        rankScaling = RankScaling.fromConfig(config["rankScaling"], config["slurm"])
 
-        # zenith = args.zenith,
-        zenithStart = args.zenithStart,
-        zenithEnd = args.zenithEnd,
+    # Node-local copy of the corsika run directory, made by the job scripts (see NodeStaging.py)
+    staging = None
+    if config["staging"]["enabled"]:
+        from utils.NodeStaging import NodeStaging
+        staging = NodeStaging(args.pathCorsika, config["staging"]["localDir"])
 
-        primary_particle = args.primary,
-        directory = args.dirSimulations,
-    )
+    # The index of all runs of the campaign, with the settings chosen for each run (not for a dry run)
+    index = None
+    if not args.dryRun:
+        os.makedirs(args.dirSimulations, exist_ok=True)
+        index = CampaignIndex(os.path.join(args.dirSimulations, "campaign_index.sqlite"))
+    # the mean core-hours of the runs of each bin measured by RuntimeAggregator, for the watchdog (see FileWriter.py)
+    binCoreHours = index.getBinCoreHours() if index is not None else {}
+
+    # One FileWriter and SimulationMaker per site and primary.
+    # With several sites each one gets its own folder in dirSimulations: site/primary/energy/theta/runNumber/
+    sites = args.sites or [config["site"]["name"]]
+    # the parameters of the showers are drawn by a sampler, unless the fixed grid is used
+    sampling = None
+    if args.sampler != "grid":
+        sampling = {
+            "design": args.sampler,
+            "spectralIndex": args.spectralIndex,
+            "zenithDistribution": args.zenithDistribution,
+        }
+    for site in sites:
+        if site not in config.siteNames:
+            sys.exit(f'The site {site} is not in the config file {config.source}, the sites are {", ".join(config.siteNames)}')
+    simMakers = []
+    for siteNumber, site in enumerate(sites):
+        siteConfig = config.forSite(site)
+        directory = args.dirSimulations if len(sites) == 1 else os.path.join(args.dirSimulations, site, "")
+        # --obslev overrides the observation level of all sites
+        obslev = args.obslev if args.obslev is not None else siteConfig["site"]["obslev"]
+        for primary in args.primary:
+            fW = FileWriter(
+                username=args.username,                 # User name on server
+                dirRun=args.pathCorsika,
+                corsikaExe=args.corsikaExe,
+                config=siteConfig,
+                dirSimulations=directory,
+                primary=primary,                        # 1 is gamma, 14 is proton, 402 is He, 1608 is Oxygen, 5626 is Fe
+                primIdDict = args.primIdDict,
+
+                zenithStart = args.zenithStart,
+                zenithEnd = args.zenithEnd,
+                
+                # zenith =args.zenith,
+                obslev = obslev,
+
+                pathAntennas=args.pathAntennas,
+                footprintFactor=args.footprintFactor,
+                thinningPolicy=thinningPolicy,
+                seedOffset=siteNumber * 10_000_000,
+                staging=staging,
+                timeResolutionPolicy=timeResolutionPolicy,
+                rankScaling=rankScaling,
+                measuredCoreHours={(log10_E1, zenith_bin): coreHours
+                                   for (binPrimary, binSite, log10_E1, zenith_bin), coreHours in binCoreHours.items()
+                                   if binPrimary == primary and binSite == (site if len(sites) > 1 else "")},
+            )
+
+            simMakers.append(SimulationMaker(
+                startNumber=args.startNumber, 
+                endNumber=args.endNumber, 
+                energies=energies, 
+                fW=fW, # The fileWriter class 
+                pathCorsika = args.pathCorsika,
+                corsikaExe = args.corsikaExe,
+
+                # zenith = args.zenith,
+                zenithStart = args.zenithStart,
+                zenithEnd = args.zenithEnd,
 
+                primary_particle = primary,
+                directory = directory,
+                index = index,
+                site = site if len(sites) > 1 else None,
+                # each primary and site gets its own sample (the seed is shifted for reproducible campaigns)
+                sampling = None if sampling is None else dict(
+                    sampling, seed=None if args.samplerSeed is None else args.samplerSeed + len(simMakers)),
+                nShowers = args.nShowers,
+            ))
+
+    # Adaptive sampling: only the runs each bin still needs for the target precision (see AdaptiveSampler.py)
+    adaptive = config["adaptiveSampling"]["enabled"] and not args.dryRun
+    if adaptive:
+        from utils.AdaptiveSampler import AdaptiveSampler
+        adaptiveSampler = AdaptiveSampler(
+            index,
+            config["adaptiveSampling"]["dirFeatures"] or os.path.join(args.dirSimulations, "features"),
+            observables=config["adaptiveSampling"]["observables"],
+            aggregate=config["adaptiveSampling"]["aggregate"],
+        )
+        if config["adaptiveSampling"]["extractFeatures"]:
+            adaptiveSampler.extractFeatures(processes=args.preflightProcesses)
+        for simMaker in simMakers:
+            simMaker.followUp = adaptiveSampler.followUpPlan(simMaker, simMaker.fW.config)
+        adaptiveSampler.printReport()
+
+    if thinningPolicy is not None:
+        thinningPolicy.printReport(mergePlans([simMaker.buildPlan() for simMaker in simMakers]))
+
+    if args.dryRun:
+        # Only builds the plan and reports the expected cost, nothing is written to disk
+        from utils.CampaignPlanner import CampaignPlanner, runSettings
+        plans = [simMaker.buildPlan() for simMaker in simMakers]
+        # the antennas after the footprint pruning, the trace samples and the MPI ranks of each run
+        settings = [runSettings(plan, simMaker.fW) for plan, simMaker in zip(plans, simMakers)]
+        plan = mergePlans(plans)
+        planner = CampaignPlanner(
+            plan=plan,
+            **mergePlans(settings),
+            # the cost predicted by the thinning policy for the THIN and ECTMAX chosen per bin, as in its report above
+            coreHours=None if thinningPolicy is None else thinningPolicy.predictPlan(plan),
+        )
+        planner.printReport()
+        return
+
+    # The .inp, .reas and .list of the runs are checked for consistency in batches as they are written,
+    # so that no inconsistent run is ever submitted (see PreflightChecker.py)
+    makeKeySubString = lambda: interleave(simMaker.generator() for simMaker in simMakers)
+    checker = None
+    owner = None
+    if args.rankCalibration:
+        # The reference showers of the rank scaling for every rank count and ECTMAX, not in the campaign index
+        # (see RankScaling.py). They are the same showers as the runs of the campaign, so they are not checked again.
+        from utils.RankScaling import calibrationRuns
+        makeKeySubString = lambda: interleave(
+            calibrationRuns(simMaker, config["rankScaling"]["rankCounts"], config["rankScaling"]["ectmaxLevels"])
+            for simMaker in simMakers)
+    elif args.claim:
+        # Several drivers share the plan of the campaign in the index and claim batches of runs from it,
+        # each batch is checked before it is submitted (see CampaignIndex.claimRuns)
+        owner = CampaignIndex.leaseOwner()
+        plans = []
+        for simMaker in simMakers:
+            plan = simMaker.buildPlan()
+            plan["folder"] = simMaker.planFolders(plan)
+            plans.append(plan)
+        # the follow-up rounds of an adaptive campaign are added to the shared plan
+        try:
+            nRuns = index.publishPlan(mergePlans(plans), append=adaptive)
+        except ValueError as error:
+            sys.exit(str(error))
+        logger.info(f"Claiming runs of the shared plan of {nRuns} runs as {owner}")
+        if not args.skipPreflight:
+            from utils.PreflightChecker import PreflightChecker
+            checker = PreflightChecker(processes=args.preflightProcesses, index=index, staging=staging)
+        makeKeySubString = lambda: claimedRuns(index, simMakers, owner, args.claimBatch, args.leaseMinutes * 60.,
+                                               check=None if checker is None else checker.check)
+    elif not args.skipPreflight:
+        from utils.PreflightChecker import PreflightChecker
+        checker = PreflightChecker(processes=args.preflightProcesses, index=index, staging=staging)
+        generateRuns = makeKeySubString
+        makeKeySubString = lambda: checker.checkBatches(generateRuns(), args.preflightBatch)
+
+    # sbatch on the cluster, bash on this machine, or a fake backend for load tests
+    backend = getBackend(
+        args.backend,
+        partition=config["slurm"]["partition"],
+        localTasks=args.localTasks,
+        fakeLatency=tuple(args.fakeLatency),
+        fakeFailureRate=args.fakeFailureRate,
+    )
     submitter = Submitter(
-        MakeKeySubString=simMaker.generator,
+        # a single submission queue for all primaries and sites, which take turns
+        MakeKeySubString=makeKeySubString,
         parallel_sim=args.parallelSim,
         logDir=args.dirSimulations+"/logs",
+        partition=config["slurm"]["partition"],
+        backend=backend,
+        pollInterval=args.pollInterval,
+        index=None if args.rankCalibration else index,
     )
 
-    # Starts the spawn of the simulations
-    submitter.startProcesses()
-    # Loops over the running processes and checks if any process is complete.
-    # If so, it will spawn the next one
-    submitter.checkRunningProcesses()
+    try:
+        # Starts the spawn of the simulations
+        submitter.startProcesses()
+        # Loops over the running processes and checks if any process is complete.
+        # If so, it will spawn the next one
+        submitter.checkRunningProcesses()
+    finally:
+        if owner is not None:
+            # the runs claimed but not submitted go back to the other drivers
+            index.releaseClaims(owner)
+
+    if checker is not None:
+        checker.printReport()
+    if timeResolutionPolicy is not None:
+        timeResolutionPolicy.printReport()
+
+    if submitter.nFailed:
+        logger.warning(f"{submitter.nFailed} submissions failed, see {args.dirSimulations}/logs")
+    index.close()
+
+    # Timing of the stages, in the format of the IceTray summary.json
+    summaryFile = args.summaryFile or os.path.join(args.dirSimulations, "summary.json")
+    timer.writeSummary(summaryFile)
+    logger.info(f"Stage timing written to {summaryFile}")
     
 
 
@@ -164,8 +372,16 @@ if __name__ == "__main__":
     parser.add_argument(
         "--primary",
         type=int,
-        default=14,
-        help="primary type: 1 is gamma, 14 is proton, 402 is He, 1608 is Oxygen, 5626 is Fe",
+        nargs="+",
+        default=[14],
+        help="primary types, one or more: 1 is gamma, 14 is proton, 402 is He, 1608 is Oxygen, 5626 is Fe",
+    )
+    parser.add_argument(
+        "--sites",
+        type=str,
+        nargs="+",
+        default=None,
+        help="site profiles of the config file ([sites.<name>]) to simulate, default is the [site] of the config file",
     )
 
     parser.add_argument(
@@ -177,14 +393,20 @@ if __name__ == "__main__":
     parser.add_argument(
         "--pathCorsika",
         type=str,
-        default="/home/hk-project-radiohfi/bg5912/work/soft/corsika-77550/run/",
-        help="the /run directory where the executable of corsika is located",
+        default=None,
+        help="the /run directory where the executable of corsika is located (default from the [corsika] section of the config file)",
     )
     parser.add_argument(
         "--corsikaExe",
         type=str,
-        default="mpi_corsika77550Linux_SIBYLL_urqmd_thin_coreas_parallel_runner",
-        help="the name of the executable of corsika located in the /run directory",
+        default=None,
+        help="the name of the executable of corsika located in the /run directory (default from the [corsika] section of the config file)",
+    )
+    parser.add_argument(
+        "--config",
+        type=str,
+        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "campaign.toml"),
+        help="campaign config file (TOML or YAML) with physics constants, slurm settings and per-bin overrides",
     )
     parser.add_argument(
         "--startNumber",
@@ -195,8 +417,9 @@ if __name__ == "__main__":
     parser.add_argument(
         "--endNumber",
         type=int,
-        default=1000,
-        help="if you startNumber is 0 then it is equal to the total number of simulation per bin (e.g. 667 default)",
+        default=9,
+        help="if you startNumber is 0 then it is equal to the number of simulations per zenith value of a bin. The runs of a bin "
+             "(endNumber x 10 zenith values, 11 in the last bin) have to fit in the two runIndex digits of the runNumber: at most 9",
     )
 
     parser.add_argument(
@@ -232,11 +455,44 @@ if __name__ == "__main__":
         help="End value of zenith range (do not change unless you know what you are doing)"
     )
 
+    parser.add_argument(
+        "--sampler",
+        type=str,
+        default="grid",
+        choices=["grid", "random", "lhs", "sobol"],
+        help="grid: the fixed energy/zenith grid. random, lhs (Latin hypercube), sobol: continuous sampling of energy, zenith and azimuth (see utils/Samplers.py)",
+    )
+    parser.add_argument(
+        "--spectralIndex",
+        type=float,
+        default=None,
+        help="with a sampler: draw the energies from dN/dE ~ E^-spectralIndex, default is uniform in log10 E",
+    )
+    parser.add_argument(
+        "--zenithDistribution",
+        type=str,
+        default="cos",
+        choices=["cos", "sincos", "uniform"],
+        help="with a sampler: uniform in cos(zenith), sin*cos weighting (flat ground), or uniform in zenith",
+    )
+    parser.add_argument(
+        "--nShowers",
+        type=int,
+        default=None,
+        help="with a sampler: number of showers per primary and site, default is the number of runs of the grid",
+    )
+    parser.add_argument(
+        "--samplerSeed",
+        type=int,
+        default=None,
+        help="with a sampler: seed of the random numbers, for a reproducible plan",
+    )
+
     parser.add_argument(
         "--obslev", 
         type=float, 
-        default=0, 
-        help="observation level in cm"
+        default=None, 
+        help="observation level in cm (default from the [site] section of the config file, for all sites)"
     )
 
     parser.add_argument(
@@ -246,6 +502,13 @@ if __name__ == "__main__":
         help="the directory where the antenna position file is located"
     )
 
+    parser.add_argument(
+        "--footprintFactor",
+        type=float,
+        default=0,
+        help="drop antennas outside of the expected footprint, given in units of the Cherenkov radius (e.g. 3). 0 keeps all antennas",
+    )
+
     parser.add_argument(
         "--parallelSim",
         type=int,
@@ -253,9 +516,110 @@ if __name__ == "__main__":
         help="Number of parallel simulation processes - DO NOT USE WITH MPI",
     )
 
+    parser.add_argument(
+        "--skipPreflight",
+        action="store_true",
+        help="submit each run as soon as it is written, without the consistency check of all .inp/.reas/.list files first",
+    )
+    parser.add_argument(
+        "--preflightProcesses",
+        type=int,
+        default=8,
+        help="number of parallel processes of the preflight check",
+    )
+    parser.add_argument(
+        "--preflightBatch",
+        type=int,
+        default=1000,
+        help="number of runs written and checked before they are submitted, the next batch is written while they run",
+    )
+    parser.add_argument(
+        "--claim",
+        action="store_true",
+        help="share the plan with other drivers on the same dirSimulations: runs are claimed in batches from the campaign index",
+    )
+    parser.add_argument(
+        "--claimBatch",
+        type=int,
+        default=16,
+        help="--claim: number of runs claimed at a time",
+    )
+    parser.add_argument(
+        "--leaseMinutes",
+        type=float,
+        default=60.,
+        help="--claim: the runs claimed by a driver that stopped are claimed by the others after this time",
+    )
+    parser.add_argument(
+        "--backend",
+        type=str,
+        default="slurm",
+        choices=["slurm", "local", "fake"],
+        help="slurm: sbatch the .sub files. local: run them with bash on this machine (--parallelSim at a time). fake: run nothing, for load tests",
+    )
+    parser.add_argument(
+        "--localTasks",
+        type=int,
+        default=1,
+        help="local backend: number of MPI tasks of each run",
+    )
+    parser.add_argument(
+        "--fakeLatency",
+        type=float,
+        nargs=2,
+        default=[0., 0.],
+        help="fake backend: min and max latency of each job in seconds",
+    )
+    parser.add_argument(
+        "--fakeFailureRate",
+        type=float,
+        default=0.,
+        help="fake backend: fraction of the jobs that fail",
+    )
+    parser.add_argument(
+        "--pollInterval",
+        type=float,
+        default=10,
+        help="seconds between two checks of the running submissions",
+    )
+
+    parser.add_argument(
+        "--rankCalibration",
+        action="store_true",
+        help="submit the reference showers of the MPI rank scaling instead of the campaign, one per bin, "
+             "rank count and ECTMAX of [rankScaling] (then fit them with python3 -m utils.RankScaling)",
+    )
+
+    parser.add_argument(
+        "--dryRun",
+        action="store_true",
+        help="only plan the campaign and print the number of showers, core-hours, output size and inodes per bin. Nothing is written",
+    )
+
+    parser.add_argument(
+        "--summaryFile",
+        type=str,
+        default=None,
+        help="file for the timing of the stages (summary.json format), default is summary.json in dirSimulations",
+    )
+    parser.add_argument(
+        "--logLevel",
+        type=str,
+        default="INFO",
+        choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+        help="INFO writes one summary line per energy/zenith bin, DEBUG writes every run",
+    )
+    parser.add_argument(
+        "--logFile",
+        type=str,
+        default=None,
+        help="write the log to this file instead of stdout",
+    )
+
     args = parser.parse_args()
+    setupLogging(args.logLevel, args.logFile)
     mainCorsikaSim(args)
 
-    print("Final incantation complete: All cosmic portals explored, program's journey ends...")
+    logger.info("Final incantation complete: All cosmic portals explored, program's journey ends...")
     
-    print("-------------------- Program finished --------------------")
\ No newline at end of file
+    logger.info("-------------------- Program finished --------------------")
\ No newline at end of file
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the input generation and of the submission throughput of the driver.
+
+For each campaign size it measures
+    generation (SimulationMaker.generator + FileWriter + RadioFilesGenerator + SubFilesGenerator):
+        runs generated per second
+        bytes written per run (size of the run folders)
+        read/write syscalls per run (/proc/self/io, Linux only)
+        peak RSS of the process
+    submission (Submitter):
+        launches per second, with a fake sbatch that only prints a job id
+
+Everything is written to a temporary folder in --target (default /dev/shm if it exists, i.e. tmpfs),
+with a synthetic square antenna layout, so the numbers do not depend on the cluster or on the antenna file.
+Nothing of the campaign is left behind.
+
+How to run (from the repository root):
+    python3 benchmarks/generationThroughput.py --sizes 100 1000 10000 --antennas 300
+"""
+import os
+import resource
+import shutil
+import stat
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from utils.CampaignConfig import loadConfig
+from utils.CampaignIndex import CampaignIndex
+from utils.FileWriter import FileWriter
+from utils.SimulationMaker import SimulationMaker
+from utils.Submitter import Submitter
+
+# runs per energy bin: 11 zenith values (one zenith bin) times RUNS_PER_ZENITH
+RUNS_PER_ZENITH = 100
+
+
+def writeAntennaLayout(fileName, nAntennas, spacing=50000.):
+    """
+    Writes a square grid of nAntennas antennas in the .list format
+    """
+    side = int(np.ceil(np.sqrt(nAntennas)))
+    x, y = np.meshgrid(np.arange(side) * spacing, np.arange(side) * spacing)
+    x, y = x.ravel()[:nAntennas] - x.mean(), y.ravel()[:nAntennas] - y.mean()
+    with open(fileName, "w") as f:
+        for i in range(nAntennas):
+            f.write(f"AntennaPosition = {x[i]} {y[i]} 0.0 bench{i}\n")
+
+
+def writeFakeSbatch(binDir):
+    """
+    Writes an sbatch stand-in that only prints a job id, and puts it first in the PATH
+    """
+    os.makedirs(binDir, exist_ok=True)
+    sbatch = os.path.join(binDir, "sbatch")
+    with open(sbatch, "w") as f:
+        f.write("#!/bin/sh\necho \"Submitted batch job $$\"\n")
+    os.chmod(sbatch, os.stat(sbatch).st_mode | stat.S_IEXEC)
+    os.environ["PATH"] = binDir + os.pathsep + os.environ["PATH"]
+
+
+def readSyscalls():
+    """
+    Returns the number of read and write syscalls of this process so far (0 if /proc is not available)
+    """
+    try:
+        with open("/proc/self/io") as f:
+            io = dict(line.split(": ") for line in f.read().splitlines())
+        return int(io["syscr"]) + int(io["syscw"])
+    except (OSError, KeyError):
+        return 0
+
+
+def folderBytes(directory):
+    total = 0
+    for root, _, files in os.walk(directory):
+        total += sum(os.path.getsize(os.path.join(root, name)) for name in files)
+    return total
+
+
+def benchmarkSize(size, workDir, pathAntennas, parallelSim):
+    """
+    Generates and submits a campaign of about size runs in workDir, returns the measured numbers
+    """
+    dirSimulations = os.path.join(workDir, f"sims_{size}/")
+    os.makedirs(dirSimulations)
+    config = loadConfig()
+
+    endNumber = min(RUNS_PER_ZENITH, max(1, int(np.ceil(size / 11))))
+    nEnergies = int(np.ceil(size / (11 * endNumber)))
+    # energyDict of runNumberGenerator goes from 7.0 to 12.9
+    energies = np.around(7.0 + 0.1 * np.arange(nEnergies + 1), decimals=1)
+
+    fW = FileWriter(
+        username="bench",
+        dirSimulations=dirSimulations,
+        dirRun=workDir,
+        corsikaExe="corsika",
+        config=config,
+        primary=14,
+        primIdDict={14: 1},
+        obslev=0,
+        pathAntennas=pathAntennas,
+        zenithStart=65.,
+        zenithEnd=67.5,
+    )
+    index = CampaignIndex(os.path.join(dirSimulations, "campaign_index.sqlite"))
+    simMaker = SimulationMaker(
+        startNumber=0,
+        endNumber=endNumber,
+        energies=energies,
+        fW=fW,
+        pathCorsika=workDir,
+        corsikaExe="corsika",
+        zenithStart=65.,
+        zenithEnd=67.5,
+        primary_particle=14,
+        directory=dirSimulations,
+        index=index,
+    )
+
+    # generation
+    syscallsStart = readSyscalls()
+    start = time.perf_counter()
+    subFiles = list(simMaker.generator())
+    generationTime = time.perf_counter() - start
+    syscalls = readSyscalls() - syscallsStart
+    index.close()
+    nRuns = len(subFiles)
+
+    # submission, without the sleep between the checks of checkRunningProcesses
+    submitter = Submitter(
+        MakeKeySubString=lambda: iter(subFiles),
+        parallel_sim=parallelSim,
+        logDir=os.path.join(dirSimulations, "logs"),
+    )
+    start = time.perf_counter()
+    submitter.startProcesses()
+    while submitter.singleCheck():
+        time.sleep(0.001)
+    submissionTime = time.perf_counter() - start
+
+    return {
+        "runs": nRuns,
+        "runs/s": nRuns / generationTime,
+        "bytes/run": folderBytes(dirSimulations) / max(nRuns, 1),
+        "syscalls/run": syscalls / max(nRuns, 1),
+        "peak RSS MB": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.,
+        "submissions/s": nRuns / submissionTime,
+    }
+
+
+def main(args):
+    target = args.target or ("/dev/shm" if os.path.isdir("/dev/shm") else None)
+    workDir = tempfile.mkdtemp(prefix="spellcaster_bench_", dir=target)
+    try:
+        pathAntennas = os.path.join(workDir, "bench.list")
+        writeAntennaLayout(pathAntennas, args.antennas)
+        writeFakeSbatch(os.path.join(workDir, "bin"))
+
+        print(f"Benchmark in {workDir} with {args.antennas} antennas")
+        columns = ["runs", "runs/s", "bytes/run", "syscalls/run", "peak RSS MB", "submissions/s"]
+        print(" ".join(f"{column:>14}" for column in columns))
+        for size in args.sizes:
+            result = benchmarkSize(size, workDir, pathAntennas, args.parallelSim)
+            print(" ".join(f"{result[column]:>14.1f}" for column in columns))
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Throughput benchmark of the input generation and of the submission"
+    )
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[100, 1000],
+        help="campaign sizes (number of runs) to benchmark",
+    )
+    parser.add_argument(
+        "--antennas",
+        type=int,
+        default=300,
+        help="number of antennas of the synthetic layout",
+    )
+    parser.add_argument(
+        "--parallelSim",
+        type=int,
+        default=50,
+        help="number of parallel sbatch processes of the Submitter",
+    )
+    parser.add_argument(
+        "--target",
+        type=str,
+        default=None,
+        help="directory for the temporary campaign (default /dev/shm)",
+    )
+
+    main(parser.parse_args())
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+Startup-time benchmark of the driver.
+
+It runs `python -X importtime -c "import MakeCorsikaSim"` in a fresh interpreter (cold start),
+parses the import times written to stderr and
+    - prints the slowest imports (cumulative time)
+    - fails (exit code 1) if the import of MakeCorsikaSim takes longer than --maxMs
+    - fails if one of the optional heavy modules is imported at startup (they have to be imported on first use)
+
+The median of --repeat runs is used, so that a single slow filesystem access does not fail the check.
+
+How to run (from the repository root):
+    python3 benchmarks/importTime.py --maxMs 500
+"""
+import os
+import subprocess
+import sys
+
+# These modules are only needed by some features and must not be imported when the driver starts
+DEFERRED_MODULES = ["miniradiotools", "yaml", "scipy", "matplotlib", "radiotools"]
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def measureImportTime(module="MakeCorsikaSim", python=sys.executable):
+    """
+    Returns a dictionary {imported module: (self time, cumulative time)} in microseconds
+    """
+    result = subprocess.run(
+        [python, "-X", "importtime", "-c", f"import {module}"],
+        cwd=REPO_DIR,
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        sys.exit(f"Importing {module} failed:\n{result.stderr}")
+
+    times = {}
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        selfTime, cumulative, name = line[len("import time:"):].split("|")
+        times[name.strip()] = (int(selfTime), int(cumulative))
+    return times
+
+
+def main(args):
+    runs = [measureImportTime(args.module) for _ in range(args.repeat)]
+    totals = sorted(run[args.module][1] for run in runs)
+    median = totals[len(totals) // 2] / 1000
+
+    slowest = sorted(runs[-1].items(), key=lambda item: item[1][1], reverse=True)[:args.top]
+    print(f"{'cumulative [ms]':>16} {'self [ms]':>10}  module")
+    for name, (selfTime, cumulative) in slowest:
+        print(f"{cumulative / 1000:>16.1f} {selfTime / 1000:>10.1f}  {name}")
+    print(f"Import of {args.module}: {median:.1f} ms (median of {args.repeat}), limit {args.maxMs} ms")
+
+    failed = False
+    imported = {name.split(".")[0] for run in runs for name in run}
+    for module in DEFERRED_MODULES:
+        if module in imported:
+            print(f"FAIL: {module} is imported at startup, it should be imported on first use")
+            failed = True
+    if median > args.maxMs:
+        print(f"FAIL: startup of {args.module} is slower than {args.maxMs} ms")
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Cold-start import time benchmark of the driver"
+    )
+    parser.add_argument(
+        "--module",
+        type=str,
+        default="MakeCorsikaSim",
+        help="module to import",
+    )
+    parser.add_argument(
+        "--maxMs",
+        type=float,
+        default=500,
+        help="maximum allowed import time in ms",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=5,
+        help="number of cold starts, the median is used",
+    )
+    parser.add_argument(
+        "--top",
+        type=int,
+        default=15,
+        help="number of slowest imports printed",
+    )
+
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the tests import the modules of utils like the scripts of the repo do, from its root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,163 @@
+"""
+Tests of the shared plan of several drivers (CampaignIndex.publishPlan, claimRuns, renewClaims, completeClaim,
+releaseClaims), each driver with its own connection to the same temporary index.
+
+How to run:
+    python3 -m pytest tests/
+"""
+
+import multiprocessing as mp
+import time
+
+import numpy as np
+import pytest
+
+from utils.CampaignIndex import CampaignIndex
+
+
+def makePlan(energies=(8.0, 8.1), zenithBins=(65.0, 67.5), runsPerBin=5, primary=14, site="", first=0):
+    """
+    Returns a plan as built by SimulationMaker.buildPlan, with the folder of each run
+    """
+    log10_E1, zenith_bin, runIndex = (np.array(values).ravel() for values in np.meshgrid(
+        energies, zenithBins, np.arange(first, first + runsPerBin), indexing="ij"))
+    n = len(runIndex)
+    return {
+        "folder":       np.array([f"/sims/{site}/{primary}/{e}/{z}/{i:06d}/" for e, z, i in zip(log10_E1, zenith_bin, runIndex)]),
+        "primary":      np.full(n, primary),
+        "site":         np.full(n, site),
+        "log10_E1":     log10_E1,
+        "zenith_bin":   zenith_bin,
+        "zenith":       zenith_bin + 1.,
+        "azimuth":      np.zeros(n),
+        "runIndex":     runIndex.astype(int),
+        "log10_E":      log10_E1,
+        "weight":       np.ones(n),
+    }
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "campaign_index.sqlite")
+
+
+def drive(path, owner, batchSize, queue):
+    """
+    A driver: claims batches until the plan is exhausted and completes each run, puts the ids of its runs in queue
+    """
+    index = CampaignIndex(path)
+    done = []
+    while True:
+        runs = index.claimRuns(owner, batchSize, leaseSeconds=60.)
+        if not runs:
+            break
+        for run in runs:
+            assert index.completeClaim(owner, run["id"])
+            done.append(run["id"])
+    index.close()
+    queue.put((owner, done))
+
+
+def test_noRunClaimedTwice(path):
+    index = CampaignIndex(path)
+    nRuns = index.publishPlan(makePlan(energies=np.round(np.arange(8.0, 9.0, 0.1), 1), runsPerBin=20))
+    index.close()
+
+    queue = mp.get_context("spawn").Queue()
+    drivers = [mp.get_context("spawn").Process(target=drive, args=(path, owner, 7, queue)) for owner in ("driverA", "driverB")]
+    for driver in drivers:
+        driver.start()
+    results = dict(queue.get(timeout=120) for _ in drivers)
+    for driver in drivers:
+        driver.join(timeout=120)
+        assert driver.exitcode == 0
+
+    claimedA, claimedB = results["driverA"], results["driverB"]
+    assert len(claimedA) == len(set(claimedA)) and len(claimedB) == len(set(claimedB))
+    assert not set(claimedA) & set(claimedB)
+    assert len(claimedA) + len(claimedB) == nRuns
+
+    index = CampaignIndex(path)
+    assert index.connection.execute("SELECT COUNT(*) FROM plan WHERE status != 'done'").fetchone()[0] == 0
+    index.close()
+
+
+def test_expiredLeaseReclaimed(path):
+    driverA, driverB = CampaignIndex(path), CampaignIndex(path)
+    driverA.publishPlan(makePlan(runsPerBin=2))
+    claimedA = driverA.claimRuns("driverA", 3, leaseSeconds=0.05)
+    assert len(claimedA) == 3
+
+    # the leases of A are still valid: B gets other runs
+    claimedB = driverB.claimRuns("driverB", 100, leaseSeconds=60.)
+    assert not {run["id"] for run in claimedA} & {run["id"] for run in claimedB}
+
+    # A stops renewing, after its leases expire B claims its runs
+    time.sleep(0.1)
+    reclaimed = driverB.claimRuns("driverB", 100, leaseSeconds=60.)
+    assert {run["id"] for run in reclaimed} == {run["id"] for run in claimedA}
+    assert driverA.renewClaims("driverA", leaseSeconds=60.) == set()
+    driverA.close()
+    driverB.close()
+
+
+def test_completeClaimAfterLostLease(path):
+    driverA, driverB = CampaignIndex(path), CampaignIndex(path)
+    driverA.publishPlan(makePlan(runsPerBin=1))
+    run, = driverA.claimRuns("driverA", 1, leaseSeconds=0.05)
+    time.sleep(0.1)
+    assert [claim["id"] for claim in driverB.claimRuns("driverB", 1, leaseSeconds=60.)] == [run["id"]]
+
+    assert not driverA.completeClaim("driverA", run["id"])
+    assert driverB.completeClaim("driverB", run["id"])
+    status, owner = driverA.connection.execute("SELECT status, lease_owner FROM plan WHERE id = ?", (run["id"],)).fetchone()
+    assert (status, owner) == ("done", "driverB")
+    driverA.close()
+    driverB.close()
+
+
+def test_releasedClaimsArePending(path):
+    driverA, driverB = CampaignIndex(path), CampaignIndex(path)
+    driverA.publishPlan(makePlan(runsPerBin=1))
+    claimed = driverA.claimRuns("driverA", 4, leaseSeconds=60.)
+    assert driverB.claimRuns("driverB", 4, leaseSeconds=60.) == []
+    driverA.releaseClaims("driverA", [claimed[0]["id"]])
+    assert [run["id"] for run in driverB.claimRuns("driverB", 4, leaseSeconds=60.)] == [claimed[0]["id"]]
+    driverA.close()
+    driverB.close()
+
+
+def test_mismatchedBinsRefused(path):
+    driverA, driverB = CampaignIndex(path), CampaignIndex(path)
+    nRuns = driverA.publishPlan(makePlan())
+
+    with pytest.raises(ValueError):
+        driverB.publishPlan(makePlan(energies=(8.0, 8.1, 8.2)))
+    assert driverB.connection.execute("SELECT COUNT(*) FROM plan").fetchone()[0] == nRuns
+
+    # the same bins join the shared plan without adding runs, another primary is merged into it
+    assert driverB.publishPlan(makePlan()) == nRuns
+    assert driverB.publishPlan(makePlan(primary=5626)) == 2 * nRuns
+    # only the runs of its own primary are claimed by a driver
+    claimed = driverB.claimRuns("driverB", 100, pairs=[(5626, "")])
+    assert len(claimed) == nRuns and {run["primary_particle"] for run in claimed} == {5626}
+    driverA.close()
+    driverB.close()
+
+
+def test_appendBlockedWhilePending(path):
+    driverA, driverB = CampaignIndex(path), CampaignIndex(path)
+    nRuns = driverA.publishPlan(makePlan(runsPerBin=2))
+
+    # a follow-up round is not added while runs of the plan are pending or claimed
+    assert driverB.publishPlan(makePlan(runsPerBin=2, first=2), append=True) == nRuns
+    claimed = driverA.claimRuns("driverA", 100, leaseSeconds=60.)
+    assert driverB.publishPlan(makePlan(runsPerBin=2, first=2), append=True) == nRuns
+
+    # once all runs are done, the next round is added (once: the other driver finds it pending)
+    for run in claimed:
+        assert driverA.completeClaim("driverA", run["id"])
+    assert driverB.publishPlan(makePlan(runsPerBin=2, first=2), append=True) == 2 * nRuns
+    assert driverA.publishPlan(makePlan(runsPerBin=2, first=4), append=True) == 2 * nRuns
+    driverA.close()
+    driverB.close()
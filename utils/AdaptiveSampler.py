@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+
+"""
+This class plans the follow-up runs of an adaptive campaign: instead of endNumber runs in every energy/zenith bin,
+each bin only gets the runs it still needs until its observables are known to the target precision.
+
+The observables come from the feature table of the finished runs (see FeatureExtractor.py), one value per run:
+the maximum (or the sum) of a column, e.g. the fluence, over the antennas of the run. For each bin and observable
+the relative standard error of the mean is
+    std / (|mean| sqrt(n))
+over the n runs of the bin in the table, and the bin needs (std / (mean targetRelativeError))^2 runs in total.
+The runs still running (written or submitted, or verified but not in the feature table yet) count as if they
+were done, so the bins are not planned twice. A bin gets
+    minRuns runs                    while fewer runs are done, before its variance is estimated
+    the missing runs                for the observable with the largest error
+    at most maxRunsPerRound runs    per call, so that the estimate of the variance is updated in between
+The settings are in the [adaptiveSampling] section of the config file and can differ per bin ([[overrides]]).
+
+The follow-up runs of a bin continue its runIndex, at the zenith values of the grid in turn with a random azimuth
+(or drawn from the distributions of the sampler restricted to the bin, see Samplers.py). A bin holds at most
+MAX_RUN_INDEX runs (the runIndex is part of the runNumber, see runNumberGenerator.py), the runs beyond are not planned.
+The weights keep the formula of the first round: the phase space of the bin shared by all its runs,
+1 / (nBin * pdf in the bin), so the runs of the bin planned before are reweighted in the index for the new nBin
+(the runs done and running, with the new ones), and the weights of a bin keep adding up to its phase space.
+Each call of MakeCorsikaSim.py with [adaptiveSampling] enabled = true plans and submits one round,
+with --claim the round is added to the shared plan.
+
+How to run (prints the uncertainty of each bin):
+    python3 -m utils.AdaptiveSampler --dirSimulations /path/to/sims/ --observables fluence peak --target 0.05
+"""
+
+import os
+
+import numpy as np
+
+from utils.FeatureExtractor import loadFeatures
+from utils.Logger import getLogger
+from utils.Samplers import binWeights
+from utils.runNumberGenerator import MAX_RUN_INDEX
+
+logger = getLogger(__name__)
+
+# states of the runs in the index (see CampaignStatus.py)
+DONE_STATES = ("verified", "archived")
+RUNNING_STATES = ("written", "submitted")
+
+
+def runObservables(table, observables, aggregate="max"):
+    """
+    Returns the folders of the runs in a feature table (see loadFeatures) and the value of each observable per run,
+    the maximum or the sum over its antennas, as an array (runs, observables)
+    """
+    if not table:
+        return np.zeros(0, dtype=str), np.zeros((0, len(observables)))
+    folders, inverse = np.unique(table["folder"], return_inverse=True)
+    order = np.argsort(inverse, kind="stable")
+    starts = np.searchsorted(inverse[order], np.arange(len(folders)))
+    values = np.empty((len(folders), len(observables)))
+    for i, observable in enumerate(observables):
+        column = np.asarray(table[observable], dtype=float)[order]
+        if aggregate == "sum":
+            values[:, i] = np.add.reduceat(np.nan_to_num(column), starts)
+        else:
+            # antennas without a trace have NaN, fmax ignores them
+            values[:, i] = np.fmax.reduceat(column, starts)
+    return folders, values
+
+
+def binUncertainty(values):
+    """
+    Returns the relative standard error of the mean and the relative standard deviation of each observable
+    (the columns of values, one row per run), NaN if they cannot be estimated
+    """
+    n = len(values)
+    if n < 2:
+        return np.full(values.shape[1], np.nan), np.full(values.shape[1], np.nan)
+    mean = np.abs(np.nanmean(values, axis=0))
+    std = np.nanstd(values, axis=0, ddof=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        relativeStd = np.where(mean > 0, std / mean, np.nan)
+    return relativeStd / np.sqrt(n), relativeStd
+
+
+class AdaptiveSampler:
+    """
+    Parameters:
+        index:          the CampaignIndex of the campaign
+        dirFeatures:    the directory of the feature table
+        observables:    the columns of the feature table whose bin means have to reach the target precision
+        aggregate:      value of an observable per run, max or sum over its antennas
+    """
+
+    def __init__(self, index, dirFeatures, observables=("fluence", "peak"), aggregate="max"):
+        if aggregate not in ("max", "sum"):
+            raise ValueError(f"aggregate must be max or sum, got {aggregate!r}")
+        self.index = index
+        self.dirFeatures = dirFeatures
+        self.observables = list(observables)
+        self.aggregate = aggregate
+        self.report = []
+        self._runs = None
+        self._values = None
+
+    def extractFeatures(self, processes=8):
+        """
+        Adds the runs verified since the last call to the feature table
+        """
+        from utils.FeatureExtractor import FeatureExtractor
+        nRuns = FeatureExtractor(self.index, self.dirFeatures, processes=processes).extract()
+        logger.info(f"Features of {nRuns} runs added to {self.dirFeatures}")
+        self._values = None
+
+    def runs(self):
+        """
+        Returns the runs of the index grouped by bin (primary, site, log10_E1, zenith_bin):
+        a dictionary of lists of (folder, runIndex, state, log10_E, zenith)
+        """
+        if self._runs is None:
+            self._runs = {}
+            rows = self.index.getRuns(columns=("folder", "runNumber", "runIndex", "primary_particle", "site",
+                                               "log10_E1", "zenith_bin", "state", "log10_E", "zenith"))
+            for folder, runNumber, runIndex, primary, site, log10_E1, zenith_bin, state, log10_E, zenith in rows:
+                if log10_E1 is None or zenith_bin is None:
+                    continue
+                if runIndex is None and runNumber is not None:
+                    # older indices: the last two digits of the runNumber (see SimulationMaker.runFolder)
+                    runIndex = int(runNumber) % 100
+                key = (primary, site or "", round(float(log10_E1), 6), round(float(zenith_bin), 6))
+                self._runs.setdefault(key, []).append((folder, runIndex, state, log10_E, zenith))
+        return self._runs
+
+    def values(self):
+        """
+        Returns the observables of the runs in the feature table, as a dictionary folder: array of the observables
+        """
+        if self._values is None:
+            table = loadFeatures(self.dirFeatures, columns=["folder"] + self.observables)
+            if not table:
+                logger.warning(f"No feature table in {self.dirFeatures}, the bins get their minimal number of runs")
+            folders, values = runObservables(table, self.observables, self.aggregate)
+            self._values = dict(zip(folders.tolist(), values))
+        return self._values
+
+    def binStatus(self, key):
+        """
+        Returns the observables of the done runs of a bin (array (runs, observables)), the number of runs
+        still running and the next free runIndex
+        """
+        values, nRunning, nextRunIndex = [], 0, 0
+        allValues = self.values()
+        for folder, runIndex, state, _, _ in self.runs().get(key, []):
+            if runIndex is not None:
+                nextRunIndex = max(nextRunIndex, runIndex + 1)
+            if folder in allValues:
+                values.append(allValues[folder])
+            elif state in RUNNING_STATES or state in DONE_STATES:
+                nRunning += 1
+        values = np.array(values) if values else np.zeros((0, len(self.observables)))
+        return values, nRunning, nextRunIndex
+
+    def runsNeeded(self, values, nRunning, settings):
+        """
+        Returns the number of runs to add to a bin, its relative errors and the runs it needs in total
+        """
+        relativeError, relativeStd = binUncertainty(values)
+        nDone = len(values)
+        if nDone < settings["minRuns"] or not np.isfinite(relativeStd).any():
+            needed = settings["minRuns"]
+        else:
+            needed = int(np.ceil(np.nanmax(relativeStd / settings["targetRelativeError"])**2))
+        nNew = int(np.clip(needed - nDone - nRunning, 0, settings["maxRunsPerRound"]))
+        return nNew, relativeError, needed
+
+    def binRuns(self, key):
+        """
+        Returns the runs of a bin counted in its weights (done or running): lists of the folders, log10_E and zenith
+        """
+        allValues = self.values()
+        runs = [(folder, log10_E, zenith) for folder, _, state, log10_E, zenith in self.runs().get(key, [])
+                if folder in allValues or state in RUNNING_STATES or state in DONE_STATES]
+        return [list(column) for column in zip(*runs)] if runs else ([], [], [])
+
+    def followUpPlan(self, simMaker, config):
+        """
+        Returns the plan (see SimulationMaker.buildPlan) of the runs the bins of a SimulationMaker still need,
+        with the settings of the [adaptiveSampling] section of its config (per bin).
+        The runs of the bins that get new runs are reweighted in the index.
+        """
+        plan = simMaker.buildPlan()
+        site = simMaker.site or ""
+        existing = {run[0] for runs in self.runs().values() for run in runs}
+        energyWidths = dict(zip(np.round(simMaker.energies[:-1], 6), np.diff(np.asarray(simMaker.energies, dtype=float))))
+        followUp = {key: [] for key in ("log10_E1", "zenith_bin", "zenith", "azimuth", "runIndex", "log10_E", "weight")}
+
+        bins = np.unique(np.stack([plan["log10_E1"], plan["zenith_bin"]], axis=1), axis=0) if len(plan["runIndex"]) else []
+        for log10_E1, zenith_bin in bins:
+            key = (simMaker.primary_particle, site, round(float(log10_E1), 6), round(float(zenith_bin), 6))
+            values, nRunning, runIndex = self.binStatus(key)
+            nNew, relativeError, needed = self.runsNeeded(
+                values, nRunning, config.forBin(log10_E1, zenith_bin)["adaptiveSampling"])
+            if nNew == 0:
+                self.report.append((key, len(values), nRunning, relativeError, needed, nNew))
+                continue
+
+            inBin = (plan["log10_E1"] == log10_E1) & (plan["zenith_bin"] == zenith_bin)
+            gridZeniths = np.unique(plan["zenith"][inBin])
+            if simMaker.sampler is None:
+                zeniths = gridZeniths[(len(values) + nRunning + np.arange(nNew)) % len(gridZeniths)]
+                log10_Es = np.full(nNew, log10_E1)
+                azimuths = np.round(np.random.uniform(0, 360, nNew), 2)
+            else:
+                log10_Es, zeniths, azimuths = simMaker.sampler.sampleBin(nNew, log10_E1, zenith_bin)
+            newRuns = []
+            for zenith, azimuth, log10_E in zip(zeniths, azimuths, log10_Es):
+                # the runNumber is not unique, the next runIndex whose folder is free
+                while runIndex < MAX_RUN_INDEX and simMaker.runFolder(log10_E1, zenith_bin, zenith, azimuth, runIndex)[1] in existing:
+                    runIndex += 1
+                if runIndex >= MAX_RUN_INDEX:
+                    logger.warning(f"The bin log10_E={log10_E1} zenith={zenith_bin} of primary {simMaker.primary_particle} has no "
+                                   f"free runIndex below {MAX_RUN_INDEX} (see runNumberGenerator.py), "
+                                   f"{nNew - len(newRuns)} of its new runs are not planned")
+                    break
+                existing.add(simMaker.runFolder(log10_E1, zenith_bin, zenith, azimuth, runIndex)[1])
+                newRuns.append((zenith, azimuth, runIndex, log10_E))
+                runIndex += 1
+            self.report.append((key, len(values), nRunning, relativeError, needed, len(newRuns)))
+            if not newRuns:
+                continue
+
+            # the same weights for the runs of the bin planned before and the new ones, for the new number of runs
+            folders, oldLog10_E, oldZeniths = self.binRuns(key)
+            nBin = len(folders) + len(newRuns)
+            zeniths = np.array([run[0] for run in newRuns] + oldZeniths, dtype=float)
+            log10_Es = np.array([run[3] for run in newRuns] + oldLog10_E, dtype=float)
+            if simMaker.sampler is None:
+                zenithEdges = np.deg2rad([zenith_bin, zenith_bin + 2.5])
+                phaseSpace = energyWidths[round(float(log10_E1), 6)] * 2 * np.pi * (np.cos(zenithEdges[0]) - np.cos(zenithEdges[1]))
+                weights = binWeights(np.full(nBin, 1. / phaseSpace), nBin)
+            else:
+                weights = binWeights(simMaker.sampler.binPdf(log10_Es, zeniths, np.full(nBin, log10_E1), np.full(nBin, zenith_bin)), nBin)
+            for folder, weight in zip(folders, weights[len(newRuns):]):
+                self.index.addRun(folder=folder, weight=float(weight))
+            for (zenith, azimuth, runIndex, log10_E), weight in zip(newRuns, weights):
+                for name, value in zip(followUp, (log10_E1, zenith_bin, zenith, azimuth, runIndex, log10_E, weight)):
+                    followUp[name].append(value)
+        self.index.flush()
+
+        followUp = {key: np.array(values, dtype=int if key == "runIndex" else float) for key, values in followUp.items()}
+        followUp["primary"] = np.full(len(followUp["runIndex"]), simMaker.primary_particle)
+        followUp["site"] = np.full(len(followUp["runIndex"]), site)
+        return followUp
+
+    def printReport(self):
+        """
+        Prints per bin the runs done and running, the relative error of each observable and the runs added
+        """
+        print(f"{'primary':>7} {'site':>10} {'log10_E':>8} {'zenith':>7} {'done':>6} {'running':>8} "
+              + " ".join(f"{'err ' + observable:>14}" for observable in self.observables)
+              + f" {'needed':>7} {'new':>5}")
+        for (primary, site, log10_E1, zenith_bin), nDone, nRunning, relativeError, needed, nNew in self.report:
+            print(f"{primary:>7} {site or '-':>10} {log10_E1:>8.1f} {zenith_bin:>7.1f} {nDone:>6d} {nRunning:>8d} "
+                  + " ".join(f"{error:>14.3g}" for error in relativeError)
+                  + f" {needed:>7d} {nNew:>5d}")
+        print(f"Adaptive sampling: {sum(entry[5] for entry in self.report)} new runs in "
+              f"{sum(1 for entry in self.report if entry[5])} of {len(self.report)} bins")
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    from utils.CampaignIndex import CampaignIndex
+
+    parser = argparse.ArgumentParser(
+        description="Prints the relative error of the bin means of observables of the feature table"
+    )
+    parser.add_argument(
+        "--dirSimulations",
+        type=str,
+        required=True,
+        help="Directory where the simulation are stored (with the campaign_index.sqlite)",
+    )
+    parser.add_argument(
+        "--dirFeatures",
+        type=str,
+        default=None,
+        help="directory of the feature table, default is features/ in dirSimulations",
+    )
+    parser.add_argument(
+        "--observables",
+        type=str,
+        nargs="+",
+        default=["fluence", "peak"],
+        help="columns of the feature table",
+    )
+    parser.add_argument(
+        "--aggregate",
+        type=str,
+        default="max",
+        choices=["max", "sum"],
+        help="value of an observable per run: max or sum over its antennas",
+    )
+    parser.add_argument(
+        "--target",
+        type=float,
+        default=0.05,
+        help="target relative standard error of the bin means, for the runs needed",
+    )
+    args = parser.parse_args()
+
+    index = CampaignIndex(os.path.join(args.dirSimulations, "campaign_index.sqlite"))
+    sampler = AdaptiveSampler(index, args.dirFeatures or os.path.join(args.dirSimulations, "features"),
+                              observables=args.observables, aggregate=args.aggregate)
+    settings = {"minRuns": 2, "targetRelativeError": args.target, "maxRunsPerRound": np.iinfo(np.int32).max}
+    for key in sorted(sampler.runs()):
+        values, nRunning, _ = sampler.binStatus(key)
+        nNew, relativeError, needed = sampler.runsNeeded(values, nRunning, settings)
+        sampler.report.append((key, len(values), nRunning, relativeError, needed, nNew))
+    sampler.printReport()
+    index.close()
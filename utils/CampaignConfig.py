@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+
+"""
+This module loads the campaign configuration file (campaign.toml by default, YAML is also accepted).
+It holds the constants that used to be hardcoded in FileWriter, RadioFilesGenerator and SubFilesGenerator:
+    [corsika]   path and executable
+    [physics]   THIN, THINH, ECUTS, PARALLEL, MAGNET, ATMFILE
+    [radio]     refractive index and time settings of the .reas file
+    [slurm]     account, partition, nodes, tasks, time limit
+    [site]      name, observation level and starshape settings (atmosphere model, inclination) of the site
+    [staging]   node-local copy of the corsika run directory (DATDIR, executable), off by default
+    [timeResolutionPolicy]  time resolution and window of the .reas file from the antenna distances (see TimeResolutionPolicy.py), off by default
+    [watchdog]  termination of stalled or runaway runs by the job script (see JobWatchdog.py)
+    [thinningPolicy]    the cost-bounded choice of THIN and ECTMAX (see ThinningPolicy.py), off by default
+    [rankScaling]   the number of MPI ranks of each shower from a calibration table (see RankScaling.py), off by default
+    [adaptiveSampling]  only the runs each bin needs for the target precision of its observables (see AdaptiveSampler.py), off by default
+
+Per-bin overrides can be given as a list of [[overrides]] tables, each with an energy range (log10 GeV)
+and/or a zenith range (degrees), [min, max), and the sections/keys that change in that bin, e.g.
+
+    [[overrides]]
+    energy = [7.0, 8.0]
+    physics = { thin = 1.0e-5 }
+
+The overrides are applied in the order of the file, so the last matching one wins.
+
+Site profiles can be given as [sites.<name>] tables with the sections/keys that change for that site, e.g.
+
+    [sites.auger.site]
+    obslev = 140000.0
+    [sites.auger.physics]
+    magnet = [19.71, -14.18]
+    atmfile = "ATMOSPHERE_Malargue.DAT"
+
+config.forSite(name) returns the configuration of a site, the per-bin overrides are applied on top of it.
+
+The file is validated against DEFAULTS (unknown keys and wrong types are rejected), loaded only once per path
+(loadConfig is cached) and returned as read-only mappings, so nothing can change it during the run.
+"""
+
+import functools
+import os
+import types
+
+# The default values. They are also the schema used to validate the file.
+DEFAULTS = {
+    "corsika": {
+        "path":                     "/home/hk-project-radiohfi/bg5912/work/soft/corsika-77550/run/",
+        "exe":                      "mpi_corsika77550Linux_SIBYLL_urqmd_thin_coreas_parallel_runner",
+    },
+    "physics": {
+        "thin":                     1.0E-06,    # relative thinning level, THIN thin thin*E thinRadius
+        "thinRadius":               5.0E+03,
+        "thinh":                    [1.0E+00, 1.0E+02],
+        "ecuts":                    [3.0E-01, 1.0E-02, 2.5E-04, 2.5E-04],
+        "parallelEctcut":           1.0E+03,    # PARALLEL ECTCUT ECTMAX, in GeV
+        "parallelEctmax":           1.0E-03,    # ECTMAX relative to the primary energy
+        "magnet":                   [26.860, 49.687],   # from geomag for Xiaodushan, 400km altitude
+        "atmfile":                  "ATMOSPHERE_20170401120000_Dunhuang.DAT",   # relative to the corsika path
+    },
+    "radio": {
+        "refractiveIndex":          1.00031200,
+        "timeResolution":           5e-10,
+        "automaticTimeBoundaries":  12e-07,
+        "resolutionReductionScale": 0.,
+        "magneticDeclination":      0.12532,
+    },
+    "slurm": {
+        "account":                  "hk-project-p0022320",
+        "partition":                "cpuonly",
+        "nodes":                    1,
+        "ntasksPerNode":            76,
+        "cpusPerTask":              1,
+        "time":                     "2-00:00:00",
+    },
+    "site": {
+        "name":                     "dunhuang", # used for the folder of the site when several sites are simulated
+        "obslev":                   0.,         # observation level in cm (--obslev overrides it)
+        "atmModel":                 41,         # atmosphere model of the starshape calculation, 41: Dunhuang, China
+        "inclination":              61.60523,   # inclination of the magnetic field in degrees, for the starshapes
+    },
+    "staging": {
+        "enabled":                  False,      # copy the corsika run directory to node-local storage (see NodeStaging.py)
+        "localDir":                 "/tmp/corsika_stage",   # node-local, the same on all nodes and kept between jobs
+    },
+    "timeResolutionPolicy": {
+        "enabled":                  False,      # choose the .reas time settings per run (see TimeResolutionPolicy.py)
+        "maxFrequency":             2.5E+08,    # upper end of the frequency band of interest in Hz, sampled at least at Nyquist
+        "fullResolutionRadius":     2.,         # antennas within this many Cherenkov radii of the axis keep the full resolution
+        "minTimeWindow":            4.0E-07,    # time window of the pulse in s, the wavefront curvature is added
+    },
+    "watchdog": {
+        "enabled":                  True,       # terminate stalled or runaway runs (see JobWatchdog.py)
+        "stallMinutes":             60.,        # no growth of the log and timetables for this long: stalled
+        "runtimeFactor":            3.,         # running longer than this times the expected wall time: runaway
+        "checkSeconds":             60,         # interval of the checks
+        "graceSeconds":             30,         # time between TERM and KILL
+        "defaultWallHours":         0.,         # expected wall time without a prediction or measured runs of the bin, 0: cost model
+    },
+    "thinningPolicy": {
+        "budgetCoreHours":          0.,         # target CPU budget per shower, 0: off (the [physics] values are used)
+        "calibrationTable":         "",         # csv of past runs: log10_E,zenith,thin,ectmax,coreHours
+        "thinLevels":               [1.0E-06, 3.0E-06, 1.0E-05, 3.0E-05, 1.0E-04],
+        "ectmaxLevels":             [1.0E-03, 3.0E-03, 1.0E-02],
+    },
+    "rankScaling": {
+        "enabled":                  False,      # choose the MPI ranks of each shower from the table (see RankScaling.py)
+        "table":                    "",         # csv written by python3 -m utils.RankScaling
+        "rankCounts":               [19, 38, 76, 152, 304], # the rank counts calibrated and chosen from
+        "ectmaxLevels":             [1.0E-03, 1.0E-02],     # ECTMAX of the calibration showers
+        "minEfficiency":            0.7,        # the lowest parallel efficiency accepted for more ranks
+        "maxWallHours":             0.,         # the ranks are increased to stay within this wall time, 0: the slurm time limit
+        "chargeUnit":               "node",     # node: whole nodes are charged (exclusive partitions), core: the ranks
+    },
+    "adaptiveSampling": {
+        "enabled":                  False,      # plan only the runs the bins still need (see AdaptiveSampler.py)
+        "observables":              ["fluence", "peak"],    # columns of the feature table (see FeatureExtractor.py)
+        "aggregate":                "max",      # value of an observable per run: max or sum over its antennas
+        "targetRelativeError":      0.05,       # relative standard error of the bin mean of each observable
+        "minRuns":                  5,          # runs of a bin before its variance is estimated
+        "maxRunsPerRound":          20,         # at most this many runs are added to a bin per call
+        "extractFeatures":          True,       # add the newly verified runs to the feature table first
+        "dirFeatures":              "",         # directory of the feature table, default is features/ in dirSimulations
+    },
+}
+
+# Lists of these keys can have any length (all the other lists have the length of the default)
+VARIABLE_LENGTH = {"thinLevels", "ectmaxLevels", "observables", "rankCounts"}
+
+DEFAULT_CONFIG_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "campaign.toml")
+
+
+def _freeze(value):
+    """
+    Returns a read-only copy: dictionaries become MappingProxyType, lists become tuples
+    """
+    if isinstance(value, dict):
+        return types.MappingProxyType({key: _freeze(item) for key, item in value.items()})
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+def _checkType(name, value, default):
+    # integers are fine where floats are expected, the opposite is not
+    if isinstance(default, float) and isinstance(value, int) and not isinstance(value, bool):
+        return float(value)
+    if isinstance(default, list):
+        if name.split(".")[-1] in VARIABLE_LENGTH:
+            if not isinstance(value, (list, tuple)) or len(value) == 0:
+                raise ValueError(f"Config key {name} must be a non-empty list, got {value!r}")
+            return [_checkType(f"{name}[{i}]", item, default[0]) for i, item in enumerate(value)]
+        if not isinstance(value, (list, tuple)) or len(value) != len(default):
+            raise ValueError(f"Config key {name} must be a list of {len(default)} values, got {value!r}")
+        return [_checkType(f"{name}[{i}]", item, default[i]) for i, item in enumerate(value)]
+    if not isinstance(value, type(default)):
+        raise ValueError(f"Config key {name} must be of type {type(default).__name__}, got {value!r}")
+    return value
+
+
+def _validateSections(data, where):
+    """
+    Checks that all sections and keys exist in DEFAULTS and have the right type.
+    Returns the validated (and type converted) sections.
+    """
+    validated = {}
+    for section, values in data.items():
+        if section not in DEFAULTS:
+            raise ValueError(f"Unknown config section [{section}] in {where}")
+        if not isinstance(values, dict):
+            raise ValueError(f"Config section [{section}] in {where} must be a table")
+        validated[section] = {}
+        for key, value in values.items():
+            if key not in DEFAULTS[section]:
+                raise ValueError(f"Unknown config key {section}.{key} in {where}")
+            validated[section][key] = _checkType(f"{section}.{key}", value, DEFAULTS[section][key])
+    return validated
+
+
+def _validateRange(name, value, where):
+    if not isinstance(value, (list, tuple)) or len(value) != 2 or not value[0] < value[1]:
+        raise ValueError(f"{name} in {where} must be a [min, max) range, got {value!r}")
+    return (float(value[0]), float(value[1]))
+
+
+class CampaignConfig:
+    """
+    Read-only campaign configuration.
+        config["physics"]["thin"]       the values of the file (or the defaults)
+        config.forBin(log10_E1, zenith) the values with the overrides of that bin applied
+        config.forSite(name)            the configuration of a site profile
+    """
+
+    def __init__(self, data, source="<defaults>", site=None):
+        self._data = data
+        data = dict(data)
+        overrides = data.pop("overrides", [])
+        sites = data.pop("sites", {})
+        self.source = source
+
+        merged = {section: dict(values) for section, values in DEFAULTS.items()}
+        for section, values in _validateSections(data, source).items():
+            merged[section].update(values)
+
+        if not isinstance(sites, dict):
+            raise ValueError(f"sites in {source} must be a table of site profiles")
+        self.siteNames = tuple(sites) or (merged["site"]["name"],)
+        self._sites = frozenset(sites)
+        if site in sites:
+            for section, values in _validateSections(sites[site], f"{source} sites.{site}").items():
+                merged[section].update(values)
+            merged["site"]["name"] = site
+        elif site is not None and site != merged["site"]["name"]:
+            raise ValueError(f"Unknown site {site!r} in {source}, the sites are {', '.join(self.siteNames)}")
+        self._site = site
+        self._base = _freeze(merged)
+        self._siteCache = {}
+
+        self._overrides = []
+        for i, override in enumerate(overrides):
+            where = f"{source} overrides[{i}]"
+            override = dict(override)
+            energy = _validateRange("energy", override.pop("energy", (-1e9, 1e9)), where)
+            zenith = _validateRange("zenith", override.pop("zenith", (-1e9, 1e9)), where)
+            self._overrides.append((energy, zenith, _validateSections(override, where)))
+        self._overrides = tuple(self._overrides)
+
+        self._binCache = {}
+
+    def __getitem__(self, section):
+        return self._base[section]
+
+    def forSite(self, name):
+        """
+        Returns the configuration with the profile of the site applied (the same config for the default site).
+        """
+        if name == self._site or (name not in self._sites and name == self._base["site"]["name"]):
+            return self
+        if name not in self._siteCache:
+            self._siteCache[name] = CampaignConfig(self._data, self.source, site=name)
+        return self._siteCache[name]
+
+    def forBin(self, log10_E1, zenith):
+        """
+        Returns the configuration with all overrides matching the energy (log10 GeV) and zenith (degrees) applied.
+        """
+        key = (round(float(log10_E1), 6), round(float(zenith), 6))
+        if key not in self._binCache:
+            merged = {section: dict(values) for section, values in self._base.items()}
+            for (eMin, eMax), (zMin, zMax), sections in self._overrides:
+                if eMin <= key[0] < eMax and zMin <= key[1] < zMax:
+                    for section, values in sections.items():
+                        merged[section].update(values)
+            self._binCache[key] = _freeze(merged)
+        return self._binCache[key]
+
+
+@functools.lru_cache(maxsize=None)
+def loadConfig(path=DEFAULT_CONFIG_PATH):
+    """
+    Loads and validates the config file. The result is cached, so the file is only read once per run.
+    TOML is read with the standard library, YAML needs PyYAML.
+    If the path is None, the defaults are used.
+    """
+    if path is None:
+        return CampaignConfig({})
+
+    path = os.path.abspath(path)
+    if path.endswith((".yaml", ".yml")):
+        import yaml
+        with open(path) as f:
+            data = yaml.safe_load(f) or {}
+    else:
+        try:
+            import tomllib
+        except ImportError: # python < 3.11
+            import tomli as tomllib
+        with open(path, "rb") as f:
+            data = tomllib.load(f)
+    return CampaignConfig(data, source=path)
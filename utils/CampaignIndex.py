@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+
+"""
+This class keeps an index of all runs of a campaign in a SQLite database
+(by default {dirSimulations}/campaign_index.sqlite).
+
+Each run is identified by its folder (primary/energy/zenith/runNumber/), since the runNumber alone is not
+unique across the energy bins. For each run the index stores the parameters of the shower, the settings
+chosen for it (thinning, ECTMAX, number of antennas, predicted core-hours) and its state.
+The verified flag and checksum of the output are set by OutputVerifier,
+the container of the archived runs by RunArchiver, the features flag (1: in the feature table) by FeatureExtractor.
+runIndex is the index of the run in its bin (older indices only have it in the last digits of the runNumber).
+
+Writes are buffered and committed in batches (see flush), so that generating a million runs does not mean
+a million transactions on the shared filesystem.
+
+The table bin_counters holds the number of runs, their core-hours and predicted core-hours per
+primary/site/energy/zenith bin and state. It is kept up to date by triggers on the runs table, in the same
+transaction as the change of a run, so that the status of a campaign (see CampaignStatus.py) never has to
+read all runs. first_entered and last_entered are the first and last time a run of the bin entered the state.
+
+Several drivers can work on the same campaign with the plan table: the first one publishes the plan
+(publishPlan, one row per run folder), then each driver claims small batches of runs (claimRuns) with a lease. A claim is atomic
+(BEGIN IMMEDIATE holds the write lock of the database from the select to the update), so no run is claimed twice.
+A driver only claims the runs of its own primaries and sites. It renews the leases of its claims while it holds them
+(renewClaims) and skips the runs whose lease it lost. Claims are completed when the run is submitted; the leases
+of a crashed driver expire and its runs are claimed again by the others.
+"""
+
+import collections
+import os
+import socket
+import sqlite3
+import time
+
+from utils.Logger import getLogger
+
+logger = getLogger(__name__)
+
+
+class CampaignIndex:
+    """
+    Parameters:
+        path:       the SQLite file of the index
+        batchSize:  number of buffered rows after which they are committed
+    """
+
+    # column name and type of the runs table
+    columns = {
+        "folder":               "TEXT PRIMARY KEY",
+        "runNumber":            "TEXT",
+        "runIndex":             "INTEGER",
+        "primary_particle":     "INTEGER",
+        "site":                 "TEXT",
+        "log10_E1":             "REAL",
+        "zenith_bin":           "REAL",
+        "zenith":               "REAL",
+        "azimuth":              "REAL",
+        "log10_E":              "REAL",
+        "weight":               "REAL",
+        "state":                "TEXT",
+        "thin":                 "REAL",
+        "ectmax":               "REAL",
+        "ranks":                "INTEGER",
+        "predicted_core_hours": "REAL",
+        "n_antennas":           "INTEGER",
+        "wall_hours":           "REAL",
+        "core_hours":           "REAL",
+        "verified":             "INTEGER",
+        "checksum":             "TEXT",
+        "verify_error":         "TEXT",
+        "archive":              "TEXT",
+        "archive_offset":       "INTEGER",
+        "archive_size":         "INTEGER",
+        "features":             "INTEGER",
+        "updated":              "REAL",
+    }
+
+    # column name and type of the plan table shared by the drivers
+    planColumns = {
+        "id":                   "INTEGER PRIMARY KEY",
+        "folder":               "TEXT UNIQUE",
+        "primary_particle":     "INTEGER",
+        "site":                 "TEXT",
+        "log10_E1":             "REAL",
+        "zenith_bin":           "REAL",
+        "zenith":               "REAL",
+        "azimuth":              "REAL",
+        "runIndex":             "INTEGER",
+        "log10_E":              "REAL",
+        "weight":               "REAL",
+        "status":               "TEXT",     # pending, claimed or done
+        "lease_owner":          "TEXT",
+        "lease_expires":        "REAL",
+    }
+
+    # the bin of a run in bin_counters, runs without a bin (e.g. only a state was set) are counted in the bin -1
+    binExpressions = ("COALESCE({row}.primary_particle, -1)", "COALESCE({row}.site, '')",
+                      "COALESCE({row}.log10_E1, -1)", "COALESCE({row}.zenith_bin, -1)", "COALESCE({row}.state, '')")
+
+    def __init__(self, path, batchSize=1000):
+        self.path = path
+        self.batchSize = batchSize
+        self._buffer = []
+        self.connection = sqlite3.connect(path, timeout=60)
+        columns = ", ".join(f"{name} {kind}" for name, kind in self.columns.items())
+        self.connection.execute(f"CREATE TABLE IF NOT EXISTS runs ({columns})")
+        # indices created by an older version get the new columns
+        existing = {row[1] for row in self.connection.execute("PRAGMA table_info(runs)")}
+        for name, kind in self.columns.items():
+            if name not in existing:
+                self.connection.execute(f"ALTER TABLE runs ADD COLUMN {name} {kind}")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS runs_bin ON runs (log10_E1, zenith_bin)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS runs_verified ON runs (verified)")
+        columns = ", ".join(f"{name} {kind}" for name, kind in self.planColumns.items())
+        self.connection.execute(f"CREATE TABLE IF NOT EXISTS plan ({columns})")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS plan_status ON plan (status, lease_expires)")
+        self._createCounters()
+        self.connection.commit()
+
+    def _createCounters(self):
+        """
+        Creates the bin_counters table and the triggers maintaining it (filled from the runs of an older index)
+        """
+        exists = self.connection.execute(
+            "SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = 'bin_counters'").fetchone()[0]
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS bin_counters (primary_particle INTEGER, site TEXT, log10_E1 REAL, zenith_bin REAL, "
+            "state TEXT, n INTEGER, core_hours REAL, predicted_core_hours REAL, first_entered REAL, last_entered REAL, "
+            "PRIMARY KEY (primary_particle, site, log10_E1, zenith_bin, state))")
+        if not exists:
+            self.connection.execute(
+                f"INSERT INTO bin_counters SELECT {', '.join(expression.format(row='runs') for expression in self.binExpressions)}, "
+                "COUNT(*), TOTAL(core_hours), TOTAL(predicted_core_hours), MIN(updated), MAX(updated) FROM runs GROUP BY 1, 2, 3, 4, 5")
+
+        def add(row, sign, entered="1"):
+            key = ", ".join(expression.format(row=row) for expression in self.binExpressions)
+            match = " AND ".join(f"{name} = {expression.format(row=row)}" for name, expression in
+                                 zip(("primary_particle", "site", "log10_E1", "zenith_bin", "state"), self.binExpressions))
+            # not INSERT OR IGNORE: the conflict policy of the statement firing the trigger (e.g. the upsert of flush) wins
+            return (f"INSERT INTO bin_counters SELECT {key}, 0, 0., 0., NULL, NULL "
+                    f"WHERE NOT EXISTS (SELECT 1 FROM bin_counters WHERE {match}); "
+                    f"UPDATE bin_counters SET n = n {sign} 1, "
+                    f"core_hours = core_hours {sign} COALESCE({row}.core_hours, 0.), "
+                    f"predicted_core_hours = predicted_core_hours {sign} COALESCE({row}.predicted_core_hours, 0.)"
+                    + (f", first_entered = CASE WHEN {entered} THEN MIN(COALESCE(first_entered, {row}.updated), {row}.updated) ELSE first_entered END, "
+                       f"last_entered = CASE WHEN {entered} THEN MAX(COALESCE(last_entered, {row}.updated), {row}.updated) ELSE last_entered END"
+                       if sign == "+" else "")
+                    + f" WHERE {match};")
+
+        self.connection.execute(
+            f"CREATE TRIGGER IF NOT EXISTS runs_insert AFTER INSERT ON runs BEGIN {add('NEW', '+')} END")
+        self.connection.execute(
+            f"CREATE TRIGGER IF NOT EXISTS runs_delete AFTER DELETE ON runs BEGIN {add('OLD', '-')} END")
+        # only the columns of the counters, e.g. a new checksum does not touch them,
+        # and the run only enters its state (first/last_entered) if the state changed
+        self.connection.execute(
+            "CREATE TRIGGER IF NOT EXISTS runs_update AFTER UPDATE OF primary_particle, site, log10_E1, zenith_bin, state, "
+            f"core_hours, predicted_core_hours ON runs BEGIN {add('OLD', '-')} {add('NEW', '+', 'OLD.state IS NOT NEW.state')} END")
+
+    def addRun(self, **run):
+        """
+        Adds (or replaces) a run. The keywords are the columns of the runs table, the folder is required.
+        """
+        run.setdefault("updated", time.time())
+        self._buffer.append(run)
+        if len(self._buffer) >= self.batchSize:
+            self.flush()
+
+    def flush(self):
+        """
+        Commits all buffered rows in a single transaction.
+        """
+        if not self._buffer:
+            return
+        with self.connection:
+            for run in self._buffer:
+                names = ", ".join(run.keys())
+                placeholders = ", ".join("?" for _ in run)
+                updates = ", ".join(f"{name}=excluded.{name}" for name in run.keys() if name != "folder")
+                self.connection.execute(
+                    f"INSERT INTO runs ({names}) VALUES ({placeholders}) ON CONFLICT(folder) DO UPDATE SET {updates}",
+                    [self._toSql(value) for value in run.values()],
+                )
+        self._buffer = []
+
+    def setState(self, folder, state):
+        self.addRun(folder=folder, state=state)
+
+    def getRuns(self, state=None, columns=("folder", "runNumber")):
+        """
+        Returns the rows of the runs (optionally only the ones in the given state) as a list of tuples.
+        """
+        self.flush()
+        query = f"SELECT {', '.join(columns)} FROM runs"
+        if state is None:
+            return self.connection.execute(query).fetchall()
+        return self.connection.execute(query + " WHERE state = ?", (state,)).fetchall()
+
+    def getVerifiedFolders(self):
+        """
+        Returns the set of the folders of the runs whose output is verified (see OutputVerifier).
+        """
+        self.flush()
+        return {row[0] for row in self.connection.execute("SELECT folder FROM runs WHERE verified = 1")}
+
+    def getBinCounters(self):
+        """
+        Returns the rows of bin_counters as dictionaries
+        """
+        self.flush()
+        cursor = self.connection.execute("SELECT * FROM bin_counters WHERE n != 0")
+        names = [column[0] for column in cursor.description]
+        return [dict(zip(names, row)) for row in cursor.fetchall()]
+
+    def getBinCoreHours(self):
+        """
+        Returns the mean measured core-hours (see RuntimeAggregator) of the runs of each bin, as a dictionary
+        {(primary_particle, site, log10_E1, zenith_bin): core-hours}, only of the bins with measured runs
+        """
+        self.flush()
+        rows = self.connection.execute(
+            "SELECT primary_particle, COALESCE(site, ''), log10_E1, zenith_bin, AVG(core_hours) FROM runs "
+            "WHERE core_hours IS NOT NULL GROUP BY 1, 2, 3, 4")
+        return {(primary, site, log10_E1, zenith_bin): coreHours for primary, site, log10_E1, zenith_bin, coreHours in rows}
+
+    @staticmethod
+    def leaseOwner():
+        """
+        Returns the name of this driver in the leases: host and process id
+        """
+        return f"{socket.gethostname()}:{os.getpid()}"
+
+    def publishPlan(self, plan, append=False):
+        """
+        Stores the plan (see SimulationMaker.buildPlan and mergePlans, with the folder of each run added)
+        as the shared plan of the campaign, unless another driver published one before.
+        A driver joining the shared plan must have the same energy/zenith bins for the primaries and sites in it,
+        otherwise a ValueError is raised; the runs of its primaries and sites that are not in it yet are added.
+        With append (the follow-up rounds of AdaptiveSampler), the runs are added to the shared plan unless
+        runs of it are still pending or claimed, i.e. another driver added its round before.
+        Runs of the plan with the same folder are stored once, the number of runs dropped this way is logged.
+        Returns the number of runs of the shared plan.
+        """
+        self.flush()
+        keys = ["folder", "primary_particle", "site", "log10_E1", "zenith_bin", "zenith", "azimuth", "runIndex", "log10_E", "weight"]
+        planKeys = ["folder", "primary", "site", "log10_E1", "zenith_bin", "zenith", "azimuth", "runIndex", "log10_E", "weight"]
+        rows = list(zip(*[[self._toSql(value) for value in plan[key]] for key in planKeys]))
+        bins = collections.defaultdict(set)
+        for row in rows:
+            bins[row[1:3]].add(row[3:5])
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            published = collections.defaultdict(set)
+            for primary, site, log10_E1, zenith_bin in self.connection.execute(
+                    "SELECT DISTINCT primary_particle, site, log10_E1, zenith_bin FROM plan"):
+                published[(primary, site)].add((log10_E1, zenith_bin))
+            if append:
+                roundOpen = self.connection.execute("SELECT COUNT(*) FROM plan WHERE status != 'done'").fetchone()[0] == 0
+            else:
+                roundOpen = not published
+                for primary, site in set(bins) & set(published):
+                    if bins[(primary, site)] != published[(primary, site)]:
+                        raise ValueError(f"The energy/zenith bins of primary {primary} and site {site!r} differ from the shared plan "
+                                         f"of the campaign in {self.path}, use the same settings as the other drivers")
+            # the primaries and sites that are not in the shared plan yet are always added
+            rows = [row for row in rows if roundOpen or row[1:3] not in published]
+            changes = self.connection.total_changes
+            self.connection.executemany(
+                f"INSERT OR IGNORE INTO plan ({', '.join(keys)}, status) VALUES ({', '.join('?' for _ in keys)}, 'pending')", rows)
+            nDropped = len(rows) - (self.connection.total_changes - changes)
+            nRuns = self.connection.execute("SELECT COUNT(*) FROM plan").fetchone()[0]
+            self.connection.commit()
+        except BaseException:
+            self.connection.rollback()
+            raise
+        if nDropped:
+            logger.warning(f"{nDropped} of {len(rows)} runs were not added to the shared plan, their folder is already in it")
+        return nRuns
+
+    def claimRuns(self, owner, n, leaseSeconds=3600., pairs=None):
+        """
+        Claims up to n pending runs of the plan (or runs whose lease expired) for owner,
+        only of the (primary, site) pairs given (all runs if None).
+        Returns the claimed runs as a list of dictionaries with the columns of the plan table.
+        """
+        self.flush()
+        now = time.time()
+        condition, parameters = "", []
+        if pairs is not None:
+            condition = " AND (" + " OR ".join("(primary_particle = ? AND site = ?)" for _ in pairs) + ")"
+            parameters = [self._toSql(value) for pair in pairs for value in pair]
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            # the runs of crashed drivers first, then the pending ones (both from the plan_status index)
+            cursor = self.connection.execute(
+                f"SELECT * FROM plan WHERE status = 'claimed' AND lease_expires < ?{condition} LIMIT ?", (now, *parameters, n))
+            rows = cursor.fetchall()
+            if len(rows) < n:
+                rows += self.connection.execute(
+                    f"SELECT * FROM plan WHERE status = 'pending'{condition} LIMIT ?", (*parameters, n - len(rows))).fetchall()
+            names = [column[0] for column in cursor.description]
+            runs = [dict(zip(names, row)) for row in rows]
+            self.connection.executemany(
+                "UPDATE plan SET status = 'claimed', lease_owner = ?, lease_expires = ? WHERE id = ?",
+                [(owner, now + leaseSeconds, run["id"]) for run in runs])
+            self.connection.commit()
+        except BaseException:
+            self.connection.rollback()
+            raise
+        return runs
+
+    def renewClaims(self, owner, leaseSeconds=3600.):
+        """
+        Extends the leases of the unfinished claims of owner (the heartbeat of a driver).
+        Returns the ids of the runs it still holds, the others were claimed by another driver after their lease expired.
+        """
+        with self.connection:
+            self.connection.execute(
+                "UPDATE plan SET lease_expires = ? WHERE status = 'claimed' AND lease_owner = ?", (time.time() + leaseSeconds, owner))
+        return {row[0] for row in self.connection.execute(
+            "SELECT id FROM plan WHERE status = 'claimed' AND lease_owner = ?", (owner,))}
+
+    def completeClaim(self, owner, planId):
+        """
+        Marks a claimed run as done. Returns False if the lease was lost (expired and claimed by another driver).
+        """
+        with self.connection:
+            cursor = self.connection.execute(
+                "UPDATE plan SET status = 'done', lease_expires = NULL WHERE id = ? AND lease_owner = ?", (planId, owner))
+        return cursor.rowcount == 1
+
+    def releaseClaims(self, owner, planIds=None):
+        """
+        Returns the unfinished claims of owner (only the runs planIds, if given) to the pending runs,
+        e.g. when a driver stops
+        """
+        condition, parameters = "", []
+        if planIds is not None:
+            condition = f" AND id IN ({', '.join('?' for _ in planIds)})"
+            parameters = list(planIds)
+        with self.connection:
+            self.connection.execute(
+                "UPDATE plan SET status = 'pending', lease_owner = NULL, lease_expires = NULL "
+                f"WHERE status = 'claimed' AND lease_owner = ?{condition}", (owner, *parameters))
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+    @staticmethod
+    def _toSql(value):
+        # numpy scalars are converted to python ones, which sqlite understands
+        return value.item() if hasattr(value, "item") else value
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+
+"""
+This class estimates what a campaign will cost before anything is written to disk.
+It takes the plan built by SimulationMaker.buildPlan and reports per energy/zenith bin:
+    number of showers
+    estimated core-hours
+    expected output size
+    expected number of inodes (files and folders)
+and the number of Slurm submissions (one sbatch per shower).
+
+Everything is done with numpy on the columns of the plan, so it is fast also for plans with millions of showers.
+
+The cost model is a rough one and should be replaced by numbers from past campaigns where available
+(with a thinning policy its prediction for the chosen THIN and ECTMAX is given as coreHours):
+    core-hours scale linearly with the energy of the shower (fixed relative thinning)
+    and with the slant depth (1/cos(zenith)) relative to a reference shower,
+    and linearly with the number of antennas for the CoREAS part.
+    The output is dominated by the CoREAS traces (one text file per antenna)
+    and the particle file written by corsika (PAROUT).
+
+The number of antennas, trace samples and MPI ranks of each run follow from the FileWriter of its primary and site
+(see runSettings): the antennas kept by the footprint pruning for a core placed as in
+RadioFilesGenerator.get_antennaPositions, the samples of the [radio] time window and resolution,
+and the ranks of RankScaling or of the [slurm] section.
+"""
+
+import numpy as np
+
+from utils.FootprintModel import FootprintModel
+
+
+def referenceCoreHours(log10_E, zenith, nAntennas, refLog10_E=8., refZenith=65., refCoreHours=50., coreHoursPerAntenna=0.5):
+    """
+    Returns the core-hours of showers of the cost model above (numpy broadcasting over all arguments)
+    """
+    energyScale = 10**(np.asarray(log10_E, dtype=float) - refLog10_E)
+    slantScale = np.cos(np.deg2rad(refZenith)) / np.cos(np.deg2rad(np.minimum(zenith, 89.)))
+    return (refCoreHours + coreHoursPerAntenna * np.asarray(nAntennas, dtype=float)) * energyScale * slantScale
+
+
+def antennaPositions(pathAntennas):
+    """
+    Returns the x and y in cm of the antennas of a .list file (AntennaPosition = x y z name)
+    """
+    positions = np.genfromtxt(pathAntennas, dtype="str", ndmin=2)
+    return positions[:, 2].astype(float), positions[:, 3].astype(float)
+
+
+def coreOffsets(n, rng, minRadius=20000., maxRadius=40000.):
+    """
+    Returns n random shifts (dx, dy) in cm of the antennas, uniform in the square of half-size maxRadius
+    without the disk of minRadius, as in RadioFilesGenerator.get_antennaPositions
+    """
+    dx, dy = np.zeros(n), np.zeros(n)
+    redo = np.arange(n)
+    while len(redo):
+        dx[redo] = rng.uniform(-maxRadius, maxRadius, len(redo))
+        dy[redo] = rng.uniform(-maxRadius, maxRadius, len(redo))
+        redo = redo[np.hypot(dx[redo], dy[redo]) <= minRadius]
+    return dx, dy
+
+
+def runSettings(plan, fileWriter, seed=0, chunkSize=4096):
+    """
+    Returns the number of antennas, the mean number of trace samples per antenna and the MPI ranks of every run
+    of a plan (see SimulationMaker.buildPlan), as the FileWriter of the plan writes them.
+    The antennas are counted for one random core position per run, like the runs themselves.
+    With a TimeResolutionPolicy the time settings are chosen when the runs are written, the [radio] ones are used here.
+    """
+    nRuns = len(plan["log10_E1"])
+    config = fileWriter.config
+    x, y = antennaPositions(fileWriter.pathAntennas)
+
+    # the settings of the bin, as in FileWriter.writeFile (overrides by energy bin and zenith)
+    window, resolution, scale, ectmax, ranks = (np.zeros(nRuns) for _ in range(5))
+    pairs = np.stack([plan["log10_E1"], plan["zenith"]], axis=1)
+    uniquePairs, pairIndex = np.unique(pairs, axis=0, return_inverse=True)
+    pairIndex = pairIndex.reshape(-1)
+    for i, (log10_E1, zenith) in enumerate(uniquePairs):
+        binConfig = config.forBin(log10_E1, zenith)
+        mask = pairIndex == i
+        window[mask] = binConfig["radio"]["automaticTimeBoundaries"]
+        resolution[mask] = binConfig["radio"]["timeResolution"]
+        scale[mask] = binConfig["radio"]["resolutionReductionScale"]
+        ectmax[mask] = binConfig["physics"]["parallelEctmax"]
+        ranks[mask] = binConfig["slurm"]["nodes"] * binConfig["slurm"]["ntasksPerNode"]
+    if fileWriter.thinningPolicy is not None:
+        ectmax = np.array([fileWriter.thinningPolicy.choose(log10_E1, zenith_bin)[1]
+                           for log10_E1, zenith_bin in zip(plan["log10_E1"], plan["zenith_bin"])])
+    if fileWriter.rankScaling is not None:
+        ranks = np.array([fileWriter.rankScaling.choose(log10_E, zenith_bin, par)
+                          for log10_E, zenith_bin, par in zip(plan["log10_E"], plan["zenith_bin"], ectmax)], dtype=float)
+
+    nAntennas = np.full(nRuns, len(x), dtype=float)
+    samples = window / resolution
+    dx, dy = coreOffsets(nRuns, np.random.default_rng(seed))
+    for start in range(0, nRuns, chunkSize):
+        runs = slice(start, start + chunkSize)
+        # the antennas relative to the core of each run
+        u, v = x[None, :] + dx[runs, None], y[None, :] + dy[runs, None]
+        kept = np.ones(u.shape, dtype=bool)
+        if fileWriter.footprintFactor:
+            footprint = FootprintModel(
+                zenith=plan["zenith"][runs],
+                azimuth=plan["azimuth"][runs],
+                log10_E1=plan["log10_E"][runs],
+                obslev=fileWriter.obslev,
+                radiusFactor=fileWriter.footprintFactor,
+            )
+            semiMajor, semiMinor = footprint.getEllipse()
+            phi = np.deg2rad(plan["azimuth"][runs])[:, None]
+            along = u * np.cos(phi) + v * np.sin(phi)
+            across = - u * np.sin(phi) + v * np.cos(phi)
+            ellipseDistance = (along / semiMajor[:, None])**2 + (across / semiMinor[:, None])**2
+            # at least the closest antenna (FootprintModel.minAntennas)
+            kept = (ellipseDistance <= 1.) | (ellipseDistance == ellipseDistance.min(axis=1, keepdims=True))
+            nAntennas[runs] = kept.sum(axis=1)
+        if (scale[runs] > 0).any():
+            # CoREAS coarsens the resolution with the distance from the core (see TimeResolutionPolicy.reductionFactors)
+            factor = np.where(scale[runs, None] > 0, 1. + np.floor(np.hypot(u, v) / np.where(scale[runs] > 0, scale[runs], 1.)[:, None]), 1.)
+            samples[runs] = (kept * (window[runs] / resolution[runs])[:, None] / factor).sum(axis=1) / np.maximum(nAntennas[runs], 1)
+    return {"nAntennas": nAntennas, "nSamples": samples, "nRanks": ranks}
+
+
+class CampaignPlanner:
+    """
+    Parameters:
+        plan:                   the plan returned by SimulationMaker.buildPlan
+        nAntennas:              number of antennas in the .list file of each shower (one value or one per run)
+        refLog10_E:             energy of the reference shower in log10 GeV
+        refZenith:              zenith of the reference shower in degrees
+        refCoreHours:           core-hours of the reference shower without antennas
+        coreHoursPerAntenna:    additional core-hours of the reference shower per antenna
+        nRanks:                 number of MPI ranks per shower (one file per rank is written by the parallel runner)
+        nSamples:               number of samples per antenna trace (AutomaticTimeBoundaries / TimeResolution)
+                                nAntennas, nRanks and nSamples can be given per run, see runSettings
+        bytesPerSample:         bytes per line of the trace files (time and three field components as text)
+        particleFileBytes:      bytes of the particle file of the reference shower
+        longFileBytes:          bytes of the .long file
+        coreHours:              predicted core-hours of every run of the plan (e.g. ThinningPolicy.predictPlan),
+                                which replace the reference scaling above. None uses the scaling
+    """
+
+    # files written for every run, apart from antennas and MPI ranks:
+    # folder, .inp, .reas, .list, .sub, DAT.log, DAT.long, DAT particle file, DAT folder,
+    # _coreas.reas, _coreas.bins, _coreas folder, slurm .out and .err
+    filesPerRun = 14
+
+    def __init__(self,
+        plan,
+        nAntennas,
+        refLog10_E=8.,
+        refZenith=65.,
+        refCoreHours=50.,
+        coreHoursPerAntenna=0.5,
+        nRanks=76,
+        nSamples=2400,
+        bytesPerSample=64,
+        particleFileBytes=2e8,
+        longFileBytes=2e5,
+        coreHours=None,
+    ):
+        self.plan = plan
+        self.nAntennas = nAntennas
+        self.refLog10_E = refLog10_E
+        self.refZenith = refZenith
+        self.refCoreHours = refCoreHours
+        self.coreHoursPerAntenna = coreHoursPerAntenna
+        self.nRanks = nRanks
+        self.nSamples = nSamples
+        self.bytesPerSample = bytesPerSample
+        self.particleFileBytes = particleFileBytes
+        self.longFileBytes = longFileBytes
+        self.coreHours = coreHours
+
+    def estimateRuns(self):
+        """
+        Returns the estimated core-hours, output bytes and inodes of every run in the plan.
+        """
+        energyScale = 10**(self.plan["log10_E"] - self.refLog10_E)
+
+        if self.coreHours is not None:
+            coreHours = np.asarray(self.coreHours, dtype=float)
+        else:
+            coreHours = referenceCoreHours(self.plan["log10_E"], self.plan["zenith"], self.nAntennas, self.refLog10_E,
+                                           self.refZenith, self.refCoreHours, self.coreHoursPerAntenna)
+        outputBytes = (self.nAntennas * self.nSamples * self.bytesPerSample
+                       + self.particleFileBytes * energyScale
+                       + self.longFileBytes)
+        inodes = np.broadcast_to(self.filesPerRun + np.asarray(self.nAntennas) + 2 * np.asarray(self.nRanks), coreHours.shape)
+        return coreHours, outputBytes, inodes
+
+    def summary(self):
+        """
+        Returns a dictionary of numpy arrays, one entry per energy/zenith bin.
+        """
+        coreHours, outputBytes, inodes = self.estimateRuns()
+
+        bins = np.stack([self.plan["log10_E1"], self.plan["zenith_bin"]], axis=1)
+        uniqueBins, binIndex = np.unique(bins, axis=0, return_inverse=True)
+        binIndex = binIndex.reshape(-1)
+        nBins = len(uniqueBins)
+
+        return {
+            "log10_E1":     uniqueBins[:, 0],
+            "zenith_bin":   uniqueBins[:, 1],
+            "showers":      np.bincount(binIndex, minlength=nBins),
+            "coreHours":    np.bincount(binIndex, weights=coreHours, minlength=nBins),
+            "outputBytes":  np.bincount(binIndex, weights=outputBytes, minlength=nBins),
+            # plus the energy and zenith folder of each bin
+            "inodes":       np.bincount(binIndex, weights=inodes, minlength=nBins) + 2,
+        }
+
+    def printReport(self):
+        """
+        Prints the estimates per bin and for the whole campaign.
+        """
+        summary = self.summary()
+
+        print(f"{'log10_E':>8} {'zenith':>7} {'showers':>9} {'core-hours':>12} {'output GB':>11} {'inodes':>10}")
+        for i in range(len(summary["showers"])):
+            print(f"{summary['log10_E1'][i]:>8.1f} {summary['zenith_bin'][i]:>7.1f} {summary['showers'][i]:>9d} "
+                  f"{summary['coreHours'][i]:>12.1f} {summary['outputBytes'][i] / 1e9:>11.2f} {int(summary['inodes'][i]):>10d}")
+
+        print("-------------------- Campaign total --------------------")
+        print(f"Showers:            {summary['showers'].sum()}")
+        print(f"Slurm submissions:  {summary['showers'].sum()}")
+        print(f"Core-hours:         {summary['coreHours'].sum():.1f}")
+        print(f"Output:             {summary['outputBytes'].sum() / 1e12:.3f} TB")
+        print(f"Inodes:             {int(summary['inodes'].sum())}")
+        return summary
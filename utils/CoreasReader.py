@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+"""
+Functions to read the CORSIKA/CoREAS input and output files of a run:
+    .inp    corsika keywords
+    .reas   CoREAS parameters
+    .list   antenna positions and names ("AntennaPosition = x y z name")
+    SIMxxxxxx_coreas/raw_<name>.dat     the traces: time, E north, E west, E vertical (cgs units)
+readList and readTrace also take an open file (e.g. a member of an archived run, see RunArchiver.openRun).
+"""
+
+import numpy as np
+
+
+def readInp(fileName):
+    """
+    Returns a dictionary {KEYWORD: [tokens of each line with this keyword]}
+    e.g. inp["OBSLEV"][0][0] is the observation level as a string.
+    Comment lines (starting with *) are skipped.
+    """
+    inp = {}
+    with open(fileName) as f:
+        for line in f:
+            tokens = line.split()
+            if not tokens or tokens[0].startswith("*"):
+                continue
+            inp.setdefault(tokens[0], []).append(tokens[1:])
+    return inp
+
+
+def readReas(fileName):
+    """
+    Returns a dictionary {parameter: value as string} of a .reas file, without the comments after ;
+    """
+    reas = {}
+    with open(fileName) as f:
+        for line in f:
+            line = line.split(";")[0].strip()
+            if not line or line.startswith("#") or "=" not in line:
+                continue
+            key, value = line.split("=", 1)
+            reas[key.strip()] = value.strip()
+    return reas
+
+
+def readList(fileName):
+    """
+    Returns a dictionary with the x, y, z (float arrays, in cm) and name of the antennas of a .list file
+    """
+    if hasattr(fileName, "read"):
+        rows = [line.split() for line in _text(fileName.read()).splitlines() if line.strip()]
+    else:
+        with open(fileName) as f:
+            rows = [line.split() for line in f if line.strip()]
+    return {
+        "x": np.array([row[2] for row in rows], dtype=float),
+        "y": np.array([row[3] for row in rows], dtype=float),
+        "z": np.array([row[4] for row in rows], dtype=float),
+        "name": np.array([row[5] for row in rows], dtype=str),
+    }
+
+
+def readTrace(fileName):
+    """
+    Returns the trace of an antenna as an array (n samples, 4): time in s and the three field components
+    """
+    # much faster than np.loadtxt, the files have no header
+    if hasattr(fileName, "read"):
+        values = np.fromstring(_text(fileName.read()), sep=" ")
+    else:
+        values = np.fromfile(fileName, sep=" ")
+    return values.reshape(-1, 4)
+
+
+def _text(data):
+    return data.decode() if isinstance(data, bytes) else data
+
+
+def expectedSamples(reas, antennas=None):
+    """
+    Returns the number of samples of the traces for the parameters of a .reas file, or None if it is not fixed
+    (no automatic time window).
+    With ResolutionReductionScale, CoREAS coarsens the resolution by 1 + floor(r / scale) with the distance r of
+    the antenna from the core (see TimeResolutionPolicy.py), so the antennas (readList) are needed and an array
+    with the samples of each antenna is returned; without them it is None.
+    """
+    window = float(reas.get("AutomaticTimeBoundaries", 0))
+    if window == 0:
+        return None
+    resolution = float(reas["TimeResolution"])
+    scale = float(reas.get("ResolutionReductionScale", 0))
+    if scale == 0:
+        return int(round(window / resolution))
+    if antennas is None:
+        return None
+
+    from utils.TimeResolutionPolicy import reductionFactors
+    r = np.hypot(antennas["x"] - float(reas.get("CoreCoordinateNorth", 0)), antennas["y"] - float(reas.get("CoreCoordinateWest", 0)))
+    return np.round(window / (resolution * reductionFactors(r, scale))).astype(int)
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+"""
+Execution backends of the Submitter. A backend starts the .sub script of a run and returns a handle
+with the interface of subprocess.Popen that the Submitter uses:
+    poll()          None while running, the return code when done
+    communicate()   (stdout, stderr) once done
+    kill()
+
+    SlurmBackend    sbatch -p <partition> <script>, as before (the handle is the sbatch process, not the job)
+    LocalBackend    runs the script with bash on this machine, each one in a multiprocessing.Process
+                    (like MultiProcesses), with SLURM_NTASKS set for the mpirun of the script.
+                    The Submitter's parallel_sim bounds the number of scripts running at the same time.
+    FakeBackend     runs nothing: each handle finishes after a random latency and fails with a given rate,
+                    to load-test the driver with millions of jobs on one machine
+
+getBackend(name, ...) returns the backend for the --backend option of MakeCorsikaSim.py.
+"""
+
+import multiprocessing as mp
+import os
+import random
+import subprocess
+import time
+
+from utils.Logger import getLogger
+
+logger = getLogger(__name__)
+
+
+class SlurmBackend:
+    """
+    Parameters:
+        partition:  the slurm partition the jobs are submitted to
+    """
+
+    def __init__(self, partition="cpuonly"):
+        self.partition = partition
+
+    def submit(self, processString):
+        return subprocess.Popen(
+            f"sbatch -p {self.partition} {processString}".split(),
+            stderr=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+
+
+def runScript(script, ntasks):
+    """
+    Runs the script with bash in its folder, the output goes next to it (<script>.local.out/.err).
+    Used as target of the processes of the LocalBackend, the exit code of bash is the exit code of the process.
+    """
+    env = dict(os.environ, SLURM_NTASKS=str(ntasks), SLURM_JOB_ID="local")
+    with open(f"{script}.local.out", "w") as out, open(f"{script}.local.err", "w") as err:
+        returncode = subprocess.call(["bash", script], cwd=os.path.dirname(script) or ".", env=env, stdout=out, stderr=err)
+    os._exit(returncode)
+
+
+class LocalHandle:
+    """
+    Popen-like handle of a script running in a multiprocessing.Process
+    """
+
+    def __init__(self, script, ntasks):
+        self.script = script
+        self.process = mp.Process(target=runScript, args=[script, ntasks])
+        self.process.start()
+
+    def poll(self):
+        return None if self.process.is_alive() else self.process.exitcode
+
+    def communicate(self):
+        self.process.join()
+        out = f"ran {self.script} locally, exit code {self.process.exitcode}, output in {self.script}.local.out"
+        return out.encode(), b""
+
+    def kill(self):
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join()
+
+
+class LocalBackend:
+    """
+    Parameters:
+        ntasks:     number of MPI tasks of each run (SLURM_NTASKS of the script)
+    """
+
+    def __init__(self, ntasks=1):
+        self.ntasks = ntasks
+
+    def submit(self, processString):
+        return LocalHandle(processString, self.ntasks)
+
+
+class FakeHandle:
+    """
+    Popen-like handle that is done after its latency
+    """
+
+    def __init__(self, jobId, latency, fails):
+        self.jobId = jobId
+        self.done = time.monotonic() + latency
+        self.fails = fails
+
+    def poll(self):
+        if time.monotonic() < self.done:
+            return None
+        return 1 if self.fails else 0
+
+    def communicate(self):
+        if self.fails:
+            return b"", b"sbatch: error: fake submission failure"
+        return f"Submitted batch job {self.jobId}".encode(), b""
+
+    def kill(self):
+        return
+
+
+class FakeBackend:
+    """
+    Parameters:
+        latency:        (min, max) of the uniform latency of each job in seconds
+        failureRate:    fraction of the jobs that fail
+        seed:           seed of the random latencies and failures
+    """
+
+    def __init__(self, latency=(0., 0.), failureRate=0., seed=None):
+        self.latency = latency
+        self.failureRate = failureRate
+        self.random = random.Random(seed)
+        self.nSubmitted = 0
+
+    def submit(self, processString):
+        self.nSubmitted += 1
+        return FakeHandle(
+            jobId=self.nSubmitted,
+            latency=self.random.uniform(*self.latency),
+            fails=self.random.random() < self.failureRate,
+        )
+
+
+def getBackend(name, partition="cpuonly", localTasks=1, fakeLatency=(0., 0.), fakeFailureRate=0., seed=None):
+    """
+    Returns the backend called name (slurm, local or fake)
+    """
+    if name == "slurm":
+        return SlurmBackend(partition)
+    if name == "local":
+        return LocalBackend(localTasks)
+    if name == "fake":
+        return FakeBackend(fakeLatency, fakeFailureRate, seed)
+    raise ValueError(f"Unknown execution backend {name}, use slurm, local or fake")
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+
+"""
+This class builds the feature table of a campaign: the radio observables of every antenna of every verified run,
+so that the analysis does not have to read the raw traces again for every quantity.
+
+For every run (in parallel, with a multiprocessing Pool) it reads the .list and the traces
+SIM{runNumber}_coreas/raw_<name>.dat, from the run folder or, for archived runs, from their container
+(see RunArchiver.openMember). The traces of all antennas with the same length and sampling are stacked,
+optionally filtered to a frequency band with one FFT for all of them, and give per antenna
+    peak            maximum of |E| (statV/cm, the CoREAS units) and its time peak_time (s)
+    peak_x/y/z      maximum of |E| of each polarization component (x north, y west, z vertical, as in the .list)
+    fluence         energy fluence eps0 c sum(E^2) dt in eV/m^2, and fluence_x/y/z of each component
+together with the antenna position (x, y, z in cm) and the run (folder, runNumber, log10_E1, zenith_bin).
+
+The table is columnar and appended in parts of about rowsPerPart rows,
+    {dirFeatures}/features_{part:04d}.parquet   if pyarrow is installed
+    {dirFeatures}/features_{part:04d}.npz       otherwise
+and the runs in it get features = 1 in the campaign index, so that the next call only adds the new runs.
+loadFeatures(dirFeatures) returns the whole table.
+
+How to run:
+    python3 -m utils.FeatureExtractor --dirSimulations /path/to/sims/ --processes 16 --band 30e6 80e6
+"""
+
+import glob
+import multiprocessing as mp
+import os
+
+import numpy as np
+
+from utils.CampaignIndex import CampaignIndex
+from utils.CoreasReader import readList, readTrace
+from utils.Logger import getLogger
+
+logger = getLogger(__name__)
+
+# statV/cm to V/m
+STATVOLT_PER_CM = 2.99792458e4
+# eps0 * c in A/V, to convert sum(E^2) dt in (V/m)^2 s to J/m^2, and J to eV
+EPS0_C = 8.8541878128e-12 * 299792458.
+ELECTRONVOLT = 1.602176634e-19
+
+
+def _pyarrow():
+    # optional dependency, the table is written as .npz without it
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        return None
+    return pyarrow
+
+
+def traceFeatures(traces, dt, band=None):
+    """
+    Returns the features (dictionary of arrays, one value per antenna) of stacked traces
+    with shape (antennas, samples, 3), sampled every dt seconds. The peak is given as its sample (peak_sample).
+    If band = (fMin, fMax) in Hz is given, the traces are filtered to the band first.
+    """
+    if band is not None:
+        spectrum = np.fft.rfft(traces, axis=1)
+        frequencies = np.fft.rfftfreq(traces.shape[1], dt)
+        spectrum[:, (frequencies < band[0]) | (frequencies > band[1]), :] = 0.
+        traces = np.fft.irfft(spectrum, n=traces.shape[1], axis=1)
+
+    amplitude = np.linalg.norm(traces, axis=2)
+    peak = np.argmax(amplitude, axis=1)
+    fluence = np.sum(traces**2, axis=1) * dt * STATVOLT_PER_CM**2 * EPS0_C / ELECTRONVOLT
+    features = {
+        "peak": amplitude[np.arange(len(traces)), peak],
+        "peak_sample": peak,
+        "fluence": fluence.sum(axis=1),
+    }
+    peakComponents = np.abs(traces).max(axis=1)
+    for i, component in enumerate("xyz"):
+        features[f"peak_{component}"] = peakComponents[:, i]
+        features[f"fluence_{component}"] = fluence[:, i]
+    return features
+
+
+class FeatureExtractor:
+    """
+    Parameters:
+        index:          the CampaignIndex of the campaign
+        dirFeatures:    the directory of the parts of the feature table
+        processes:      number of parallel processes reading the traces
+        band:           (fMin, fMax) in Hz of the band filter, None uses the full traces
+        rowsPerPart:    number of rows (antennas) after which a part of the table is written
+    """
+
+    # the columns of the table, apart from folder, runNumber, log10_E1, zenith_bin and antenna
+    featureColumns = ["x", "y", "z", "peak", "peak_time", "peak_x", "peak_y", "peak_z",
+                      "fluence", "fluence_x", "fluence_y", "fluence_z"]
+
+    def __init__(self, index, dirFeatures, processes=8, band=None, rowsPerPart=5_000_000):
+        self.index = index
+        self.dirFeatures = dirFeatures
+        self.processes = processes
+        self.band = band
+        self.rowsPerPart = rowsPerPart
+        os.makedirs(dirFeatures, exist_ok=True)
+        self.suffix = ".parquet" if _pyarrow() is not None else ".npz"
+
+    @staticmethod
+    def extractRun(job):
+        """
+        Computes the features of all antennas of a run. Returns (folder, dictionary of arrays)
+        or (folder, None) if its output cannot be read.
+        """
+        folder, runNumber, archive, band = job
+        tar = None
+        try:
+            if os.path.isdir(folder):
+                openFile = lambda name: f"{folder}/{name}"
+            else:
+                # the run is only in its container, read its members in memory
+                from utils.RunArchiver import RunArchiver
+                tar = RunArchiver.openMember(*archive)
+                openFile = lambda name: tar.extractfile(f"{runNumber}/{name}")
+
+            antennas = readList(openFile(f"SIM{runNumber}.list"))
+            traces = [readTrace(openFile(f"SIM{runNumber}_coreas/raw_{name}.dat")) for name in antennas["name"]]
+        except (OSError, KeyError, TypeError, ValueError) as error:
+            logger.debug("Cannot read the traces of %s: %s", folder, error)
+            return folder, None
+        finally:
+            if tar is not None:
+                tar.close()
+
+        n = len(traces)
+        features = {column: np.full(n, np.nan) for column in FeatureExtractor.featureColumns}
+        features["x"], features["y"], features["z"] = antennas["x"], antennas["y"], antennas["z"]
+        # the antennas with the same sampling are processed together
+        # (with ResolutionReductionScale the far antennas have fewer samples)
+        groups = {}
+        for i, trace in enumerate(traces):
+            if len(trace) < 2:
+                continue
+            groups.setdefault((len(trace), round(trace[1, 0] - trace[0, 0], 15)), []).append(i)
+        for (nSamples, dt), members in groups.items():
+            stacked = np.stack([traces[i][:, 1:] for i in members])
+            groupFeatures = traceFeatures(stacked, dt, band)
+            groupFeatures["peak_time"] = np.array([traces[i][0, 0] for i in members]) + groupFeatures.pop("peak_sample") * dt
+            for column, values in groupFeatures.items():
+                features[column][members] = values
+
+        features["antenna"] = antennas["name"]
+        return folder, features
+
+    def writePart(self, parts):
+        """
+        Concatenates the tables of the runs and writes them as the next part of the feature table
+        """
+        columns = ["folder", "runNumber", "log10_E1", "zenith_bin", "antenna"] + self.featureColumns
+        table = {column: np.concatenate([part[column] for part in parts]) for column in columns}
+        number = len(glob.glob(os.path.join(self.dirFeatures, "features_*")))
+        fileName = os.path.join(self.dirFeatures, f"features_{number:04d}{self.suffix}")
+        pyarrow = _pyarrow()
+        if pyarrow is not None:
+            pyarrow.parquet.write_table(pyarrow.table(table), fileName + ".tmp")
+        else:
+            with open(fileName + ".tmp", "wb") as f:
+                np.savez(f, **table)
+        # the part only appears complete
+        os.replace(fileName + ".tmp", fileName)
+        logger.info(f"Wrote {len(table['folder'])} rows to {fileName}")
+
+    def extract(self, recheck=False):
+        """
+        Extracts the features of all verified runs that are not in the table yet (all of them with recheck).
+        Returns the number of runs added.
+        """
+        runs = self.index.getRuns(columns=("folder", "runNumber", "log10_E1", "zenith_bin", "verified", "features",
+                                           "archive", "archive_offset", "archive_size"))
+        runs = {run[0]: run for run in runs if run[4] == 1 and (recheck or not run[5])}
+        jobs = [(folder, run[1], run[6:9], self.band) for folder, run in runs.items()]
+        logger.info(f"Extracting the features of {len(jobs)} runs with {self.processes} processes")
+
+        parts, nRows, done, nRuns = [], 0, [], 0
+        with mp.Pool(self.processes) as pool:
+            for folder, features in pool.imap_unordered(self.extractRun, jobs, chunksize=4):
+                if features is None:
+                    continue
+                _, runNumber, log10_E1, zenith_bin = runs[folder][:4]
+                n = len(features["antenna"])
+                features["folder"] = np.full(n, folder)
+                features["runNumber"] = np.full(n, runNumber)
+                features["log10_E1"] = np.full(n, log10_E1, dtype=float)
+                features["zenith_bin"] = np.full(n, zenith_bin, dtype=float)
+                parts.append(features)
+                done.append(folder)
+                nRows += n
+                if nRows >= self.rowsPerPart:
+                    nRuns += self.commit(parts, done)
+                    parts, nRows, done = [], 0, []
+        if parts:
+            nRuns += self.commit(parts, done)
+        return nRuns
+
+    def commit(self, parts, folders):
+        """
+        Writes a part and marks its runs in the index
+        """
+        self.writePart(parts)
+        for folder in folders:
+            self.index.addRun(folder=folder, features=1)
+        self.index.flush()
+        return len(folders)
+
+
+def loadFeatures(dirFeatures, columns=None):
+    """
+    Returns the feature table of all parts in dirFeatures as a dictionary of numpy arrays (optionally only some columns)
+    """
+    parts = []
+    for fileName in sorted(glob.glob(os.path.join(dirFeatures, "features_*"))):
+        if fileName.endswith(".parquet"):
+            table = _pyarrow().parquet.read_table(fileName, columns=columns)
+            parts.append({name: table.column(name).to_numpy() for name in table.column_names})
+        elif fileName.endswith(".npz"):
+            with np.load(fileName) as table:
+                parts.append({name: table[name] for name in (columns or table.files)})
+    if not parts:
+        return {}
+    return {column: np.concatenate([part[column] for part in parts]) for column in parts[0]}
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Builds the per-antenna feature table of the verified runs of a campaign"
+    )
+    parser.add_argument(
+        "--dirSimulations",
+        type=str,
+        required=True,
+        help="Directory where the simulation are stored (with the campaign_index.sqlite)",
+    )
+    parser.add_argument(
+        "--dirFeatures",
+        type=str,
+        default=None,
+        help="directory of the feature table, default is features/ in dirSimulations",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=8,
+        help="number of parallel processes reading the traces",
+    )
+    parser.add_argument(
+        "--band",
+        type=float,
+        nargs=2,
+        default=None,
+        help="filter the traces to this frequency band in Hz before computing the features, e.g. 30e6 80e6",
+    )
+    parser.add_argument(
+        "--recheck",
+        action="store_true",
+        help="extract again the runs that are already in the table (they are added again)",
+    )
+    args = parser.parse_args()
+
+    index = CampaignIndex(os.path.join(args.dirSimulations, "campaign_index.sqlite"))
+    extractor = FeatureExtractor(
+        index,
+        args.dirFeatures or os.path.join(args.dirSimulations, "features"),
+        processes=args.processes,
+        band=args.band,
+    )
+    logger.info(f"Features of {extractor.extract(args.recheck)} runs added")
+    index.close()
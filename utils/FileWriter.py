@@ -9,8 +9,13 @@ import pathlib
 import numpy as np
 from utils.RadioFilesGenerator import RadioFilesGenerator
 from utils.SubFilesGenerator import SubFilesGenerator
+from utils.JobWatchdog import JobWatchdog
 from utils.runNumberGenerator import runNumberGenerator
 import os
+from utils.Logger import getLogger
+from utils.StageTimer import timer
+
+logger = getLogger(__name__)
 
 class FileWriter:
     """
@@ -24,6 +29,8 @@ class FileWriter:
         username,                       # User name on server
         dirSimulations,                 # Simulations directory where the data temp and log folder will be created
         dirRun,                         # run directory where the corsika executable and atmosphere file are stored
+        corsikaExe,                     # the name of the corsika executable in dirRun
+        config,                         # the CampaignConfig with the physics, radio and slurm settings (see CampaignConfig.py)
         primary,                        # 1 is gamma, 14 is proton, 402 is He, 1608 is Oxygen, 5626 is Fe
         primIdDict,                     # This is a dictionary, with keys the Corsika numbering of primary, 
                                         # and values the arbitrary numbering used in this script for all primary particle. 
@@ -32,10 +39,19 @@ class FileWriter:
         pathAntennas,                   # Path to antennas
         zenithStart,
         zenithEnd,
+        footprintFactor = 0,            # Antennas outside of footprintFactor times the Cherenkov radius are dropped, 0 keeps all
+        thinningPolicy = None,          # ThinningPolicy choosing THIN and ECTMAX per bin, if None the values of the config are used
+        seedOffset = 0,                 # added to all seeds, so that the sites of a multi-site campaign have different seeds
+        staging = None,                 # NodeStaging: DATDIR and ATMFILE point to the node-local copy of dirRun, if given
+        timeResolutionPolicy = None,    # TimeResolutionPolicy choosing the time settings of the .reas per run, fixed settings if None
+        rankScaling = None,             # RankScaling choosing the MPI ranks of each shower, the [slurm] nodes and tasks if None
+        measuredCoreHours = None,       # {(log10_E1, zenith_bin): mean core-hours of the measured runs of the bin}, for the watchdog
     ):
         self.username = username
         self.primary = primary
         self.dirRun = dirRun
+        self.corsikaExe = corsikaExe
+        self.config = config
         self.directory = dirSimulations
         self.primIdDict= primIdDict
         
@@ -43,24 +59,46 @@ class FileWriter:
         self.zenithEnd = zenithEnd
         self.obslev = obslev
         self.pathAntennas = pathAntennas
-
-
-
-    def writeFile(self, runNumber, log10_E1, azimuth, zenith, folder_path):
+        self.footprintFactor = footprintFactor
+        self.thinningPolicy = thinningPolicy
+        self.seedOffset = seedOffset
+        self.staging = staging
+        self.timeResolutionPolicy = timeResolutionPolicy
+        self.rankScaling = rankScaling
+        self.measuredCoreHours = measuredCoreHours or {}
+
+
+    @timer.timed("FileWriter")
+    def writeFile(self, runNumber, log10_E1, azimuth, zenith, folder_path, log10_E=None, ectmax=None, ranks=None,
+                  zenith_bin=None):
         """
         Creates and writes a Corsika inp file that can be used as Corsika input
+        and the radio and sub files of the run.
+        log10_E1 is the energy bin (for the per-bin settings), log10_E the energy of the shower,
+        which is the lower edge of the bin if not given (fixed grid).
+        zenith_bin is the lower edge of the zenith bin of the run, for the choices made per bin
+        (the parent folder of the run if not given).
+        ectmax and ranks replace the chosen ECTMAX and MPI ranks (the calibration showers of RankScaling).
+
+        Returns a dictionary with the settings chosen for this run
+        (thin, ectmax, ranks, predicted_core_hours, n_antennas), which are stored in the campaign index.
         """
-        en1 = 10**log10_E1  # Lower limit of energy in GeV
+        if log10_E is None:
+            log10_E = log10_E1
+        if zenith_bin is None:
+            zenith_bin = float(os.path.basename(os.path.dirname(os.path.normpath(folder_path))))
+        en1 = 10**log10_E  # Energy of the shower in GeV
         
         # The seed value in Corsika is 1 <= seed <= 900_000_000; 
         # It was decided to adopt the following seed has the form: 
         # pprrrrrr where pp is the primary ID (0, 1, 2...) and rrrrrr is the 6-digit run number
         # The seedValue is % 900.000.000 so that it does not exceed the max allowed seed value in Corsika
         # Note underscore do not change anything in the python numbers, they just make them easier to read
+        # The seedOffset (multiples of 10_000_000 for the sites) is added before the modulo
         runNumbGen = runNumberGenerator()
-        seedValue1 = int((int(runNumber) + self.primIdDict[self.primary]*1_000_000) % 900_000_001)
-        seedValue2 = int((int(runNumber) + runNumbGen.getAzimuthID(azimuth)*1_000_000) % 900_000_001)
-        seedValue3 = int((int(runNumber) + runNumbGen.getZenithID(zenith)*1_000_000) % 900_000_001)
+        seedValue1 = int((int(runNumber) + self.primIdDict[self.primary]*1_000_000 + self.seedOffset) % 900_000_001)
+        seedValue2 = int((int(runNumber) + runNumbGen.getAzimuthID(azimuth)*1_000_000 + self.seedOffset) % 900_000_001)
+        seedValue3 = int((int(runNumber) + runNumbGen.getZenithID(zenith)*1_000_000 + self.seedOffset) % 900_000_001)
 
         # create the SIMxxxxxx ID
         sim = f"SIM{runNumber}"
@@ -74,11 +112,33 @@ class FileWriter:
         seed5 = seed2 + 4
         seed6 = seed3 + 5
 
-        thin1 = 1.000E-06
-        par = 1E-3
+        # the settings for this energy/zenith bin, with the overrides of the config file applied
+        binConfig = self.config.forBin(log10_E1, zenith)
+        physics = binConfig["physics"]
+        thin1 = physics["thin"]
+        par = physics["parallelEctmax"]
+        predictedCoreHours = None
+        policyComment = ""
+        if self.thinningPolicy is not None:
+            # cost-bounded choice of the thinning and ECTMAX for this energy and zenith bin
+            thin1, par, predictedCoreHours = self.thinningPolicy.choose(log10_E1, zenith_bin)
+            policyComment = (f"* thinning policy: THIN {thin1:.1E} ECTMAX {par:.1E}*E "
+                             f"predicted {predictedCoreHours:.1f} core-hours\n")
+        if ectmax is not None:
+            par = ectmax
+        if ranks is None and self.rankScaling is not None:
+            # the most cost-efficient number of ranks for the energy and zenith bin of this shower and ECTMAX
+            ranks = self.rankScaling.choose(log10_E, zenith_bin, par)
+        ecuts = " ".join(f"{ecut:.1E}" for ecut in physics["ecuts"])
+        # the atmosphere file is looked for in the corsika run directory, unless an absolute path is given
+        atmfile = os.path.join(self.dirRun, physics["atmfile"])
+        datdir = self.dirRun
+        if self.staging is not None:
+            # read from the node-local copy of the run directory, made by the .sub file
+            atmfile = self.staging.stagedPath(atmfile)
+            datdir = self.staging.stageDir
         
-        print("Filewriter using azimuth", azimuth)
-        print("Filewriter using zenith", zenith)
+        logger.debug("Filewriter using azimuth %s and zenith %s", azimuth, zenith)
 
         # Opening and writing in the file 
         with open(inp_name, "w") as file:
@@ -97,25 +157,26 @@ class FileWriter:
                 + f"ERANGE  {en1:.11E}    {en1:.11E}\n"  # in GeV
                 + f"THETAP  {zenith}    {zenith}\n"  
                 + f"PHIP    {azimuth} {azimuth}\n"  
-                + f"ECUTS   3.0E-01 1.0E-02 2.5E-04 2.5E-04\n"
-                + f"PARALLEL 1E3 {par * en1:.11E} 1 F\n" # ECTMAX like Felix did
+                + f"ECUTS   {ecuts}\n"
+                + f"PARALLEL {physics['parallelEctcut']:.0E} {par * en1:.11E} 1 F\n" # ECTMAX like Felix did
                 + f"ELMFLG  T    T\n"   # Disable NKG since it gets deactivated anyway when CURVED is selected at corsika setup
-                + f"THIN    {thin1} {thin1 * en1:.11E} 5.0E+03\n" # ERANGE * THIN1 = THIN2 # {thin1} {thin1 * en1:.11E} 5.000000e+03\n
-                + f"THINH   1.000E+00 1.000E+02\n"
+                + f"THIN    {thin1:.3E} {thin1 * en1:.11E} {physics['thinRadius']:.1E}\n" # ERANGE * THIN1 = THIN2 # {thin1} {thin1 * en1:.11E} 5.000000e+03\n
+                + f"THINH   {physics['thinh'][0]:.3E} {physics['thinh'][1]:.3E}\n"
                 + f"STEPFC  1.0\n"
                 + f"OBSLEV  {self.obslev}\n"  # 1549700 for Dunhuang?  # 1142.0E2 elevation Dunhuang (hopefully close enough to Xiaodushan, which I can't find)
                 + f"ECTMAP  1.E+15\n"
                 + f"MUMULT  T\n"
                 + f"MUADDI  T\n"
                 + f"MAXPRT  1\n"
-                + f"MAGNET  26.860    49.687\n"  # from geomag for Xiaodushan, 400km altitude
+                + f"MAGNET  {physics['magnet'][0]}    {physics['magnet'][1]}\n"  # from geomag for Xiaodushan, 400km altitude
                 + f"PAROUT  T  F\n"# erster job: t f, danach f f 
                 + f"LONGI   T   5.     T       T\n"
                 + f"RADNKG  5.E+05\n"           
-                + f"ATMFILE {self.dirRun}/ATMOSPHERE_20170401120000_Dunhuang.DAT\n"
+                + f"ATMFILE {atmfile}\n"
                 + f"DIRECT  {folder_path}/\n"
-                + f"DATDIR  {self.dirRun}\n"
+                + f"DATDIR  {datdir}\n"
                 + f"USER    {self.username}\n"
+                + policyComment
                 + f"EXIT\n")
         
 
@@ -124,16 +185,38 @@ class FileWriter:
             obslev = self.obslev,
             directory = self.directory,
             runNumber = runNumber,
-            log10_E1 = log10_E1,
+            log10_E1 = log10_E,             # the footprint depends on the energy of the shower
             pathAntennas = self.pathAntennas,
             zenith = zenith,
             azimuth = azimuth,
             primary = self.primary,
-            folder_path = folder_path
+            folder_path = folder_path,
+            footprintFactor = self.footprintFactor,
+            radio = binConfig["radio"],
+            site = binConfig["site"],
+            timeResolutionPolicy = self.timeResolutionPolicy,
+            timePolicySettings = binConfig["timeResolutionPolicy"],
         )
 
         RadGen.writeReasList()
-
+        if self.timeResolutionPolicy is not None:
+            self.timeResolutionPolicy.record(log10_E1, zenith_bin, RadGen.timeSettings)
+
+
+        # the expected wall time of the run for the watchdog: the core-hours predicted by the thinning policy,
+        # else measured in the bin (RuntimeAggregator), else [watchdog] defaultWallHours if given,
+        # else of the cost model of CampaignPlanner, shared by the cores of the job
+        slurm = binConfig["slurm"]
+        expectedCoreHours = predictedCoreHours
+        if expectedCoreHours is None:
+            expectedCoreHours = self.measuredCoreHours.get((float(log10_E1), float(zenith_bin)))
+        if expectedCoreHours is None and not binConfig["watchdog"]["defaultWallHours"]:
+            from utils.CampaignPlanner import referenceCoreHours
+            expectedCoreHours = float(referenceCoreHours(log10_E, zenith, RadGen.antennaStats["kept"]))
+        expectedWallHours = None
+        if expectedCoreHours is not None:
+            nRanks = ranks if ranks is not None else slurm["nodes"] * slurm["ntasksPerNode"]
+            expectedWallHours = expectedCoreHours / (nRanks * slurm["cpusPerTask"])
 
         # create the .sub and .sh file for each shower
         SubGen = SubFilesGenerator(
@@ -143,8 +226,21 @@ class FileWriter:
             primary = self.primary,
             directory = self.directory,
             folder_path = folder_path,
-            pathCorsika = "/home/hk-project-radiohfi/bg5912/work/soft/corsika-77550/run/",
-            corsikaExe = "/mpi_corsika77550Linux_SIBYLL_urqmd_thin_coreas_parallel_runner",
+            pathCorsika = self.dirRun,
+            corsikaExe = self.corsikaExe,
+            slurm = slurm,
+            staging = self.staging,
+            watchdog = JobWatchdog.fromConfig(binConfig["watchdog"]),
+            expectedWallHours = expectedWallHours,
+            ranks = ranks,
         )
 
-        SubGen.writeSubFiles()
\ No newline at end of file
+        SubGen.writeSubFiles()
+
+        return {
+            "thin": thin1,
+            "ectmax": par,
+            "ranks": ranks,
+            "predicted_core_hours": predictedCoreHours,
+            "n_antennas": RadGen.antennaStats["kept"],
+        }
\ No newline at end of file
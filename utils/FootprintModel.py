@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+"""
+This class estimates the radio footprint of a shower on the ground,
+so that antennas which are far away from it can be dropped before writing the .list file.
+CoREAS runtime scales with the number of antennas, so this directly shrinks the cost per shower.
+
+The model is deliberately simple and conservative:
+    - Xmax from an elongation rate parametrisation (log10 GeV, as used everywhere in this repo)
+    - distance to Xmax from an exponential atmosphere (flat earth, cos(zenith) is clipped for very inclined showers)
+    - Cherenkov angle at Xmax from the refractive index scaled with the air density
+    - the signal is expected up to radiusFactor times the Cherenkov radius in the shower plane,
+      growing logarithmically with energy (the amplitude scales with the energy, the lateral fall off is ~exponential)
+    - projected on the ground this gives an ellipse elongated by 1/cos(zenith) along the shower azimuth
+
+Coordinates are the CoREAS ones used in the .list files: x to magnetic north, y to west, in cm,
+with the core in (0, 0) as written in the .reas file.
+The zenith, azimuth and energy can also be arrays (one footprint per shower) for getEllipse,
+e.g. for the estimates of CampaignPlanner.py; getMask is for a single shower.
+"""
+
+import numpy as np
+
+
+class FootprintModel:
+    """
+    Parameters:
+        zenith:             zenith angle in degrees (corsika THETAP)
+        azimuth:            azimuth angle in degrees (corsika PHIP)
+        log10_E1:           energy in log10 GeV
+        obslev:             observation level in cm
+        radiusFactor:       signal radius in units of the Cherenkov radius (the signal-threshold ellipse)
+        energySlope:        additional units of Cherenkov radius per decade of energy above log10_Eref
+        log10_Eref:         reference energy in log10 GeV
+        minAntennas:        the closest antennas that are always kept, even if outside of the ellipse
+    """
+
+    # exponential atmosphere
+    X0 = 1036.          # g/cm^2 vertical depth at sea level
+    scaleHeight = 8.4e5 # cm
+    # refractive index at sea level
+    n0 = 1.000312
+    # maximum zenith used for the flat earth approximation
+    maxZenith = 85.
+
+    def __init__(self,
+        zenith,
+        azimuth,
+        log10_E1,
+        obslev,
+        radiusFactor=3.,
+        energySlope=0.5,
+        log10_Eref=8.,
+        minAntennas=1,
+    ):
+        self.zenith = zenith
+        self.azimuth = azimuth
+        self.log10_E1 = log10_E1
+        self.obslev = obslev
+        self.radiusFactor = radiusFactor
+        self.energySlope = energySlope
+        self.log10_Eref = log10_Eref
+        self.minAntennas = minAntennas
+
+    def getXmax(self):
+        """
+        Mean Xmax in g/cm^2 for protons, elongation rate of 60 g/cm^2 per decade around 1e18 eV
+        """
+        return 750. + 60. * (self.log10_E1 + 9. - 18.)
+
+    def getDistanceToXmax(self):
+        """
+        Returns the distance along the shower axis from the core to Xmax in cm
+        and the height of Xmax in cm
+        """
+        cosZen = np.cos(np.deg2rad(np.minimum(self.zenith, self.maxZenith)))
+        # the vertical depth of Xmax cannot be deeper than the observation level
+        verticalDepth = np.minimum(self.getXmax() * cosZen, self.X0 * np.exp(-self.obslev / self.scaleHeight))
+        heightXmax = -self.scaleHeight * np.log(verticalDepth / self.X0)
+        return (heightXmax - self.obslev) / cosZen, heightXmax
+
+    def getCherenkovRadius(self):
+        """
+        Radius of the Cherenkov ring in the shower plane in cm
+        """
+        distance, heightXmax = self.getDistanceToXmax()
+        n = 1. + (self.n0 - 1.) * np.exp(-heightXmax / self.scaleHeight)
+        return distance * np.tan(np.arccos(1. / n))
+
+    def getEllipse(self):
+        """
+        Returns the semi-major and semi-minor axis of the footprint on the ground in cm
+        """
+        energyTerm = self.energySlope * np.maximum(0., self.log10_E1 - self.log10_Eref)
+        semiMinor = self.getCherenkovRadius() * (self.radiusFactor + energyTerm)
+        semiMajor = semiMinor / np.cos(np.deg2rad(np.minimum(self.zenith, self.maxZenith)))
+        return semiMajor, semiMinor
+
+    def getMask(self, x, y):
+        """
+        Returns a boolean mask of the antennas (x, y in cm) which are inside of the footprint ellipse.
+        """
+        semiMajor, semiMinor = self.getEllipse()
+        phi = np.deg2rad(self.azimuth)
+        # rotate in the frame of the shower axis projected on the ground
+        u = x * np.cos(phi) + y * np.sin(phi)
+        v = - x * np.sin(phi) + y * np.cos(phi)
+        ellipseDistance = (u / semiMajor)**2 + (v / semiMinor)**2
+
+        mask = ellipseDistance <= 1.
+        if mask.sum() < self.minAntennas:
+            mask[np.argsort(ellipseDistance)[:self.minAntennas]] = True
+        return mask
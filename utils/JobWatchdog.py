@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+"""
+This class writes the progress watchdog of the job scripts (see SubFilesGenerator.py).
+
+A stuck MPI-CORSIKA run holds its nodes until slurm kills it at the time limit of the job.
+With the watchdog, the .sub script starts mpirun in the background and checks every checkSeconds
+the size of DAT{runNumber}.log and of the corsika_timetable-* files of the run (one line is added for
+every finished sub-shower of the MPI runner). The run is terminated (TERM, then KILL after graceSeconds) if
+    stalled     none of them has grown for stallMinutes
+    runaway     it runs longer than runtimeFactor times the expected wall time of the shower
+The expected wall time is the expected core-hours of the shower divided by the cores of the job (see FileWriter.py):
+predicted by the thinning policy, else the mean of the runs of its bin measured by RuntimeAggregator, else
+defaultWallHours if it is given, else the cost model of CampaignPlanner.
+
+A terminated run gets a WATCHDOG file in its folder with the reason, the job script exits with 1
+and the OutputVerifier marks the run as failed with that reason. Otherwise the job script exits with the
+exit code of mpirun, so a crashed run is a failed job as it is without the watchdog.
+"""
+
+WATCHDOG_FILE = "WATCHDOG"
+
+
+class JobWatchdog:
+    """
+    Parameters:
+        stallMinutes:       the run is terminated if its log and timetables did not grow for this long
+        runtimeFactor:      the run is terminated after runtimeFactor times its expected wall time
+        checkSeconds:       interval of the checks
+        graceSeconds:       time between TERM and KILL
+        defaultWallHours:   expected wall time of the runs without a prediction or measured runs of their bin,
+                            0: the cost model of CampaignPlanner is used (by FileWriter)
+    """
+
+    def __init__(self, stallMinutes=60., runtimeFactor=3., checkSeconds=60, graceSeconds=30, defaultWallHours=0.):
+        self.stallMinutes = stallMinutes
+        self.runtimeFactor = runtimeFactor
+        self.checkSeconds = checkSeconds
+        self.graceSeconds = graceSeconds
+        self.defaultWallHours = defaultWallHours
+
+    @classmethod
+    def fromConfig(cls, watchdog):
+        """
+        Returns the watchdog of the [watchdog] section of the CampaignConfig, or None if it is disabled
+        """
+        if not watchdog["enabled"]:
+            return None
+        return cls(
+            stallMinutes=watchdog["stallMinutes"],
+            runtimeFactor=watchdog["runtimeFactor"],
+            checkSeconds=watchdog["checkSeconds"],
+            graceSeconds=watchdog["graceSeconds"],
+            defaultWallHours=watchdog["defaultWallHours"],
+        )
+
+    def maxSeconds(self, expectedWallHours=None):
+        """
+        Returns the maximal runtime in seconds, 0 if there is no limit
+        """
+        if not expectedWallHours:
+            expectedWallHours = self.defaultWallHours
+        return int(round(self.runtimeFactor * expectedWallHours * 3600.))
+
+    def scriptLines(self, folder_path, expectedWallHours=None):
+        """
+        Returns the bash lines that follow the mpirun started in the background (with &):
+        they run the watchdog next to it and wait for the run.
+        LOG_FILE must be set, CORSIKA_STATUS is the exit code of the run afterwards.
+        """
+        watchdogFile = f"{folder_path}/{WATCHDOG_FILE}"
+        maxSeconds = self.maxSeconds(expectedWallHours)
+        stallSeconds = int(round(self.stallMinutes * 60.))
+        return (
+            f"CORSIKA_PID=$!\n"
+            + f"rm -f {watchdogFile}\n"
+            + f"# Progress watchdog (see utils/JobWatchdog.py): terminates the run if the log and timetables stop growing\n"
+            + f"# for {stallSeconds} s, or if it runs longer than {maxSeconds} s (0: no limit)\n"
+            + f"watchdog_progress() {{\n"
+            + f"    stat -c %s $LOG_FILE {folder_path}/corsika_timetable-* 2>/dev/null | awk '{{size += $1; n++}} END {{print size + 0, n + 0}}'\n"
+            + f"}}\n"
+            + f"watchdog() {{\n"
+            + f"    local start=$SECONDS lastChange=$SECONDS last='' progress='' reason=''\n"
+            + f"    while kill -0 $CORSIKA_PID 2>/dev/null; do\n"
+            + f"        sleep {self.checkSeconds}\n"
+            + f"        progress=$(watchdog_progress)\n"
+            + f"        if [ \"$progress\" != \"$last\" ]; then last=$progress; lastChange=$SECONDS; fi\n"
+            + f"        if [ $((SECONDS - lastChange)) -ge {stallSeconds} ]; then\n"
+            + f"            reason=\"stalled: no progress for $((SECONDS - lastChange)) s\"\n"
+            + f"        elif [ {maxSeconds} -gt 0 ] && [ $((SECONDS - start)) -ge {maxSeconds} ]; then\n"
+            + f"            reason=\"runaway: running for $((SECONDS - start)) s, more than {self.runtimeFactor:g} x the expected runtime\"\n"
+            + f"        fi\n"
+            + f"        if [ -n \"$reason\" ]; then\n"
+            + f"            echo \"$reason\" > {watchdogFile}\n"
+            + f"            echo watchdog: $reason, terminating the run\n"
+            + f"            pkill -TERM -P $CORSIKA_PID; kill -TERM $CORSIKA_PID\n"
+            + f"            sleep {self.graceSeconds}\n"
+            + f"            pkill -KILL -P $CORSIKA_PID; kill -KILL $CORSIKA_PID 2>/dev/null\n"
+            + f"            return\n"
+            + f"        fi\n"
+            + f"    done\n"
+            + f"}}\n"
+            + f"watchdog &\n"
+            + f"WATCHDOG_PID=$!\n"
+            + f"wait $CORSIKA_PID\n"
+            + f"CORSIKA_STATUS=$?\n"
+            + f"# the sleep of the watchdog first, it would be left running without its parent\n"
+            + f"pkill -P $WATCHDOG_PID 2>/dev/null; kill $WATCHDOG_PID 2>/dev/null; wait $WATCHDOG_PID 2>/dev/null\n"
+        )
+
+    @staticmethod
+    def exitLines(folder_path):
+        """
+        Returns the last lines of the job script: it fails if the watchdog terminated the run,
+        or with the exit code of mpirun (CORSIKA_STATUS) if it failed
+        """
+        return (
+            f"if [ -f {folder_path}/{WATCHDOG_FILE} ]; then echo run terminated by the watchdog: $(cat {folder_path}/{WATCHDOG_FILE}); exit 1; fi\n"
+            + f"if [ $CORSIKA_STATUS -ne 0 ]; then echo mpirun failed with exit code $CORSIKA_STATUS; exit $CORSIKA_STATUS; fi\n"
+        )
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+
+"""
+Logging for the driver (MakeCorsikaSim.py) and the classes in utils.
+
+The generation loop runs once per shower, so anything it writes is multiplied by the number of runs.
+Therefore:
+    - the per-run messages are DEBUG and not shown by default
+    - the records are handed to a queue and written by a background thread (QueueListener),
+      through a MemoryHandler that writes the DEBUG records in blocks instead of line by line
+      (INFO and above, and any record after flushInterval seconds, are written immediately)
+    - ProgressTracker writes one INFO line per energy/zenith bin with the rate and the ETA
+
+Usage:
+    from utils.Logger import getLogger
+    logger = getLogger(__name__)
+    logger.debug("only with --logLevel DEBUG")
+
+setupLogging is called once by the driver; without it the messages go to the standard python logging.
+"""
+
+import atexit
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+
+import numpy as np
+
+ROOT_NAME = "CoreasSpellcaster"
+
+_listener = None
+_buffered = None
+
+
+def getLogger(name):
+    """
+    Returns the logger of a module, below the common root logger of the repo.
+    """
+    return logging.getLogger(f"{ROOT_NAME}.{name}")
+
+
+class TimedMemoryHandler(logging.handlers.MemoryHandler):
+    """
+    A MemoryHandler which also writes its buffer when the last write is more than flushInterval seconds ago,
+    so that the buffered records are not held back for long while the driver runs.
+    """
+
+    def __init__(self, capacity, flushLevel=logging.INFO, target=None, flushInterval=2.):
+        super().__init__(capacity, flushLevel=flushLevel, target=target)
+        self.flushInterval = flushInterval
+        self.lastFlush = time.monotonic()
+
+    def shouldFlush(self, record):
+        return super().shouldFlush(record) or time.monotonic() - self.lastFlush >= self.flushInterval
+
+    def flush(self):
+        super().flush()
+        self.lastFlush = time.monotonic()
+
+
+def setupLogging(level="INFO", logFile=None, bufferCapacity=1000, flushInterval=2.):
+    """
+    Sets the level and the asynchronous, buffered handlers of the root logger of the repo.
+
+    Parameters:
+        level:          name of the logging level (DEBUG, INFO, WARNING, ...)
+        logFile:        write to this file instead of stdout
+        bufferCapacity: number of DEBUG records written in one block. INFO and above are written immediately.
+        flushInterval:  seconds after which the buffered records are written with the next record
+    """
+    global _listener, _buffered
+    if _listener is not None:
+        _listener.stop()
+        _buffered.flush()
+    else:
+        # registered once, it stops the listener of the last call
+        atexit.register(_stop)
+
+    stream = logging.FileHandler(logFile) if logFile else logging.StreamHandler(sys.stdout)
+    stream.setFormatter(logging.Formatter("%(asctime)s %(levelname)-7s %(name)s: %(message)s", "%Y-%m-%d %H:%M:%S"))
+    _buffered = TimedMemoryHandler(bufferCapacity, flushLevel=logging.INFO, target=stream, flushInterval=flushInterval)
+
+    logQueue = queue.SimpleQueue()
+    _listener = logging.handlers.QueueListener(logQueue, _buffered)
+    _listener.start()
+
+    root = logging.getLogger(ROOT_NAME)
+    root.handlers = [logging.handlers.QueueHandler(logQueue)]
+    root.setLevel(level.upper())
+    root.propagate = False
+    return root
+
+
+def _stop():
+    _listener.stop()
+    _buffered.flush()
+
+
+class ProgressTracker:
+    """
+    Counts the runs done per energy/zenith bin and logs one summary line per bin
+    with the rate (runs/s) and the ETA of the whole plan.
+
+    Parameters:
+        plan:   the plan of SimulationMaker.buildPlan, used for the total number of runs per bin
+        logger: the logger used for the summaries
+    """
+
+    def __init__(self, plan, logger):
+        self.logger = logger
+        self.total = len(plan["runIndex"])
+        bins, counts = np.unique(np.stack([plan["log10_E1"], plan["zenith_bin"]], axis=1), axis=0, return_counts=True)
+        self.binTotals = {(float(log10_E1), float(zenith_bin)): int(count) for (log10_E1, zenith_bin), count in zip(bins, counts)}
+        self.done = 0
+        self.start = time.monotonic()
+        self.currentBin = None
+        self.binDone = 0
+        self.binStart = self.start
+
+    def update(self, log10_E1, zenith_bin, n=1):
+        """
+        Counts n runs (written or skipped) of the given bin.
+        """
+        key = (float(log10_E1), float(zenith_bin))
+        if key != self.currentBin:
+            self.finishBin()
+            self.currentBin = key
+            self.binDone = 0
+            self.binStart = time.monotonic()
+        self.binDone += n
+        self.done += n
+        if self.binDone >= self.binTotals.get(key, 0):
+            self.finishBin()
+
+    def finishBin(self):
+        """
+        Logs the summary of the current bin.
+        """
+        if self.currentBin is None or self.binDone == 0:
+            return
+        now = time.monotonic()
+        binRate = self.binDone / max(now - self.binStart, 1e-9)
+        rate = self.done / max(now - self.start, 1e-9)
+        eta = (self.total - self.done) / max(rate, 1e-9)
+        self.logger.info(
+            f"bin log10_E={self.currentBin[0]} zenith={self.currentBin[1]}: {self.binDone} runs, {binRate:.1f} runs/s; "
+            f"total {self.done}/{self.total} ({rate:.1f} runs/s), ETA {int(eta // 3600)}:{int(eta % 3600 // 60):02d}:{int(eta % 60):02d}"
+        )
+        self.currentBin = None
+        self.binDone = 0
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+"""
+This class describes the node-local copy of the corsika run directory (DATDIR: executable, interaction tables,
+atmosphere files), so that the MPI ranks of a job do not all read them from the shared filesystem.
+
+The copy lives in {localDir}/corsika-{hash}/, where hash is computed from the name, size and modification time
+of the regular files of the run directory (the files that are staged), without reading their content.
+The job script (see SubFilesGenerator.py) copies them there once per node:
+the first job on a node copies, under an flock, into a temporary folder which is renamed when complete;
+the following jobs on the same node find the complete folder and skip the copy.
+A changed run directory (e.g. a new executable) gets a new hash, so an outdated copy is never used.
+
+The .inp files point DATDIR and ATMFILE (if it is in the run directory) to the node-local copy.
+The localDir must be the same path on all nodes, and persist between jobs (e.g. /tmp, not a per-job $TMPDIR).
+"""
+
+import functools
+import hashlib
+import os
+
+
+@functools.lru_cache(maxsize=None)
+def hashDirectory(directory):
+    """
+    Returns a short hash of the names, sizes and modification times of the regular files of directory
+    (not of its subdirectories)
+    """
+    digest = hashlib.blake2b(digest_size=8)
+    with os.scandir(directory) as entries:
+        files = sorted((entry.name, entry.stat()) for entry in entries if entry.is_file())
+    for name, stat in files:
+        digest.update(f"{name}\0{stat.st_size}\0{stat.st_mtime_ns}\0".encode())
+    return digest.hexdigest()
+
+
+class NodeStaging:
+    """
+    Parameters:
+        dirRun:     the corsika run directory (DATDIR) on the shared filesystem
+        localDir:   the node-local directory of the copies
+    """
+
+    def __init__(self, dirRun, localDir="/tmp/corsika_stage"):
+        self.dirRun = os.path.abspath(dirRun)
+        self.localDir = localDir
+
+    @functools.cached_property
+    def stageDir(self):
+        return os.path.join(self.localDir, f"corsika-{hashDirectory(self.dirRun)}", "")
+
+    def stagedPath(self, path):
+        """
+        Returns the node-local path of a file of the run directory (other paths are not staged and stay the same)
+        """
+        path = os.path.abspath(path)
+        if os.path.commonpath([path, self.dirRun]) != self.dirRun:
+            return path
+        return os.path.join(self.stageDir, os.path.relpath(path, self.dirRun))
+
+    def sourcePath(self, path):
+        """
+        Returns the path on the shared filesystem of a node-local path (the inverse of stagedPath)
+        """
+        if not path.startswith(self.stageDir):
+            return path
+        return os.path.join(self.dirRun, path[len(self.stageDir):])
+
+    def scriptLines(self, nodes=1):
+        """
+        Returns the bash lines of the job script that stage the run directory on every node of the job
+        """
+        stageDir = self.stageDir.rstrip("/")
+        lines = (
+            f"# Copy the corsika run directory to node-local storage once per node (see utils/NodeStaging.py)\n"
+            + f"stage_corsika() {{\n"
+            + f"    mkdir -p {self.localDir} || return 1\n"
+            + f"    (\n"
+            + f"        flock -x 9\n"
+            + f"        if [ ! -f {stageDir}/.complete ]; then\n"
+            + f"            rm -rf {stageDir}.tmp && mkdir -p {stageDir}.tmp || exit 1\n"
+            + f"            find {self.dirRun}/ -maxdepth 1 -type f -exec cp -p {{}} {stageDir}.tmp/ \\; || exit 1\n"
+            + f"            touch {stageDir}.tmp/.complete && rm -rf {stageDir} && mv {stageDir}.tmp {stageDir} || exit 1\n"
+            + f"        fi\n"
+            + f"    ) 9>{stageDir}.lock\n"
+            + f"}}\n"
+        )
+        if nodes > 1:
+            lines += f"srun --nodes=$SLURM_NNODES --ntasks-per-node=1 bash -c \"$(declare -f stage_corsika); stage_corsika\""
+        else:
+            lines += f"stage_corsika"
+        lines += f" || {{ echo staging of {self.dirRun} to {stageDir} failed; exit 1; }}\n"
+        return lines
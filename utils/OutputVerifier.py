@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+
+"""
+This class checks that the runs of a campaign finished correctly, and records the result in the campaign index.
+
+The SIM{runNumber}_coreas folder exists also for crashed or truncated runs, so for every run of the index
+it checks (in parallel, with a multiprocessing Pool)
+    SIM{runNumber}_coreas/raw_<name>.dat
+        there is a trace for every antenna of SIM{runNumber}.list, each complete (ends with a newline,
+        4 columns in the last line) and, with AutomaticTimeBoundaries in the .reas file, of the expected length
+        (AutomaticTimeBoundaries / TimeResolution, coarsened with the distance of the antenna by ResolutionReductionScale)
+    DAT{runNumber}.long
+        the longitudinal particle and energy deposit tables have all the steps announced in their headers
+
+The content of all these files is hashed (blake2b, in sorted order of the file names) into one checksum per run.
+The index gets the columns verified (1/0), checksum and verify_error, and the state "verified" or "failed".
+Runs terminated by the watchdog of the job script (a WATCHDOG file, see JobWatchdog.py) fail with its reason.
+Runs without any output (not started yet) are left untouched.
+
+How to run:
+    python3 -m utils.OutputVerifier --dirSimulations /path/to/sims/ --processes 16
+"""
+
+import hashlib
+import multiprocessing as mp
+import os
+import re
+
+from utils.CampaignIndex import CampaignIndex
+from utils.CoreasReader import expectedSamples, readList, readReas
+from utils.JobWatchdog import WATCHDOG_FILE
+from utils.Logger import getLogger
+
+logger = getLogger(__name__)
+
+# headers of the tables of the .long file, with the number of steps of the table
+LONG_TABLES = re.compile(r"LONGITUDINAL (DISTRIBUTION|ENERGY DEPOSIT) IN\s+(\d+)")
+
+
+class OutputVerifier:
+    """
+    Parameters:
+        index:          the CampaignIndex of the campaign
+        processes:      number of parallel processes used to read the files
+    """
+
+    blockSize = 1 << 20     # bytes read at a time for the checksum
+
+    def __init__(self, index, processes=8):
+        self.index = index
+        self.processes = processes
+
+    @staticmethod
+    def checkLong(longFile):
+        """
+        Returns None if the .long file is complete, otherwise the reason why not
+        """
+        if not os.path.isfile(longFile):
+            return "no .long file"
+        expected, rows = [], []
+        with open(longFile, errors="replace") as f:
+            for line in f:
+                match = LONG_TABLES.search(line)
+                if match:
+                    expected.append(int(match.group(2)))
+                    rows.append(0)
+                    continue
+                fields = line.split()
+                if rows and fields:
+                    try:
+                        float(fields[0])
+                    except ValueError:
+                        # the column header of the table, or the fit after the last table
+                        continue
+                    rows[-1] += 1
+        if not expected:
+            return "no longitudinal table in .long"
+        for table, (nExpected, nRows) in enumerate(zip(expected, rows)):
+            if nRows < nExpected:
+                return f".long table {table} has {nRows} of {nExpected} steps"
+        return None
+
+    @classmethod
+    def hashFile(cls, fileName, digest):
+        """
+        Adds the content of the file to digest, returns the number of lines and the last line
+        """
+        nLines, last = 0, b""
+        with open(fileName, "rb") as f:
+            while True:
+                block = f.read(cls.blockSize)
+                if not block:
+                    break
+                digest.update(block)
+                nLines += block.count(b"\n")
+                last = (last + block)[-256:]
+        return nLines, last
+
+    @classmethod
+    def verifyRun(cls, folderRunNumber):
+        """
+        Verifies a single run. Returns (folder, status, checksum, error),
+        status is "verified", "failed" or "missing" (no output yet).
+        """
+        folder, runNumber = folderRunNumber
+        coreasDir = f"{folder}/SIM{runNumber}_coreas"
+        longFile = f"{folder}/DAT{runNumber}.long"
+        watchdogFile = f"{folder}/{WATCHDOG_FILE}"
+        if os.path.isfile(watchdogFile):
+            # terminated by the watchdog of the job script
+            with open(watchdogFile) as f:
+                return folder, "failed", None, f"watchdog: {f.read().strip()}"
+        if not os.path.isdir(coreasDir) and not os.path.isfile(longFile):
+            return folder, "missing", None, None
+
+        try:
+            antennas = readList(f"{folder}/SIM{runNumber}.list")
+            names = antennas["name"]
+            nSamples = expectedSamples(readReas(f"{folder}/SIM{runNumber}.reas"), antennas)
+        except (OSError, IndexError, KeyError, ValueError) as error:
+            return folder, "failed", None, f"cannot read .list/.reas: {error}"
+
+        error = cls.checkLong(longFile)
+        if error is not None:
+            return folder, "failed", None, error
+
+        digest = hashlib.blake2b(digest_size=16)
+        if nSamples is not None and not isinstance(nSamples, int):
+            nSamples = dict(zip((f"raw_{name}.dat" for name in names), nSamples))
+        files = sorted([(f"raw_{name}.dat", f"{coreasDir}/raw_{name}.dat") for name in names]
+                       + [(os.path.basename(longFile), longFile)])
+        for name, fileName in files:
+            digest.update(name.encode())
+            try:
+                nLines, last = cls.hashFile(fileName, digest)
+            except OSError:
+                return folder, "failed", None, f"missing {name}"
+            if name == os.path.basename(longFile):
+                continue
+            if not last.endswith(b"\n") or len(last.splitlines()[-1].split()) != 4:
+                return folder, "failed", None, f"truncated {name}"
+            expected = nSamples.get(name) if isinstance(nSamples, dict) else nSamples
+            if expected is not None and nLines != expected:
+                return folder, "failed", None, f"{name} has {nLines} of {expected} samples"
+        return folder, "verified", digest.hexdigest(), None
+
+    def verify(self, recheck=False):
+        """
+        Verifies all runs of the index that are not verified yet (all of them with recheck) in parallel,
+        and writes the results to the index. Returns the number of runs per status.
+        """
+        runs = self.index.getRuns(columns=("folder", "runNumber", "verified"))
+        runs = [(folder, runNumber) for folder, runNumber, verified in runs if recheck or not verified]
+        logger.info(f"Verifying {len(runs)} runs with {self.processes} processes")
+
+        counts = {"verified": 0, "failed": 0, "missing": 0}
+        with mp.Pool(self.processes) as pool:
+            for folder, status, checksum, error in pool.imap_unordered(self.verifyRun, runs, chunksize=16):
+                counts[status] += 1
+                if status == "missing":
+                    continue
+                if status == "failed":
+                    logger.warning(f"{folder}: {error}")
+                self.index.addRun(
+                    folder=folder,
+                    state=status,
+                    verified=int(status == "verified"),
+                    checksum=checksum,
+                    verify_error=error,
+                )
+        self.index.flush()
+        return counts
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    from utils.Logger import setupLogging
+
+    parser = argparse.ArgumentParser(
+        description="Verifies the CORSIKA/CoREAS output of a campaign and records it in the campaign index"
+    )
+    parser.add_argument(
+        "--dirSimulations",
+        type=str,
+        required=True,
+        help="Directory where the simulation are stored (with the campaign_index.sqlite)",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=8,
+        help="number of parallel processes reading the files",
+    )
+    parser.add_argument(
+        "--recheck",
+        action="store_true",
+        help="verify again the runs that are already verified",
+    )
+    args = parser.parse_args()
+    setupLogging()
+
+    index = CampaignIndex(os.path.join(args.dirSimulations, "campaign_index.sqlite"))
+    counts = OutputVerifier(index, processes=args.processes).verify(recheck=args.recheck)
+    index.close()
+    logger.info(", ".join(f"{count} {status}" for status, count in counts.items()))
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+"""
+This class checks the generated input files of the runs before they are submitted.
+
+CORSIKA crashes without any explanation if OBSLEV in the .inp file, CoreCoordinateVertical in the .reas file
+and the z of the antennas in the .list file disagree, and every crash costs a full node allocation.
+For every run (in parallel, with a multiprocessing Pool) it checks
+    .inp    OBSLEV, ERANGE, THETAP and PHIP are given, DIRECT is the folder of the run
+    .reas   CoreCoordinateVertical is OBSLEV, CorsikaParameterFile is the .inp of the run
+    .list   there are antennas, their names are unique and their z is OBSLEV (within tolerance)
+    .sub    exists
+The ATMFILE of all runs is checked once per file (on the shared filesystem, if it is staged to the nodes).
+The runs are checked in batches as they are written (checkBatches), so the first batch is submitted
+while the next runs are written, and only one batch is kept in memory.
+
+Runs with an error are not submitted (and get the state "rejected" in the campaign index).
+printReport prints the accepted and rejected runs per energy/zenith bin and the most frequent errors.
+"""
+
+import collections
+import itertools
+import multiprocessing as mp
+import os
+
+import numpy as np
+
+from utils.CoreasReader import readInp, readReas
+from utils.Logger import getLogger
+
+logger = getLogger(__name__)
+
+
+class PreflightChecker:
+    """
+    Parameters:
+        processes:  number of parallel processes reading the files
+        tolerance:  allowed difference between OBSLEV and the z of the antennas, in cm
+        index:      the CampaignIndex, where the rejected runs are marked (optional)
+        staging:    the NodeStaging of the job scripts, node-local ATMFILEs are checked at their source (optional)
+    """
+
+    def __init__(self, processes=8, tolerance=1., index=None, staging=None):
+        self.processes = processes
+        self.tolerance = tolerance
+        self.index = index
+        self.staging = staging
+        self.report = collections.defaultdict(lambda: [0, 0])   # (log10_E1, zenith_bin): [accepted, rejected]
+        self.errors = collections.Counter()
+        # ATMFILE: whether it exists, checked once per file
+        self.atmfiles = {}
+
+    @staticmethod
+    def splitSubFile(subFile):
+        """
+        Returns the folder, runNumber, energy bin and zenith bin of a run from its .sub file
+        (folder structure primary_particle/energy/theta/runNumber/)
+        """
+        folder = os.path.dirname(subFile)
+        runNumber = os.path.basename(subFile)[len("SIM"):-len(".sub")]
+        parts = os.path.normpath(folder).split(os.sep)
+        return folder, runNumber, parts[-3], parts[-2]
+
+    @classmethod
+    def checkRun(cls, job):
+        """
+        Checks the input files of a single run. Returns (the ATMFILE, the error or None)
+        """
+        subFile, tolerance = job
+        folder, runNumber, _, _ = cls.splitSubFile(subFile)
+        sim = f"{folder}/SIM{runNumber}"
+        try:
+            inp = readInp(f"{sim}.inp")
+            reas = readReas(f"{sim}.reas")
+        except OSError as error:
+            return None, f"missing input file: {os.path.basename(error.filename or '')}"
+
+        for keyword in ("OBSLEV", "ERANGE", "THETAP", "PHIP", "ATMFILE", "DIRECT"):
+            if keyword not in inp:
+                return None, f"no {keyword} in .inp"
+        atmfile = inp["ATMFILE"][0][0]
+        obslev = float(inp["OBSLEV"][0][0])
+        if os.path.normpath(inp["DIRECT"][0][0]) != os.path.normpath(folder):
+            return atmfile, "DIRECT of .inp is not the run folder"
+        if "CoreCoordinateVertical" not in reas or abs(float(reas["CoreCoordinateVertical"]) - obslev) > tolerance:
+            return atmfile, "CoreCoordinateVertical of .reas differs from OBSLEV"
+        if reas.get("CorsikaParameterFile") != f"SIM{runNumber}.inp":
+            return atmfile, "CorsikaParameterFile of .reas is not the .inp of the run"
+
+        try:
+            antennas = np.loadtxt(f"{sim}.list", dtype=str, usecols=(4, 5), ndmin=2)
+        except (OSError, ValueError, IndexError):
+            return atmfile, "unreadable .list"
+        if len(antennas) == 0:
+            return atmfile, "no antennas in .list"
+        if len(np.unique(antennas[:, 1])) != len(antennas):
+            return atmfile, "duplicate antenna names in .list"
+        if np.any(np.abs(antennas[:, 0].astype(float) - obslev) > tolerance):
+            return atmfile, "antenna z of .list differs from OBSLEV"
+
+        if not os.path.isfile(f"{sim}.sub"):
+            return atmfile, "missing .sub"
+        return atmfile, None
+
+    def check(self, keySubStrings):
+        """
+        Checks a batch of runs (the keys and .sub files yielded by SimulationMaker.generator).
+        Returns the list of the runs that can be submitted.
+        """
+        keySubStrings = list(keySubStrings)
+        jobs = [(subFile, self.tolerance) for _, subFile in keySubStrings]
+        logger.info(f"Preflight check of {len(jobs)} runs with {self.processes} processes")
+        with mp.Pool(self.processes) as pool:
+            results = pool.map(self.checkRun, jobs, chunksize=max(1, len(jobs) // (4 * self.processes)))
+
+        # the atmosphere files are only checked once each
+        sourcePath = self.staging.sourcePath if self.staging is not None else (lambda path: path)
+        for atmfile in {result[0] for result in results} - set(self.atmfiles):
+            if atmfile is not None:
+                self.atmfiles[atmfile] = os.path.isfile(sourcePath(atmfile))
+        missingAtmfiles = {atmfile for atmfile, exists in self.atmfiles.items() if not exists}
+
+        accepted = []
+        for (key, subFile), (atmfile, error) in zip(keySubStrings, results):
+            if error is None and atmfile in missingAtmfiles:
+                error = f"ATMFILE {atmfile} does not exist"
+            folder, _, log10_E1, zenith_bin = self.splitSubFile(subFile)
+            self.report[(log10_E1, zenith_bin)][error is not None] += 1
+            if error is None:
+                accepted.append((key, subFile))
+                continue
+            self.errors[error] += 1
+            logger.debug("Rejected %s: %s", folder, error)
+            if self.index is not None:
+                self.index.setState(os.path.join(folder, ""), "rejected")
+        if self.index is not None:
+            self.index.flush()
+        return accepted
+
+    def checkBatches(self, keySubStrings, batchSize=1000):
+        """
+        Checks the runs in batches of batchSize as they are generated, yields the ones that can be submitted
+        """
+        keySubStrings = iter(keySubStrings)
+        while True:
+            batch = list(itertools.islice(keySubStrings, batchSize))
+            if not batch:
+                return
+            yield from self.check(batch)
+
+    def printReport(self):
+        """
+        Prints the accepted and rejected runs per energy/zenith bin and the errors
+        """
+        print(f"{'log10_E':>8} {'zenith':>7} {'accepted':>9} {'rejected':>9}")
+        for (log10_E1, zenith_bin), (nAccepted, nRejected) in sorted(self.report.items(), key=lambda item: (float(item[0][0]), float(item[0][1]))):
+            print(f"{log10_E1:>8} {zenith_bin:>7} {nAccepted:>9d} {nRejected:>9d}")
+        for error, count in self.errors.most_common():
+            print(f"{count:>9d} x {error}")
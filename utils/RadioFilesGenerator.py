@@ -13,10 +13,16 @@ the detector antennas are moved at random for each run.
 
 import numpy as np
 import random
-from miniradiotools.starshapes import create_stshp_list, get_starshaped_pattern_radii
+from utils.StarshapeCache import getStarshapePattern
+from utils.FootprintModel import FootprintModel
+from utils.CampaignConfig import loadConfig
+from utils.Logger import getLogger
+from utils.StageTimer import timer
 import sys
 import os
 
+logger = getLogger(__name__)
+
 class RadioFilesGenerator:
 
     def __init__(self,
@@ -29,6 +35,11 @@ class RadioFilesGenerator:
         azimuth,
         primary,
         folder_path,
+        footprintFactor = 0,        # signal radius in units of the Cherenkov radius, 0 keeps all antennas (see FootprintModel.py)
+        radio = None,               # the [radio] settings of the CampaignConfig, the defaults are used if None
+        site = None,                # the [site] settings of the CampaignConfig (starshape atmosphere and inclination), the defaults are used if None
+        timeResolutionPolicy = None,    # TimeResolutionPolicy choosing the time settings of the .reas from the antennas, fixed [radio] settings if None
+        timePolicySettings = None,      # the [timeResolutionPolicy] settings of the CampaignConfig for this bin
 
     ):
         self.directory = directory
@@ -40,8 +51,24 @@ class RadioFilesGenerator:
         self.azimuth= azimuth
         self.primary = primary
         self.folder_path = folder_path
+        self.footprintFactor = footprintFactor
+        if radio is None:
+            radio = loadConfig(None)["radio"]
+        self.radio = radio
+        if site is None:
+            site = loadConfig(None)["site"]
+        self.site = site
+        self.timeResolutionPolicy = timeResolutionPolicy
+        self.timePolicySettings = timePolicySettings
+        # the time settings of the .reas file, chosen in chooseTimeSettings
+        self.timeSettings = {
+            "timeResolution": self.radio["timeResolution"],
+            "automaticTimeBoundaries": self.radio["automaticTimeBoundaries"],
+            "resolutionReductionScale": self.radio["resolutionReductionScale"],
+        }
         self.antennaInfo = {}
         self.starshapeInfo = {}
+        self.antennaStats = {}
 
 
         """
@@ -77,13 +104,13 @@ class RadioFilesGenerator:
                 + f"CoreCoordinateWest = 0                ; in cm\n"
                 + f"CoreCoordinateVertical = {self.obslev}      ; in cm\n"
                 + f"# parameters setting up the temporal observer configuration:\n"
-                + f"TimeResolution = 5e-10                ; in s\n"
-                + f"AutomaticTimeBoundaries = 12e-07            ; 0: off, x: automatic boundaries with width x in s\n"
+                + f"TimeResolution = {self.timeSettings['timeResolution']}                ; in s\n"
+                + f"AutomaticTimeBoundaries = {self.timeSettings['automaticTimeBoundaries']}            ; 0: off, x: automatic boundaries with width x in s\n"
                 + f"TimeLowerBoundary = -1                ; in s, only if AutomaticTimeBoundaries set to 0\n"
                 + f"TimeUpperBoundary = 1                ; in s, only if AutomaticTimeBoundaries set to 0\n"
-                + f"ResolutionReductionScale = 0            ; 0: off, x: decrease time resolution linearly every x cm in radius\n"
+                + f"ResolutionReductionScale = {self.timeSettings['resolutionReductionScale']:g}            ; 0: off, x: decrease time resolution linearly every x cm in radius\n"
                 + f"# parameters setting up the simulation functionality:\n"
-                + f"GroundLevelRefractiveIndex = 1.00031200        ; specify refractive index at 0 m asl\n"
+                + f"GroundLevelRefractiveIndex = {self.radio['refractiveIndex']:.8f}        ; specify refractive index at 0 m asl\n"
                 + f"# event information for Offline simulations:\n"
                 + f"EventNumber = 1\n"
                 + f"RunNumber = {self.runNumber} \n"
@@ -93,7 +120,7 @@ class RadioFilesGenerator:
                 + f"CoreNorthingOffline = 0.0000                ; in meters\n"
                 + f"CoreVerticalOffline = 0.0000                ; in meters\n"
                 + f"OfflineCoordinateSystem = Reference                ; in meters\n"
-                + f"RotationAngleForMagfieldDeclination = 0.12532        ; in degrees\n"
+                + f"RotationAngleForMagfieldDeclination = {self.radio['magneticDeclination']}        ; in degrees\n"
                 + f"Comment =\n"
                 + f"CorsikaFilePath = ./\n"
                 + f"CorsikaParameterFile = {sim}.inp"
@@ -136,8 +163,9 @@ class RadioFilesGenerator:
 
     def get_starshapes(self):
         """
-        get starshape positions from starshapes.list
-        .list files are structured like "AntennaPosition = x y z name"
+        get starshape positions for the geometry of this run
+        The patterns are cached in memory and in {directory}/starshapes_cache (see StarshapeCache.py),
+        so they are only created with miniradiotools once per geometry.
 
         """
         # create the SIMxxxxxx ID
@@ -156,43 +184,75 @@ class RadioFilesGenerator:
 
         radiotools_azimuth = self.azimuth + 270 
 
-        print("* * * * * * * * * * * * * *")
-        print("* casting starshape pattern *")
-        antenna_rings = get_starshaped_pattern_radii(self.zenith, self.obslev, atm_model=41)
-        # atm_model = 41: Dunhuang, China
-
-        corsika_azimuth = create_stshp_list(self.zenith, radiotools_azimuth, filename=f"{self.directory}/{self.log10_E1}/{sim}_starshape.list", 
-                        obslevel=int(self.obslev), # for Dunhuang, in cm for corsika
-                        obsplane = "gp",
-                        inclination=61.60523, # for Dunhuang
-                        vxB_plot=False,
-                        # n_rings = 20 # for 160 antennas
-                        antenna_rings = antenna_rings # for 240 antennas
+        logger.debug("* casting starshape pattern *")
+        # The radii and the pattern only depend on the geometry, so they are taken from the cache
+        # and created (and written to the cache) only if this geometry was never used before.
+        # the atmosphere model and the inclination of the site (41 and 61.60523 for Dunhuang, China)
+        corsika_azimuth, x, y, z, name = getStarshapePattern(
+                        self.zenith, radiotools_azimuth,
+                        obslev=int(self.obslev), # in cm for corsika
+                        atm_model=self.site["atmModel"],
+                        inclination=self.site["inclination"],
+                        cacheDir=f"{self.directory}/starshapes_cache",
                         )
-        print("* * * * * * * * * * * * * *")
         # check if self.azimuth is the same as the corsika_azimuth from the starshapes
         # if it is: yay!
         if self.azimuth == corsika_azimuth:
-            print(f"Shower azimuth = starshape azimuth: {corsika_azimuth}")
-            print(f"***** Summoning starshapes ***** with azimuth {corsika_azimuth}.")
+            logger.debug("***** Summoning starshapes ***** with azimuth %s.", corsika_azimuth)
         # if it isn't, we have a problem:
         else:
-            print(f"Shower azimuth {self.azimuth}")
-            print(f"Starshape azimuth {corsika_azimuth}")
+            logger.error(f"Shower azimuth {self.azimuth}, starshape azimuth {corsika_azimuth}")
             sys.exit(f"Shower and starshape azimuth are not the same! Please check the inputs and try again.")
 
-
-        # use the starshape file we just generated and read the antenna positions and names from it:
-        file = np.genfromtxt(f"{self.directory}/{self.log10_E1}/{sim}_starshape.list", dtype = "str")
-        
-        # get antenna positions from file
-        # file[:,0] and file[:,1] are useless (they are simply "AntennaPosition" and "=")
-        # get the x and y positions
-        self.starshapeInfo["x"] = file[:,2].astype(float)
-        self.starshapeInfo["y"] = file[:,3].astype(float)
-        self.starshapeInfo["z"] = file[:,4].astype(float)
+        # the arrays come directly from the cache, no need to write and read the starshape file again
+        self.starshapeInfo["x"] = x
+        self.starshapeInfo["y"] = y
+        self.starshapeInfo["z"] = z
         # get the names of the antennas
-        self.starshapeInfo["name"] = file[:,5]
+        self.starshapeInfo["name"] = name
+
+
+    def pruneAntennas(self):
+        """
+        Drops the detector antennas that are outside of the expected footprint of this shower.
+        The footprint is an ellipse around the core (see FootprintModel.py).
+        The number of antennas kept is stored in self.antennaStats.
+        """
+        total = self.antennaInfo["x"].shape[0]
+
+        if self.footprintFactor:
+            footprint = FootprintModel(
+                zenith = self.zenith,
+                azimuth = self.azimuth,
+                log10_E1 = self.log10_E1,
+                obslev = self.obslev,
+                radiusFactor = self.footprintFactor,
+            )
+            mask = footprint.getMask(self.antennaInfo["x"], self.antennaInfo["y"])
+            for key in self.antennaInfo.keys():
+                self.antennaInfo[key] = self.antennaInfo[key][mask]
+
+        self.antennaStats = {"total": total, "kept": self.antennaInfo["x"].shape[0]}
+        logger.debug("Footprint: keeping %d of %d antennas", self.antennaStats["kept"], total)
+
+
+    def chooseTimeSettings(self):
+        """
+        Chooses the time window and ResolutionReductionScale of the .reas file from the antennas of this run
+        (see TimeResolutionPolicy.py), if a policy is given.
+        """
+        if self.timeResolutionPolicy is None:
+            return
+        self.timeSettings = self.timeResolutionPolicy.choose(
+            self.timePolicySettings, self.radio,
+            self.antennaInfo["x"], self.antennaInfo["y"],
+            zenith = self.zenith,
+            azimuth = self.azimuth,
+            log10_E = self.log10_E1,
+            obslev = self.obslev,
+        )
+        logger.debug("Time settings: window %s s, reduction scale %g cm",
+                     self.timeSettings["automaticTimeBoundaries"], self.timeSettings["resolutionReductionScale"])
 
 
     def listWriter(self):
@@ -210,14 +270,19 @@ class RadioFilesGenerator:
             # for i in range(self.starshapeInfo["x"].shape[0]):
             #     f.write(f"AntennaPosition = {self.starshapeInfo['x'][i]} {self.starshapeInfo['y'][i]} {self.starshapeInfo['z'][i]} {self.starshapeInfo['name'][i]}\n") 
             # write the positions (x, y, z) and names of the detector's antennas to the .list file
-            print("***** Summoning GP300 antennas *****")
+            logger.debug("***** Summoning GP300 antennas *****")
             for i in range(self.antennaInfo["x"].shape[0]):
-                f.write(f"AntennaPosition = {self.antennaInfo['x'][i]} {self.antennaInfo['y'][i]} 120000 {self.antennaInfo['name'][i]}\n") 
+                # the antennas are at the observation level, the same as OBSLEV in the .inp and CoreCoordinateVertical in the .reas
+                f.write(f"AntennaPosition = {self.antennaInfo['x'][i]} {self.antennaInfo['y'][i]} {self.obslev} {self.antennaInfo['name'][i]}\n")
 
+    @timer.timed("RadioFilesGenerator")
     def writeReasList(self):
         # define this to make it easier to call the functions
 
-        self.reasWriter()
         self.get_antennaPositions()
+        self.pruneAntennas()
+        # the time settings of the .reas depend on the antennas of the run
+        self.chooseTimeSettings()
+        self.reasWriter()
         # self.get_starshapes()
         self.listWriter()
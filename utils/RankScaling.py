@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+
+"""
+This class chooses the number of MPI ranks of each shower from a calibration of how the energy/zenith bins scale.
+
+Without it every job gets the [slurm] nodes x ntasksPerNode ranks. The parallel runner of MPI-CORSIKA splits
+the shower into sub-showers above ECTMAX (PARALLEL in the .inp file), so how well a shower scales depends
+on its energy, zenith and ECTMAX. The wall time is modelled (Amdahl) as
+    wallHours(N) = serialHours + parallelHours / N
+for N ranks, fitted per bin and ECTMAX to reference showers. The jobs get whole nodes (see slurmForRanks), which are
+charged on exclusive partitions, so with chargeUnit = "node" a job of N ranks is charged for
+    chargedRanks(N) = ceil(N / ntasksPerNode) ntasksPerNode
+ranks, and with chargeUnit = "core" for N. The efficiency is the share of the charged time spent on the shower,
+    efficiency(N) = wallHours(1) / (chargedRanks(N) wallHours(N))
+and each shower gets the largest of the rankCounts whose efficiency is at least minEfficiency, the cheapest one
+(smallest chargedRanks(N) wallHours(N)) if none is, or more ranks if the wall time would exceed maxWallHours
+(default the slurm time limit).
+The bin, zenith and ECTMAX of a shower are matched to the nearest row of the table.
+
+Calibration:
+    1. python3 MakeCorsikaSim.py ... --rankCalibration
+       writes and submits one reference shower per energy/zenith bin for every rank count and ECTMAX of the
+       [rankScaling] section (the same shower: same runNumber and seeds) to
+       {dirSimulations}/rankCalibration/{primary}/{log10_E1}/{zenith_bin}/ranks{N}_ectmax{ECTMAX}/{runNumber}/
+       These runs are not part of the campaign index.
+    2. python3 -m utils.RankScaling --dirSimulations /path/to/sims/ --table rank_scaling.csv
+       reads their wall time from the corsika timetables (see RuntimeAggregator.readTimetables), fits the model
+       and writes the table, a csv with the columns log10_E,zenith,ectmax,serialHours,parallelHours,runs
+    3. [rankScaling] enabled = true and table = "rank_scaling.csv" in the config file:
+       the .sub files of the campaign get the chosen ranks (see SubFilesGenerator.py)
+"""
+
+import glob
+import os
+
+import numpy as np
+
+from utils.JobWatchdog import WATCHDOG_FILE
+from utils.Logger import getLogger
+
+logger = getLogger(__name__)
+
+CALIBRATION_DIR = "rankCalibration"
+
+
+def slurmForRanks(slurm, ranks):
+    """
+    Returns the [slurm] settings with the nodes and tasks per node of a job with the given number of ranks,
+    as few nodes as possible with at most ntasksPerNode tasks each
+    """
+    nodes = -(-int(ranks) // slurm["ntasksPerNode"])
+    return dict(slurm, nodes=nodes, ntasksPerNode=-(-int(ranks) // nodes))
+
+
+def timeLimitHours(time):
+    """
+    Returns the hours of a slurm time limit, in the formats of sbatch --time: "minutes", "minutes:seconds",
+    "hours:minutes:seconds", "days-hours", "days-hours:minutes" and "days-hours:minutes:seconds".
+    0 for no limit ("UNLIMITED", "INFINITE")
+    """
+    time = str(time).strip()
+    if time.upper() in ("UNLIMITED", "INFINITE"):
+        return 0.
+    days, dash, time = time.partition("-")
+    if not dash:
+        days, time = "0", days
+    fields = [float(field) for field in time.split(":")]
+    if len(fields) > 3:
+        raise ValueError(f"Not a slurm time limit: {time}")
+    if dash:
+        # days-hours[:minutes[:seconds]]
+        fields += [0.] * (3 - len(fields))
+    elif len(fields) < 3:
+        # minutes[:seconds]
+        fields = [0.] + fields + [0.] * (2 - len(fields))
+    return 24. * float(days) + fields[0] + fields[1] / 60. + fields[2] / 3600.
+
+
+class RankScaling:
+    """
+    Parameters:
+        table:          csv of the fitted scaling (see above)
+        rankCounts:     the rank counts that can be chosen
+        minEfficiency:  the lowest parallel efficiency accepted for more ranks
+        maxWallHours:   the wall time a job must stay within (the ranks are increased for it), 0: no limit
+        ntasksPerNode:  the ranks per node of the jobs (see slurmForRanks), whose nodes are charged as a whole;
+                        0 when the cores are charged (the chargeUnit "core")
+    """
+
+    tableColumns = ["log10_E", "zenith", "ectmax", "serialHours", "parallelHours", "runs"]
+
+    def __init__(self, table, rankCounts, minEfficiency=0.7, maxWallHours=0., ntasksPerNode=0):
+        self.table = np.atleast_1d(np.genfromtxt(table, delimiter=",", names=True))
+        self.rankCounts = np.sort(np.asarray(rankCounts, dtype=int))
+        self.minEfficiency = minEfficiency
+        self.maxWallHours = maxWallHours
+        self.ntasksPerNode = ntasksPerNode
+        self._choices = {}
+        logger.info(f"Rank scaling of {len(self.table)} bins read from {table}")
+
+    @classmethod
+    def fromConfig(cls, rankScaling, slurm):
+        """
+        Returns the RankScaling of the [rankScaling] section of the CampaignConfig, or None if it is disabled
+        """
+        if not rankScaling["enabled"]:
+            return None
+        if not rankScaling["table"]:
+            raise ValueError("[rankScaling] is enabled without a table, run the calibration first (see RankScaling.py)")
+        if rankScaling["chargeUnit"] not in ("node", "core"):
+            raise ValueError(f"[rankScaling] chargeUnit must be node or core, not {rankScaling['chargeUnit']}")
+        return cls(
+            rankScaling["table"],
+            rankScaling["rankCounts"],
+            minEfficiency=rankScaling["minEfficiency"],
+            maxWallHours=rankScaling["maxWallHours"] or timeLimitHours(slurm["time"]),
+            ntasksPerNode=slurm["ntasksPerNode"] if rankScaling["chargeUnit"] == "node" else 0,
+        )
+
+    def nearest(self, log10_E, zenith, ectmax):
+        """
+        Returns the row of the table closest to the shower (0.1 in log10_E, 2.5 degrees and a decade of ECTMAX weigh the same)
+        """
+        distance = (((self.table["log10_E"] - log10_E) / 0.1)**2 + ((self.table["zenith"] - zenith) / 2.5)**2
+                    + np.log10(self.table["ectmax"] / ectmax)**2)
+        return self.table[np.argmin(distance)]
+
+    @staticmethod
+    def wallHours(row, ranks):
+        return row["serialHours"] + row["parallelHours"] / np.asarray(ranks, dtype=float)
+
+    def chargedRanks(self, ranks):
+        """
+        Returns the ranks charged for jobs of the given ranks: all ranks of their nodes, or the ranks themselves
+        """
+        ranks = np.asarray(ranks, dtype=int)
+        if not self.ntasksPerNode:
+            return ranks
+        return -(-ranks // self.ntasksPerNode) * self.ntasksPerNode
+
+    def chargedHours(self, row, ranks):
+        return self.chargedRanks(ranks) * self.wallHours(row, ranks)
+
+    def efficiency(self, row, ranks):
+        return self.wallHours(row, 1) / self.chargedHours(row, ranks)
+
+    def choose(self, log10_E, zenith_bin, ectmax):
+        """
+        Returns the number of ranks for a shower of the given energy and zenith bin, ectmax relative to its energy
+        as in the config
+        """
+        key = (round(float(log10_E), 6), round(float(zenith_bin), 6), float(ectmax))
+        if key not in self._choices:
+            row = self.nearest(*key)
+            efficient = self.rankCounts[self.efficiency(row, self.rankCounts) >= self.minEfficiency]
+            ranks = efficient.max() if len(efficient) else self.rankCounts[np.argmin(self.chargedHours(row, self.rankCounts))]
+            if self.maxWallHours > 0 and self.wallHours(row, ranks) > self.maxWallHours:
+                # more ranks than efficient, so that the job finishes within the time limit
+                fast = self.rankCounts[self.wallHours(row, self.rankCounts) <= self.maxWallHours]
+                ranks = fast.min() if len(fast) else self.rankCounts.max()
+            self._choices[key] = int(ranks)
+        return self._choices[key]
+
+
+def calibrationRuns(simMaker, rankCounts, ectmaxLevels):
+    """
+    Writes the reference showers of the calibration for the bins of a SimulationMaker (the first run of each bin of
+    its plan) and yields their keys and strings to submit, one run per rank count and ECTMAX of each bin
+    """
+    plan = simMaker.buildPlan()
+    directory = os.path.join(simMaker.directory, CALIBRATION_DIR)
+    _, first = np.unique(np.stack([plan["log10_E1"], plan["zenith_bin"]], axis=1), axis=0, return_index=True)
+    for i in first:
+        log10_E1, zenith_bin, zenith, azimuth = plan["log10_E1"][i], plan["zenith_bin"][i], plan["zenith"][i], plan["azimuth"][i]
+        runNumber, _ = simMaker.runFolder(log10_E1, zenith_bin, zenith, azimuth, plan["runIndex"][i])
+        for ectmax in ectmaxLevels:
+            for ranks in rankCounts:
+                point = f"ranks{ranks}_ectmax{ectmax:.0E}"
+                folder = os.path.join(directory, f"{simMaker.primary_particle}/{log10_E1}/{zenith_bin}/{point}/{runNumber}/")
+                os.makedirs(folder, exist_ok=True)
+                simMaker.fW.writeFile(runNumber, log10_E1, azimuth, zenith, folder, log10_E=plan["log10_E"][i],
+                                      ectmax=ectmax, ranks=ranks, zenith_bin=zenith_bin)
+                key = f"{log10_E1}_{runNumber}_{point}" if simMaker.site is None else f"{simMaker.site}_{log10_E1}_{runNumber}_{point}"
+                yield key, simMaker.makeStringToSubmit(log10_E1, runNumber, zenith, folder)
+
+
+def readCalibration(dirSimulations):
+    """
+    Returns the wall hours of the finished calibration runs in dirSimulations (also of all sites),
+    as a dictionary of arrays log10_E, zenith (the bin), ectmax, ranks, wallHours.
+    Runs stopped by the watchdog or without their .long file (not finished) are skipped.
+    """
+    from utils.RuntimeAggregator import RuntimeAggregator
+
+    runs = {key: [] for key in ("log10_E", "zenith", "ectmax", "ranks", "wallHours")}
+    for folder in sorted(glob.glob(os.path.join(dirSimulations, "**", CALIBRATION_DIR, "*", "*", "*", "ranks*_ectmax*", "*", ""),
+                                   recursive=True)):
+        parts = os.path.normpath(folder).split(os.sep)
+        runNumber, point, zenith_bin, log10_E1 = parts[-1], parts[-2], parts[-3], parts[-4]
+        if os.path.exists(os.path.join(folder, WATCHDOG_FILE)):
+            logger.warning(f"{folder} was stopped by the watchdog, not used for the calibration")
+            continue
+        if not os.path.isfile(os.path.join(folder, f"DAT{runNumber}.long")):
+            logger.debug(f"No DAT{runNumber}.long in {folder}, the run is not finished")
+            continue
+        wallHours, _, _ = RuntimeAggregator.readTimetables(f"{folder}/DAT{runNumber}")
+        if not np.isfinite(wallHours):
+            logger.debug(f"No timetables in {folder}, the run is not finished")
+            continue
+        ranks, ectmax = point[len("ranks"):].split("_ectmax")
+        for key, value in zip(runs, (log10_E1, zenith_bin, ectmax, ranks, wallHours)):
+            runs[key].append(float(value))
+    return {key: np.array(values) for key, values in runs.items()}
+
+
+def fitScaling(runs):
+    """
+    Fits wallHours = serialHours + parallelHours / ranks (both >= 0) for each bin and ECTMAX
+    with at least two rank counts. Returns the rows of the table as a dictionary of arrays.
+    """
+    table = {column: [] for column in RankScaling.tableColumns}
+    points = np.stack([runs["log10_E"], runs["zenith"], runs["ectmax"]], axis=1) if len(runs["ranks"]) else np.zeros((0, 3))
+    for log10_E, zenith, ectmax in np.unique(points, axis=0):
+        mask = (points[:, 0] == log10_E) & (points[:, 1] == zenith) & (points[:, 2] == ectmax)
+        ranks, wallHours = runs["ranks"][mask], runs["wallHours"][mask]
+        if len(np.unique(ranks)) < 2:
+            logger.warning(f"Only one rank count for log10_E {log10_E} zenith {zenith} ECTMAX {ectmax:.0E}, not fitted")
+            continue
+        (serial, parallel), *_ = np.linalg.lstsq(np.stack([np.ones(len(ranks)), 1. / ranks], axis=1), wallHours, rcond=None)
+        if serial < 0:
+            serial, parallel = 0., np.sum(wallHours / ranks) / np.sum(1. / ranks**2)
+        elif parallel < 0:
+            serial, parallel = wallHours.mean(), 0.
+        for column, value in zip(table, (log10_E, zenith, ectmax, serial, parallel, mask.sum())):
+            table[column].append(value)
+    return {column: np.array(values) for column, values in table.items()}
+
+
+def writeTable(table, fileName):
+    with open(fileName, "w") as f:
+        f.write(",".join(RankScaling.tableColumns) + "\n")
+        for row in zip(*(table[column] for column in RankScaling.tableColumns)):
+            f.write(f"{row[0]:.1f},{row[1]:.1f},{row[2]:.3E},{row[3]:.6g},{row[4]:.6g},{int(row[5])}\n")
+
+
+def printScaling(rankScaling):
+    """
+    Prints per row of the table the serial fraction, the efficiency for each rank count and the chosen ranks
+    """
+    print(f"{'log10_E':>8} {'zenith':>7} {'ectmax':>9} {'serial':>7} "
+          + " ".join(f"{'eff ' + str(ranks):>8}" for ranks in rankScaling.rankCounts) + f" {'ranks':>6} {'wall-h':>7}")
+    for row in rankScaling.table:
+        ranks = rankScaling.choose(row["log10_E"], row["zenith"], row["ectmax"])
+        serialFraction = row["serialHours"] / max(rankScaling.wallHours(row, 1), 1e-12)
+        print(f"{row['log10_E']:>8.1f} {row['zenith']:>7.1f} {row['ectmax']:>9.1E} {serialFraction:>7.3f} "
+              + " ".join(f"{efficiency:>8.2f}" for efficiency in rankScaling.efficiency(row, rankScaling.rankCounts))
+              + f" {ranks:>6d} {float(rankScaling.wallHours(row, ranks)):>7.2f}")
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    from utils.CampaignConfig import loadConfig
+
+    parser = argparse.ArgumentParser(
+        description="Fits the MPI rank scaling of the calibration runs and writes the table used for the .sub files"
+    )
+    parser.add_argument(
+        "--dirSimulations",
+        type=str,
+        required=True,
+        help="Directory where the simulation are stored (with the rankCalibration folder)",
+    )
+    parser.add_argument(
+        "--table",
+        type=str,
+        default="rank_scaling.csv",
+        help="the csv file written, [rankScaling] table of the config file",
+    )
+    parser.add_argument(
+        "--config",
+        type=str,
+        default=None,
+        help="config file with the [rankScaling] rank counts and efficiency of the report, default is campaign.toml",
+    )
+    args = parser.parse_args()
+
+    config = loadConfig(args.config) if args.config else loadConfig()
+    runs = readCalibration(args.dirSimulations)
+    logger.info(f"{len(runs['ranks'])} finished calibration runs")
+    table = fitScaling(runs)
+    if not len(table["runs"]):
+        raise SystemExit("No bin has finished calibration runs with two rank counts or more")
+    writeTable(table, args.table)
+    logger.info(f"Rank scaling of {len(table['runs'])} bins written to {args.table}")
+    printScaling(RankScaling(
+        args.table,
+        config["rankScaling"]["rankCounts"],
+        minEfficiency=config["rankScaling"]["minEfficiency"],
+        maxWallHours=config["rankScaling"]["maxWallHours"] or timeLimitHours(config["slurm"]["time"]),
+        ntasksPerNode=config["slurm"]["ntasksPerNode"] if config["rankScaling"]["chargeUnit"] == "node" else 0,
+    ))
@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+
+"""
+This class packs the verified runs of a campaign into a few large containers per energy/zenith bin,
+and removes the run folders from scratch (quotas on bytes and on inodes).
+
+The container of a bin is an uncompressed tar file
+    {dirArchive}/{primary}/{log10_E1}/{zenith_bin}/bin_{part:04d}.tar
+whose members are the compressed runs, {runNumber}.tar.zst (if the zstandard module is installed) or {runNumber}.tar.gz.
+A new part is started when a container would be larger than maxContainerBytes.
+Since the members are appended and never rewritten, a single shower can be read with one seek:
+the container, the offset and the size of each run are stored in the campaign index
+(columns archive, archive_offset, archive_size) and in the text file bin_{part:04d}.tar.idx next to the container.
+
+The runs are compressed in parallel (multiprocessing Pool) into a staging folder, then appended to the containers
+by the main process only. The end of each container is kept (and read back from its .idx file), so a run is appended
+with one seek instead of a scan of all members. The run folder is removed once its container is written to disk and
+its state "archived" is committed to the index; runs whose folder no longer exists are skipped.
+
+With --watch the archiver runs next to the campaign: every --interval seconds it verifies the new output
+(see OutputVerifier) and archives what is verified, so that scratch usage stays bounded.
+
+How to run:
+    python3 -m utils.RunArchiver --dirSimulations /path/to/sims/ --dirArchive /path/to/archive/ --processes 8 --watch
+Reading a single shower back:
+    RunArchiver.extractRun(index, folder, destination)
+"""
+
+import gzip
+import io
+import multiprocessing as mp
+import os
+import shutil
+import tarfile
+import time
+
+from utils.CampaignIndex import CampaignIndex
+from utils.Logger import getLogger
+from utils.OutputVerifier import OutputVerifier
+
+logger = getLogger(__name__)
+
+
+def _zstandard():
+    # optional dependency, the runs are compressed with gzip without it
+    try:
+        import zstandard
+    except ImportError:
+        return None
+    return zstandard
+
+
+class RunArchiver:
+    """
+    Parameters:
+        index:              the CampaignIndex of the campaign
+        dirArchive:         the directory of the containers
+        processes:          number of parallel processes compressing the runs
+        maxContainerBytes:  size after which a new container of the bin is started
+        level:              compression level (zstd or gzip)
+        skipParticleFiles:  do not archive the particle files of the MPI sub-jobs (DAT{runNumber}/DAT{runNumber}-*)
+        keepFolders:        do not remove the run folders after archiving them
+    """
+
+    # runs archived between two commits of the index (their folders are removed after the commit)
+    commitEvery = 64
+
+    def __init__(self,
+                 index,
+                 dirArchive,
+                 processes=8,
+                 maxContainerBytes=50 * 1024**3,
+                 level=3,
+                 skipParticleFiles=False,
+                 keepFolders=False,
+    ):
+        self.index = index
+        self.dirArchive = dirArchive
+        self.processes = processes
+        self.maxContainerBytes = maxContainerBytes
+        self.level = level
+        self.skipParticleFiles = skipParticleFiles
+        self.keepFolders = keepFolders
+        self.staging = os.path.join(dirArchive, ".staging")
+        os.makedirs(self.staging, exist_ok=True)
+        self.suffix = ".tar.zst" if _zstandard() is not None else ".tar.gz"
+        # container: offset of its end-of-archive marker, where the next member is written
+        self.containerEnds = {}
+
+    @staticmethod
+    def compressRun(job):
+        """
+        Writes the run folder as a compressed tar file to the staging folder, returns (folder, blob file),
+        the blob is None if the folder disappeared in the meantime
+        """
+        folder, runNumber, blob, level, skipParticleFiles = job
+
+        def exclude(tarinfo):
+            name = os.path.basename(tarinfo.name)
+            if skipParticleFiles and name.startswith(f"DAT{runNumber}-"):
+                return None
+            return tarinfo
+
+        zstandard = _zstandard()
+        try:
+            with open(blob + ".tmp", "wb") as f:
+                if blob.endswith(".zst"):
+                    with zstandard.ZstdCompressor(level=level).stream_writer(f) as compressed:
+                        with tarfile.open(fileobj=compressed, mode="w|") as tar:
+                            tar.add(folder, arcname=runNumber, filter=exclude)
+                else:
+                    with gzip.GzipFile(fileobj=f, mode="wb", compresslevel=level) as compressed:
+                        with tarfile.open(fileobj=compressed, mode="w|") as tar:
+                            tar.add(folder, arcname=runNumber, filter=exclude)
+        except FileNotFoundError:
+            os.remove(blob + ".tmp")
+            return folder, None
+        os.replace(blob + ".tmp", blob)
+        return folder, blob
+
+    def container(self, primary, log10_E1, zenith_bin, size):
+        """
+        Returns the container of the bin where a member of the given size is appended
+        """
+        binDir = os.path.join(self.dirArchive, f"{primary}/{log10_E1}/{zenith_bin}")
+        os.makedirs(binDir, exist_ok=True)
+        part = 0
+        while True:
+            path = os.path.join(binDir, f"bin_{part:04d}.tar")
+            if not os.path.isfile(path) or os.path.getsize(path) + size <= self.maxContainerBytes:
+                return path
+            part += 1
+
+    def containerEnd(self, containerPath):
+        """
+        Returns the offset where the next member of the container is written (its end-of-archive marker)
+        """
+        if containerPath in self.containerEnds:
+            return self.containerEnds[containerPath]
+        end = 0
+        if os.path.isfile(containerPath + ".idx"):
+            # the data of the last member, padded to the tar block size
+            with open(containerPath + ".idx") as f:
+                lines = f.read().splitlines()
+            if lines:
+                _, offset, size, _ = lines[-1].split(" ", 3)
+                end = int(offset) + -(-int(size) // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+        elif os.path.isfile(containerPath):
+            # a container without .idx, scanned once
+            with tarfile.open(containerPath, mode="a") as tar:
+                end = tar.offset
+        self.containerEnds[containerPath] = end
+        return end
+
+    def append(self, containerPath, memberName, blob):
+        """
+        Appends the blob to the container, returns the offset and the size of its data in the container
+        """
+        tarinfo = tarfile.TarInfo(memberName)
+        tarinfo.size = os.path.getsize(blob)
+        tarinfo.mtime = int(time.time())
+        header = tarinfo.tobuf(tarfile.PAX_FORMAT, tarfile.ENCODING, "surrogateescape")
+        end = self.containerEnd(containerPath)
+        with open(containerPath, "r+b" if os.path.isfile(containerPath) else "wb") as f:
+            f.seek(end)
+            f.write(header)
+            # the data follows the header
+            offset = end + len(header)
+            with open(blob, "rb") as data:
+                shutil.copyfileobj(data, f, 16 * 1024**2)
+            f.write(b"\0" * (-tarinfo.size % tarfile.BLOCKSIZE))
+            self.containerEnds[containerPath] = f.tell()
+            # the end-of-archive marker, overwritten by the next member
+            f.write(b"\0" * (2 * tarfile.BLOCKSIZE))
+            f.truncate()
+            f.flush()
+            os.fsync(f.fileno())
+        return offset, tarinfo.size
+
+    def removeFolders(self, folders):
+        """
+        Commits the archived runs to the index, then removes their folders
+        """
+        self.index.flush()
+        if not self.keepFolders:
+            for folder in folders:
+                shutil.rmtree(folder, ignore_errors=True)
+        folders.clear()
+
+    def archive(self):
+        """
+        Archives all verified runs that are not archived yet. Returns the number of archived runs.
+        """
+        runs = self.index.getRuns(columns=("folder", "runNumber", "primary_particle", "log10_E1", "zenith_bin", "state"))
+        verified = self.index.getVerifiedFolders()
+        runs = {run[0]: run for run in runs if run[0] in verified and run[5] != "archived"}
+        missing = [folder for folder in runs if not os.path.isdir(folder)]
+        if missing:
+            logger.warning(f"Skipping {len(missing)} verified runs whose folder no longer exists, e.g. {missing[0]}")
+            for folder in missing:
+                del runs[folder]
+        if not runs:
+            return 0
+        logger.info(f"Archiving {len(runs)} runs with {self.processes} processes")
+
+        # the runNumber is not unique across the bins, so the staging files are numbered
+        jobs = [(folder, runNumber, os.path.join(self.staging, f"{i}_{runNumber}{self.suffix}"),
+                 self.level, self.skipParticleFiles)
+                for i, (folder, runNumber, *_) in enumerate(runs.values())]
+        nArchived = 0
+        archived = []
+        with mp.Pool(self.processes) as pool:
+            for folder, blob in pool.imap_unordered(self.compressRun, jobs):
+                if blob is None:
+                    logger.warning(f"Skipping {folder}, it disappeared while it was compressed")
+                    continue
+                _, runNumber, primary, log10_E1, zenith_bin, _ = runs[folder]
+                memberName = runNumber + self.suffix
+                containerPath = self.container(primary, log10_E1, zenith_bin, os.path.getsize(blob))
+                offset, size = self.append(containerPath, memberName, blob)
+                with open(containerPath + ".idx", "a") as f:
+                    f.write(f"{memberName} {offset} {size} {folder}\n")
+                os.remove(blob)
+
+                self.index.addRun(folder=folder, state="archived", archive=containerPath,
+                                  archive_offset=offset, archive_size=size)
+                archived.append(folder)
+                if len(archived) >= self.commitEvery:
+                    self.removeFolders(archived)
+                nArchived += 1
+        self.removeFolders(archived)
+        return nArchived
+
+    @staticmethod
+    def openRun(index, folder):
+        """
+        Returns the archived run of folder as an open tarfile, reading only its member of the container
+        """
+        rows = index.connection.execute(
+            "SELECT archive, archive_offset, archive_size FROM runs WHERE folder = ?", (folder,)
+        ).fetchall()
+        if not rows or rows[0][0] is None:
+            raise KeyError(f"{folder} is not archived")
+        return RunArchiver.openMember(*rows[0])
+
+    @staticmethod
+    def openMember(containerPath, offset, size):
+        """
+        Returns the run stored at offset (size bytes) of the container as an open tarfile
+        """
+        with open(containerPath, "rb") as f:
+            f.seek(offset)
+            data = f.read(size)
+        if data[:4] == b"\x28\xb5\x2f\xfd":
+            # magic number of a zstd frame
+            data = _zstandard().ZstdDecompressor().decompressobj().decompress(data)
+        else:
+            data = gzip.decompress(data)
+        return tarfile.open(fileobj=io.BytesIO(data), mode="r")
+
+    @classmethod
+    def extractRun(cls, index, folder, destination):
+        """
+        Extracts the archived run of folder to destination/{runNumber}
+        """
+        with cls.openRun(index, folder) as tar:
+            tar.extractall(destination, filter="data")
+
+    def watch(self, interval=600, processes=8):
+        """
+        Verifies and archives the new output every interval seconds, until interrupted
+        """
+        verifier = OutputVerifier(self.index, processes=processes)
+        while True:
+            verifier.verify()
+            nArchived = self.archive()
+            logger.info(f"{nArchived} runs archived, next check in {interval} s")
+            time.sleep(interval)
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    from utils.Logger import setupLogging
+
+    parser = argparse.ArgumentParser(
+        description="Packs the verified runs of a campaign into compressed containers per energy/zenith bin"
+    )
+    parser.add_argument(
+        "--dirSimulations",
+        type=str,
+        required=True,
+        help="Directory where the simulation are stored (with the campaign_index.sqlite)",
+    )
+    parser.add_argument(
+        "--dirArchive",
+        type=str,
+        required=True,
+        help="Directory of the containers",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=8,
+        help="number of parallel processes compressing (and verifying) the runs",
+    )
+    parser.add_argument(
+        "--maxContainerGB",
+        type=float,
+        default=50,
+        help="size in GB after which a new container of a bin is started",
+    )
+    parser.add_argument(
+        "--level",
+        type=int,
+        default=3,
+        help="compression level",
+    )
+    parser.add_argument(
+        "--skipParticleFiles",
+        action="store_true",
+        help="do not archive the particle files DAT??????-* of the MPI sub-jobs",
+    )
+    parser.add_argument(
+        "--keepFolders",
+        action="store_true",
+        help="do not remove the run folders after archiving them",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="keep running: verify and archive the new output every --interval seconds",
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=600,
+        help="seconds between two checks with --watch",
+    )
+    args = parser.parse_args()
+    setupLogging()
+
+    index = CampaignIndex(os.path.join(args.dirSimulations, "campaign_index.sqlite"))
+    archiver = RunArchiver(
+        index,
+        args.dirArchive,
+        processes=args.processes,
+        maxContainerBytes=int(args.maxContainerGB * 1024**3),
+        level=args.level,
+        skipParticleFiles=args.skipParticleFiles,
+        keepFolders=args.keepFolders,
+    )
+    try:
+        if args.watch:
+            archiver.watch(args.interval, args.processes)
+        else:
+            logger.info(f"{archiver.archive()} runs archived")
+    except KeyboardInterrupt:
+        logger.info("Archiver stopped")
+    finally:
+        index.close()
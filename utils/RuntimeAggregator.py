@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+
+"""
+This class collects the runtime statistics of the completed runs of a campaign,
+so that one can see where the core-hours go per energy/zenith bin.
+
+For every run in the campaign index it reads (in parallel, with a multiprocessing Pool)
+    DAT{runNumber}/corsika_timetable-*  (moved there by the .sub epilogue)
+        one line per sub-shower job of the MPI runner (mpi_runner.c of the parallel CORSIKA).
+        The layout is assumed to be whitespace separated columns with the MPI rank of the job in the first
+        column and its start and end time in seconds in the last two (timetableColumns = (0, -2, -1));
+        lines that do not parse (headers, comments) are skipped. Check it against the mpi_runner.c of the
+        corsika version used and give other columns with --timetableColumns if it differs.
+        From them: wall time, busy (CPU) time per rank and the MPI load balance
+        (mean busy time / max busy time, 1 is perfect).
+    SIM{runNumber}.sub
+        the allocation of the job (#SBATCH --nodes, --ntasks-per-node, --cpus-per-task): the core-hours are
+        the wall time times the allocated cores, whether the ranks were busy or not.
+        Without the .sub, the number of ranks in the timetables is used.
+    DAT{runNumber}.long
+        the particle numbers at the observation level (last step of the longitudinal table)
+        and the maximum number of charged particles
+    DAT{runNumber}.time
+        "Maximum resident set size" written by /usr/bin/time -v in the .sub file (memory peak per process)
+    DAT{runNumber}.log
+        the "TIME NEEDED FOR THIS SHOWER" of corsika, if present
+
+Missing files give NaN in the corresponding columns.
+The result is a columnar table (one numpy array per column, keyed by the run folder and runNumber),
+stored as .npz, and the wall and core-hours are written back to the campaign index.
+
+How to run:
+    python3 -m utils.RuntimeAggregator --dirSimulations /path/to/sims/ --processes 16
+"""
+
+import glob
+import multiprocessing as mp
+import os
+import re
+
+import numpy as np
+
+from utils.CampaignIndex import CampaignIndex
+from utils.Logger import getLogger
+
+logger = getLogger(__name__)
+
+# particle columns of the longitudinal table in the .long file
+LONG_COLUMNS = ["gammas", "positrons", "electrons", "mu_plus", "mu_minus", "hadrons", "charged", "nuclei"]
+
+TIME_NEEDED = re.compile(r"TIME NEEDED FOR THIS SHOWER\s*=?\s*([-+0-9.Ee]+)")
+MAX_RSS = re.compile(r"Maximum resident set size \(kbytes\):\s*(\d+)")
+SBATCH = re.compile(r"^#SBATCH\s+--(nodes|ntasks-per-node|cpus-per-task)=(\d+)", re.MULTILINE)
+
+
+class RuntimeAggregator:
+    """
+    Parameters:
+        index:          the CampaignIndex of the campaign
+        processes:      number of parallel processes used to read the files
+    """
+
+    # column of the rank, the start and the end time in the corsika_timetable files
+    timetableColumns = (0, -2, -1)
+
+    # the columns of the table, apart from folder and runNumber
+    statColumns = ["wall_hours", "core_hours", "allocated_cores", "n_ranks", "rank_busy_mean_hours", "rank_busy_max_hours",
+                   "load_balance", "corsika_time_s", "max_rss_mb", "max_charged"] \
+                  + [f"ground_{name}" for name in LONG_COLUMNS]
+
+    def __init__(self, index, processes=8):
+        self.index = index
+        self.processes = processes
+
+    @classmethod
+    def readTimetables(cls, datDir):
+        """
+        Returns the wall hours, the number of ranks, and the busy hours per rank from the corsika_timetable files
+        """
+        rankColumn, startColumn, endColumn = cls.timetableColumns
+        ranks, starts, ends = [], [], []
+        for fileName in glob.glob(f"{datDir}/corsika_timetable-*"):
+            with open(fileName) as f:
+                for line in f:
+                    fields = line.split()
+                    try:
+                        rank, start, end = int(float(fields[rankColumn])), float(fields[startColumn]), float(fields[endColumn])
+                    except (ValueError, IndexError):
+                        # header or comment lines
+                        continue
+                    ranks.append(rank)
+                    starts.append(start)
+                    ends.append(end)
+        if not ranks:
+            return np.nan, 0, np.zeros(0)
+
+        ranks, starts, ends = np.array(ranks), np.array(starts), np.array(ends)
+        if np.mean(ends < starts) > 0.5:
+            logger.warning(f"Most jobs in {datDir} end before they start, the timetable columns {cls.timetableColumns} "
+                           f"do not seem to match the format of this corsika version (see --timetableColumns)")
+        _, rankIndex = np.unique(ranks, return_inverse=True)
+        busy = np.bincount(rankIndex, weights=ends - starts) / 3600.
+        return (ends.max() - starts.min()) / 3600., len(busy), busy
+
+    @staticmethod
+    def readLong(longFile):
+        """
+        Returns the particles at the observation level (last step of the first table) and the maximum of charged particles
+        """
+        ground = np.full(len(LONG_COLUMNS), np.nan)
+        maxCharged = np.nan
+        if not os.path.isfile(longFile):
+            return ground, maxCharged
+
+        rows = []
+        with open(longFile) as f:
+            inTable = False
+            for line in f:
+                if "DEPTH" in line and "GAMMAS" in line:
+                    inTable = True
+                    continue
+                if inTable:
+                    try:
+                        rows.append([float(value) for value in line.split()[1:1 + len(LONG_COLUMNS)]])
+                    except ValueError:
+                        # end of the particle table (the energy deposit table follows)
+                        break
+        rows = [row for row in rows if len(row) == len(LONG_COLUMNS)]
+        if rows:
+            rows = np.array(rows)
+            ground = rows[-1]
+            maxCharged = rows[:, LONG_COLUMNS.index("charged")].max()
+        return ground, maxCharged
+
+    @staticmethod
+    def readAllocation(subFile):
+        """
+        Returns the number of cores allocated by the job script (nodes x tasks per node x cpus per task), NaN without it
+        """
+        if not os.path.isfile(subFile):
+            return np.nan
+        with open(subFile, errors="replace") as f:
+            options = dict(SBATCH.findall(f.read()))
+        if "ntasks-per-node" not in options:
+            return np.nan
+        return float(int(options.get("nodes", 1)) * int(options["ntasks-per-node"]) * int(options.get("cpus-per-task", 1)))
+
+    @staticmethod
+    def searchFile(fileName, pattern):
+        if not os.path.isfile(fileName):
+            return np.nan
+        with open(fileName, errors="replace") as f:
+            match = pattern.search(f.read())
+        return float(match.group(1)) if match else np.nan
+
+    @classmethod
+    def readRun(cls, folderRunNumber):
+        """
+        Reads the statistics of a single run, returns a list with the values of statColumns
+        """
+        folder, runNumber = folderRunNumber
+        wallHours, nRanks, busy = cls.readTimetables(f"{folder}/DAT{runNumber}")
+        ground, maxCharged = cls.readLong(f"{folder}/DAT{runNumber}.long")
+        maxRss = cls.searchFile(f"{folder}/DAT{runNumber}.time", MAX_RSS) / 1024.
+        corsikaTime = cls.searchFile(f"{folder}/DAT{runNumber}.log", TIME_NEEDED)
+        allocatedCores = cls.readAllocation(f"{folder}/SIM{runNumber}.sub")
+
+        if nRanks:
+            # all allocated cores are charged for the whole wall time
+            coreHours = wallHours * (allocatedCores if np.isfinite(allocatedCores) else nRanks)
+            busyMean, busyMax = busy.mean(), busy.max()
+            loadBalance = busyMean / busyMax if busyMax > 0 else np.nan
+        else:
+            coreHours = busyMean = busyMax = loadBalance = np.nan
+        return [wallHours, coreHours, allocatedCores, nRanks, busyMean, busyMax, loadBalance, corsikaTime, maxRss, maxCharged, *ground]
+
+    def aggregate(self, state=None):
+        """
+        Reads all runs of the index (optionally only the ones in the given state) in parallel.
+        Returns the table as a dictionary of numpy arrays.
+        """
+        runs = self.index.getRuns(state=state, columns=("folder", "runNumber", "log10_E1", "zenith_bin"))
+        table = {
+            "folder":       np.array([run[0] for run in runs], dtype=str),
+            "runNumber":    np.array([run[1] for run in runs], dtype=str),
+            "log10_E1":     np.array([run[2] for run in runs], dtype=float),
+            "zenith_bin":   np.array([run[3] for run in runs], dtype=float),
+        }
+        with mp.Pool(self.processes) as pool:
+            stats = pool.map(self.readRun, [(run[0], run[1]) for run in runs], chunksize=64)
+        stats = np.array(stats, dtype=float).reshape(len(runs), len(self.statColumns))
+        for i, column in enumerate(self.statColumns):
+            table[column] = stats[:, i]
+
+        # the measured times go to the index, for the status and the cost models
+        for folder, wallHours, coreHours in zip(table["folder"], table["wall_hours"], table["core_hours"]):
+            if np.isfinite(coreHours):
+                self.index.addRun(folder=str(folder), wall_hours=float(wallHours), core_hours=float(coreHours))
+        self.index.flush()
+        return table
+
+    @staticmethod
+    def save(table, fileName):
+        np.savez(fileName, **table)
+
+    @staticmethod
+    def printBinSummary(table):
+        """
+        Prints the number of measured runs, the core-hours and the load balance per energy/zenith bin
+        """
+        print(f"{'log10_E':>8} {'zenith':>7} {'runs':>7} {'core-hours':>12} {'mean wall h':>12} {'load balance':>13} {'max RSS MB':>11}")
+        bins = np.stack([table["log10_E1"], table["zenith_bin"]], axis=1)
+        for log10_E1, zenith_bin in np.unique(bins, axis=0):
+            mask = (bins[:, 0] == log10_E1) & (bins[:, 1] == zenith_bin) & np.isfinite(table["core_hours"])
+            if not mask.any():
+                continue
+            print(f"{log10_E1:>8.1f} {zenith_bin:>7.1f} {mask.sum():>7d} {table['core_hours'][mask].sum():>12.1f} "
+                  f"{table['wall_hours'][mask].mean():>12.2f} {np.nanmean(table['load_balance'][mask]):>13.2f} "
+                  f"{np.nanmax(table['max_rss_mb'][mask]) if np.isfinite(table['max_rss_mb'][mask]).any() else np.nan:>11.0f}")
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Collects the CORSIKA/CoREAS runtime statistics of a campaign"
+    )
+    parser.add_argument(
+        "--dirSimulations",
+        type=str,
+        required=True,
+        help="Directory where the simulation are stored (with the campaign_index.sqlite)",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        default=None,
+        help="the .npz file of the table, default is runtime_stats.npz in dirSimulations",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=8,
+        help="number of parallel processes reading the files",
+    )
+    parser.add_argument(
+        "--timetableColumns",
+        type=int,
+        nargs=3,
+        default=list(RuntimeAggregator.timetableColumns),
+        help="columns of the rank, the start and the end time in the corsika_timetable files (negative: from the end)",
+    )
+    args = parser.parse_args()
+    RuntimeAggregator.timetableColumns = tuple(args.timetableColumns)
+
+    index = CampaignIndex(os.path.join(args.dirSimulations, "campaign_index.sqlite"))
+    aggregator = RuntimeAggregator(index, processes=args.processes)
+    table = aggregator.aggregate()
+    aggregator.save(table, args.output or os.path.join(args.dirSimulations, "runtime_stats.npz"))
+    aggregator.printBinSummary(table)
+    index.close()
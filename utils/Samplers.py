@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+
+"""
+Samplers of the shower parameters (energy, zenith, azimuth), as an alternative to the fixed grid of SimulationMaker.buildPlan.
+
+A ParameterSampler draws nShowers points of the unit cube with one of the designs
+    random      independent uniform numbers
+    lhs         Latin hypercube: each of the nShowers strata of each dimension is used exactly once
+    sobol       Sobol low-discrepancy sequence (digitally shifted with the seed), best with a power of 2 showers
+and maps them to the parameters with
+    energy      uniform in log10 E (spectralIndex None), or a continuous power law dN/dE ~ E^-spectralIndex
+    zenith      uniform in cos(zenith) (like the grid), sincos (dN ~ sin cos dzenith, isotropic flux through a flat ground)
+                or uniform in zenith
+    azimuth     uniform in [0, 360)
+
+The result is a plan in the same format as SimulationMaker.buildPlan, so the folders stay grouped by energy and zenith bin:
+    log10_E1 and zenith_bin are the lower edges of the bin of each run, log10_E and zenith the sampled values.
+Each run also gets a weight, the phase space (log10 GeV x sr) it stands for: 1 / (nBin * pdf(log10_E, solid angle)),
+with the pdf restricted to its energy/zenith bin and the nBin runs of the bin, so that the weights of a bin add up to
+(an estimate of) its phase space. It is the same weight as the grid (the phase space of the bin divided by its runs)
+and the follow-up runs of AdaptiveSampler, which reweights the runs of a bin when it adds runs to it.
+Summing the weights times a flux over a set of runs gives the expected rate, for any flux.
+The runIndex of a run counts the runs of its bin, so a bin can get at most MAX_RUN_INDEX runs (see runNumberGenerator.py):
+a plan with more raises a ValueError, use fewer showers (--nShowers) or narrower bins.
+"""
+
+import numpy as np
+
+from utils.runNumberGenerator import MAX_RUN_INDEX
+
+DESIGNS = ("random", "lhs", "sobol")
+ZENITH_DISTRIBUTIONS = ("cos", "sincos", "uniform")
+
+# Primitive polynomials and initial direction numbers (Joe & Kuo) of the dimensions 2 and 3 of the Sobol sequence.
+# The first dimension is the van der Corput sequence in base 2.
+SOBOL_PARAMETERS = [
+    (1, 0, [1]),        # degree s, coefficients a, initial m
+    (2, 1, [1, 3]),
+]
+SOBOL_BITS = 30
+
+
+def _sobolDirections(s, a, m):
+    """
+    Returns the SOBOL_BITS direction numbers of one dimension, as integers scaled by 2^SOBOL_BITS
+    """
+    m = list(m)
+    for i in range(s, SOBOL_BITS):
+        value = m[i - s] ^ (m[i - s] << s)
+        for k in range(1, s):
+            value ^= ((a >> (s - 1 - k)) & 1) * (m[i - k] << k)
+        m.append(value)
+    return np.array([m[i] << (SOBOL_BITS - 1 - i) for i in range(SOBOL_BITS)], dtype=np.int64)
+
+
+def unitSobol(n, dimensions=3, rng=None):
+    """
+    The first n points of the Sobol sequence in up to 3 dimensions, digitally shifted (XOR) with random numbers of rng
+    """
+    if dimensions > 1 + len(SOBOL_PARAMETERS):
+        raise ValueError(f"The Sobol sequence is implemented for up to {1 + len(SOBOL_PARAMETERS)} dimensions")
+    directions = [np.array([1 << (SOBOL_BITS - 1 - i) for i in range(SOBOL_BITS)], dtype=np.int64)]
+    directions += [_sobolDirections(*parameters) for parameters in SOBOL_PARAMETERS]
+
+    index = np.arange(n, dtype=np.int64)
+    points = np.zeros((n, dimensions), dtype=np.int64)
+    for dimension in range(dimensions):
+        for bit in range(SOBOL_BITS):
+            points[:, dimension] ^= ((index >> bit) & 1) * directions[dimension][bit]
+    if rng is not None:
+        points ^= rng.integers(0, 1 << SOBOL_BITS, size=dimensions, dtype=np.int64)
+    return points / float(1 << SOBOL_BITS)
+
+
+def unitLatinHypercube(n, dimensions=3, rng=None):
+    rng = rng or np.random.default_rng()
+    strata = np.stack([rng.permutation(n) for _ in range(dimensions)], axis=1)
+    return (strata + rng.random((n, dimensions))) / n
+
+
+def unitRandom(n, dimensions=3, rng=None):
+    rng = rng or np.random.default_rng()
+    return rng.random((n, dimensions))
+
+
+UNIT_DESIGNS = {
+    "random":   unitRandom,
+    "lhs":      unitLatinHypercube,
+    "sobol":    unitSobol,
+}
+
+
+def binWeights(binPdf, nBin):
+    """
+    Returns the weights of the runs of a bin: its phase space shared by its nBin runs, 1 / (nBin * pdf in the bin)
+    """
+    return 1. / (nBin * np.asarray(binPdf, dtype=float))
+
+
+class ParameterSampler:
+    """
+    Parameters:
+        energies:           the edges of the energy bins in log10 GeV (as for the grid), the range is energies[0] ... energies[-1]
+        zenithEdges:        the edges of the zenith bins in degrees (see SimulationMaker.getZenithEdges)
+        design:             random, lhs or sobol
+        spectralIndex:      dN/dE ~ E^-spectralIndex, None is uniform in log10 E
+        zenithDistribution: cos, sincos or uniform
+        seed:               seed of the random numbers, None is a different plan every time
+    """
+
+    def __init__(self,
+                 energies,
+                 zenithEdges,
+                 design="lhs",
+                 spectralIndex=None,
+                 zenithDistribution="cos",
+                 seed=None,
+    ):
+        if design not in UNIT_DESIGNS:
+            raise ValueError(f"Unknown sampling design {design}, use one of {', '.join(DESIGNS)}")
+        if zenithDistribution not in ZENITH_DISTRIBUTIONS:
+            raise ValueError(f"Unknown zenith distribution {zenithDistribution}, use one of {', '.join(ZENITH_DISTRIBUTIONS)}")
+        self.energies = np.asarray(energies, dtype=float)
+        self.zenithEdges = np.asarray(zenithEdges, dtype=float)
+        self.design = design
+        self.spectralIndex = spectralIndex
+        self.zenithDistribution = zenithDistribution
+        self.rng = np.random.default_rng(seed)
+
+    def energyPdf(self, log10_E, lMin, lMax):
+        """
+        Returns the pdf per unit of log10 E at log10_E of the energies drawn in [lMin, lMax]
+        """
+        log10_E = np.asarray(log10_E, dtype=float)
+        gamma = self.spectralIndex
+        if gamma is None or gamma == 1:
+            return np.full(log10_E.shape, 1. / (lMax - lMin))
+        # the pdf in log10 E is ln(10) E pdf(E)
+        k = 1. - gamma
+        energy = 10**log10_E
+        return np.log(10) * energy * energy**-gamma * k / ((10**lMax)**k - (10**lMin)**k)
+
+    def sampleEnergies(self, u, lMin=None, lMax=None):
+        """
+        Maps uniform numbers to log10 E in [lMin, lMax] (default the whole range), returns log10 E and its pdf
+        (per unit of log10 E)
+        """
+        lMin = self.energies[0] if lMin is None else lMin
+        lMax = self.energies[-1] if lMax is None else lMax
+        gamma = self.spectralIndex
+        if gamma is None or gamma == 1:
+            log10_E = lMin + u * (lMax - lMin)
+        else:
+            # inverse transform of E^-gamma
+            k = 1. - gamma
+            eMin, eMax = 10**lMin, 10**lMax
+            log10_E = np.log10((eMin**k + u * (eMax**k - eMin**k))**(1. / k))
+        return log10_E, self.energyPdf(log10_E, lMin, lMax)
+
+    def zenithPdf(self, zenith, zMin, zMax):
+        """
+        Returns the pdf per solid angle (sr^-1) at zenith (degrees) of the zenith angles drawn in [zMin, zMax] (degrees)
+        (the azimuth is uniform, so the 2 pi is included)
+        """
+        zenith = np.deg2rad(np.asarray(zenith, dtype=float))
+        zMin, zMax = np.deg2rad(zMin), np.deg2rad(zMax)
+        if self.zenithDistribution == "cos":
+            return np.full(zenith.shape, 1. / (2 * np.pi * (np.cos(zMin) - np.cos(zMax))))
+        if self.zenithDistribution == "sincos":
+            return np.cos(zenith) / (np.pi * (np.sin(zMax)**2 - np.sin(zMin)**2))
+        return 1. / (2 * np.pi * (zMax - zMin) * np.sin(zenith))
+
+    def sampleZeniths(self, u, zMin=None, zMax=None):
+        """
+        Maps uniform numbers to zenith angles in degrees in [zMin, zMax] (default the whole range),
+        returns the zenith and the pdf per solid angle (sr^-1)
+        """
+        zMin = self.zenithEdges[0] if zMin is None else zMin
+        zMax = self.zenithEdges[-1] if zMax is None else zMax
+        zMinRad, zMaxRad = np.deg2rad(zMin), np.deg2rad(zMax)
+        if self.zenithDistribution == "cos":
+            zenith = np.arccos(np.cos(zMinRad) + u * (np.cos(zMaxRad) - np.cos(zMinRad)))
+        elif self.zenithDistribution == "sincos":
+            # uniform in sin^2
+            zenith = np.arcsin(np.sqrt(np.sin(zMinRad)**2 + u * (np.sin(zMaxRad)**2 - np.sin(zMinRad)**2)))
+        else:
+            zenith = zMinRad + u * (zMaxRad - zMinRad)
+        zenith = np.rad2deg(zenith)
+        return zenith, self.zenithPdf(zenith, zMin, zMax)
+
+    def binPdf(self, log10_E, zenith, log10_E1, zenith_bin):
+        """
+        Returns the pdf (per log10 GeV x sr) of the runs at log10_E and zenith, restricted to their bins
+        (the lower edges log10_E1 and zenith_bin)
+        """
+        log10_E2 = self.upperEdges(log10_E1, self.energies)
+        zenith2 = self.upperEdges(zenith_bin, self.zenithEdges)
+        return self.energyPdf(log10_E, log10_E1, log10_E2) * self.zenithPdf(zenith, zenith_bin, zenith2)
+
+    def sampleBin(self, n, log10_E1, zenith_bin):
+        """
+        Draws n runs from the distributions of the sampler restricted to a bin (the lower edges log10_E1 and zenith_bin),
+        with uniform random numbers. Returns log10 E, the zenith (rounded like buildPlan) and the azimuth.
+        """
+        log10_E2 = self.upperEdges(log10_E1, self.energies)
+        zenith2 = self.upperEdges(zenith_bin, self.zenithEdges)
+        u = self.rng.random((n, 3))
+        log10_E, _ = self.sampleEnergies(u[:, 0], log10_E1, log10_E2)
+        zenith, _ = self.sampleZeniths(u[:, 1], zenith_bin, zenith2)
+        return log10_E, np.round(zenith, 2), np.round(360. * u[:, 2], 2) % 360.
+
+    @staticmethod
+    def upperEdges(lowerEdges, edges):
+        """
+        Returns the upper edge of the bins with the given lower edges (the closest edge, e.g. of a rounded value)
+        """
+        lowerEdges = np.asarray(lowerEdges, dtype=float)
+        index = np.abs(edges[:-1] - lowerEdges[..., np.newaxis]).argmin(axis=-1)
+        return edges[index + 1]
+
+    @staticmethod
+    def binEdges(values, edges):
+        """
+        Returns the lower edge of the bin of each value (the last bin includes its upper edge)
+        """
+        index = np.clip(np.searchsorted(edges, values, side="right") - 1, 0, len(edges) - 2)
+        return edges[index]
+
+    def buildPlan(self, nShowers, startNumber=0):
+        """
+        Returns a plan of nShowers runs (see SimulationMaker.buildPlan), ordered by energy and zenith bin
+        """
+        u = UNIT_DESIGNS[self.design](nShowers, 3, self.rng)
+        log10_E, _ = self.sampleEnergies(u[:, 0])
+        zenith, _ = self.sampleZeniths(u[:, 1])
+        # rounded like the azimuth, so that the runNumberGenerator finds their category
+        zenith = np.round(zenith, 2)
+
+        plan = {
+            "log10_E1":     self.binEdges(log10_E, self.energies),
+            "zenith_bin":   self.binEdges(zenith, self.zenithEdges),
+            "zenith":       zenith,
+            "azimuth":      np.round(360. * u[:, 2], 2) % 360.,
+            "log10_E":      log10_E,
+        }
+        order = np.lexsort((plan["zenith_bin"], plan["log10_E1"]))
+        plan = {key: values[order] for key, values in plan.items()}
+
+        # runIndex counts the runs of each energy and zenith bin, as in the grid
+        newBin = np.ones(nShowers, dtype=bool)
+        newBin[1:] = (np.diff(plan["log10_E1"]) != 0) | (np.diff(plan["zenith_bin"]) != 0)
+        binStart = np.maximum.accumulate(np.where(newBin, np.arange(nShowers), 0))
+        plan["runIndex"] = startNumber + np.arange(nShowers) - binStart
+        nBin = np.bincount(binStart, minlength=nShowers)[binStart]
+        plan["weight"] = binWeights(self.binPdf(plan["log10_E"], plan["zenith"], plan["log10_E1"], plan["zenith_bin"]), nBin)
+        if nShowers and plan["runIndex"].max() >= MAX_RUN_INDEX:
+            full = plan["runIndex"] >= MAX_RUN_INDEX
+            raise ValueError(f"The plan of {nShowers} showers has more than {MAX_RUN_INDEX - startNumber} runs in the bin "
+                             f"log10_E={plan['log10_E1'][full][0]} zenith={plan['zenith_bin'][full][0]}, the runIndex "
+                             f"would not fit in the runNumber (see runNumberGenerator.py), use fewer showers")
+        return plan
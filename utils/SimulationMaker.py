@@ -21,8 +21,13 @@ import numpy as np
 import random
 import os
 import stat
-from utils.runNumberGenerator import runNumberGenerator
+import time
+from utils.runNumberGenerator import MAX_RUN_INDEX, runNumberGenerator
 import sys
+from utils.Logger import getLogger, ProgressTracker
+from utils.StageTimer import timer
+
+logger = getLogger(__name__)
 
 class SimulationMaker:
     """
@@ -38,6 +43,11 @@ class SimulationMaker:
         fW:             the file writer class. In order to use some of the functions in this class
         pathCorsika:    the path where Corsika is installed
         corsikaExe:     the name of the Corsika executable that needs to be used
+        index:          the CampaignIndex where the written runs are recorded (optional)
+        site:           the name of the site, for the keys and the index of a multi-site campaign (optional)
+        sampling:       the keyword arguments of a ParameterSampler (design, spectralIndex, zenithDistribution, seed),
+                        which draws the runs instead of the fixed grid (see Samplers.py). None is the fixed grid
+        nShowers:       number of showers drawn by the sampler, default is the number of runs of the grid
     
     """
     def __init__(self, 
@@ -51,6 +61,10 @@ class SimulationMaker:
                  zenithEnd,
                  primary_particle,
                  directory,
+                 index=None,
+                 site=None,
+                 sampling=None,
+                 nShowers=None,
     ):
         
         self.startNumber = startNumber
@@ -64,13 +78,130 @@ class SimulationMaker:
         self.primary_particle = primary_particle
         self.runNumGen = runNumberGenerator()
         self.directory = directory
+        self.index = index
+        self.site = site
+        self.nShowers = nShowers
+        self.sampler = None
+        if sampling is not None:
+            # imported only when used, to keep the startup of the driver fast
+            from utils.Samplers import ParameterSampler
+            self.sampler = ParameterSampler(self.energies, self.getZenithEdges(), **sampling)
+        self.verifiedFolders = set()
+        # the plan of the follow-up runs of an adaptive campaign (see AdaptiveSampler.followUpPlan), None: the full plan
+        self.followUp = None
+
+
+
+    def getZenithEdges(self):
+        """
+        Returns the edges of the zenith bins, 2.5 degrees wide
+        """
+        return np.around(np.arange(self.zenithStart, self.zenithEnd + 0.1, 2.5), decimals=1)
+
+
+    def getZenithValues(self):
+        """
+        Yields the zenith bins and the zenith values simulated in each bin.
+        The bins are 2.5 degrees wide, each split into 10 values uniform in cos(zenith).
+        The last bin also includes its upper edge.
+        """
+        # Zenith angle range
+        zenith_range = self.getZenithEdges()
+        # Number of additional values per step
+        intervals = 10
+        for i, (zenith_start, zenith_end) in enumerate(zip(zenith_range[:-1], zenith_range[1:])):
+            # Calculate cosine values for the current step
+            cstart = 1 -np.cos(np.deg2rad(zenith_start))
+            cend = 1 - np.cos(np.deg2rad(zenith_end))
+            cos_value = np.linspace(cstart, cend, intervals, endpoint=False)
+            all_zenith_values = np.rad2deg(np.arccos(1-cos_value))
+            if i==(len(zenith_range)-2):
+                all_zenith_values = np.append(all_zenith_values, zenith_end)
+            yield zenith_start, all_zenith_values
+
 
+    def buildPlan(self):
+        """
+        Builds the full plan of the runs without touching the disk.
+        The plan is a dictionary of numpy arrays, one entry per run, in the order of the generator:
+            log10_E1:   lower edge of the energy bin in log10 GeV
+            zenith_bin: lower edge of the zenith bin (used for the folder structure)
+            zenith:     zenith angle of the run
+            azimuth:    random azimuth angle of the run
+            runIndex:   index of the run in its energy/zenith bin. On the grid, the run r (startNumber ... endNumber-1)
+                        of the zenith value j of a bin with nZ zenith values has runIndex r * nZ + j, so that the runs of
+                        a bin, also of separate calls with other start/endNumber, have different runNumbers and folders
+            log10_E:    energy of the run in log10 GeV (the same as log10_E1 for the grid)
+            weight:     phase space of the run in log10 GeV x sr (see Samplers.py)
+            primary:    the primary particle (the same for all runs, for plans merged with mergePlans)
+            site:       the name of the site (the same for all runs)
+        With a sampler, the energies, zeniths and azimuths are drawn by the sampler instead.
+        With a follow-up plan (adaptive sampling), it is the plan.
+        """
+        if self.followUp is not None:
+            return self.followUp
+        if self.sampler is not None:
+            nShowers = self.nShowers or self.gridSize()
+            plan = self.sampler.buildPlan(nShowers, self.startNumber)
+            plan["primary"] = np.full(nShowers, self.primary_particle)
+            plan["site"] = np.full(nShowers, self.site or "")
+            return plan
+
+        runs = np.arange(self.startNumber, self.endNumber)
+        nRuns = len(runs)
+        zenithBins, zeniths, binSolidAngles, runIndices = [], [], [], []
+        for zenith_start, all_zenith_values in self.getZenithValues():
+            nZ = len(all_zenith_values)
+            if nRuns and runs[-1] * nZ + nZ - 1 >= MAX_RUN_INDEX:
+                # before anything is written, the runs of the bin have to fit in the runIndex of the runNumber
+                raise ValueError(f"The zenith bin {zenith_start} has {nZ} zenith values, with the runs {self.startNumber}-"
+                                 f"{self.endNumber - 1} of each its runIndex goes up to {self.endNumber * nZ - 1}, but a bin "
+                                 f"can have at most {MAX_RUN_INDEX} runs (endNumber at most {MAX_RUN_INDEX // nZ})")
+            zenithBins.append(np.full(nZ, zenith_start))
+            zeniths.append(all_zenith_values)
+            runIndices.append((runs[None, :] * nZ + np.arange(nZ)[:, None]).ravel())
+            # solid angle of the bin, shared by its zenith values
+            solidAngle = 2 * np.pi * (np.cos(np.deg2rad(zenith_start)) - np.cos(np.deg2rad(zenith_start + 2.5)))
+            binSolidAngles.append(np.full(len(all_zenith_values), solidAngle / len(all_zenith_values)))
+        zenithBins = np.concatenate(zenithBins) if zenithBins else np.zeros(0)
+        zeniths = np.concatenate(zeniths) if zeniths else np.zeros(0)
+        binSolidAngles = np.concatenate(binSolidAngles) if binSolidAngles else np.zeros(0)
+        runIndices = np.concatenate(runIndices) if runIndices else np.zeros(0, dtype=int)
+
+        # This is a loop over all energies and gives the low and high limit values.
+        # Eg. 5.0 and 5.1, so the last energy is only used as upper limit
+        energies = np.asarray(self.energies[:-1])
+
+        plan = {
+            "log10_E1":     np.repeat(energies, len(zeniths) * nRuns),
+            "zenith_bin":   np.tile(np.repeat(zenithBins, nRuns), len(energies)),
+            "zenith":       np.tile(np.repeat(zeniths, nRuns), len(energies)),
+            "runIndex":     np.tile(runIndices, len(energies)),
+        }
+        # Get random azimuth
+        plan["azimuth"] = np.round(np.random.uniform(0, 360, len(plan["runIndex"])), 2)
+        plan["log10_E"] = plan["log10_E1"]
+        # the phase space of each bin (log10 GeV x sr), shared by the runs of the bin
+        energyWidths = np.diff(np.asarray(self.energies, dtype=float))
+        plan["weight"] = (np.repeat(energyWidths, len(zeniths) * nRuns)
+                          * np.tile(np.repeat(binSolidAngles, nRuns), len(energies)) / max(nRuns, 1))
+        plan["primary"] = np.full(len(plan["runIndex"]), self.primary_particle)
+        plan["site"] = np.full(len(plan["runIndex"]), self.site or "")
+        return plan
+
+
+    def gridSize(self):
+        """
+        Returns the number of runs of the fixed grid
+        """
+        nZeniths = sum(len(values) for _, values in self.getZenithValues())
+        return (len(self.energies) - 1) * nZeniths * (self.endNumber - self.startNumber)
 
 
     def generator(self):
         """
         This function generates configurations for simulations with various energies, zenith angles, and azimuth angles. 
-        It iterates through all possible combinations and yields a unique key and a string 
+        It iterates through all possible combinations (see buildPlan) and yields a unique key and a string 
         required for submitting each simulation job.
 
         The folder structure for the simulations is created as:
@@ -78,63 +209,94 @@ class SimulationMaker:
 
         Each run will have its own folder within the specified energy and zenith angle subdirectories.
         """
-        print("Conjuring energies in log10 GeV of", self.energies)
+        logger.info(f"Conjuring energies in log10 GeV of {self.energies}")
+        logger.info(f"zenith range {self.zenithStart} {self.zenithEnd}")
 
-        # Zenith angle range
-        zenith_range = np.around(np.arange(self.zenithStart, self.zenithEnd + 0.1, 2.5), decimals=1)
-        # Number of additional values per step
-        intervals = 10
-        # Initialize empty list for all zenith values
-        all_zenith_values = []
-        print("zenith range", zenith_range[0], zenith_range[-1])
-            
-            # This is a loop over all energies and gives the low and high limit values.
-            # Eg. 5.0 and 5.1
-        for log10_E1, log10_E2 in zip(self.energies[:-1], self.energies[1:]):
-                # Calculate cosine values for the current step
-            for i, (zenith_start, zenith_end) in enumerate(zip(zenith_range[:-1], zenith_range[1:])):
-                cstart = 1 -np.cos(np.deg2rad(zenith_start))
-                cend = 1 - np.cos(np.deg2rad(zenith_end))
-                cos_value = np.linspace(cstart, cend, intervals, endpoint=False)
-                all_zenith_values = (list(np.rad2deg(np.arccos(1-cos_value))))
-                if i==(len(zenith_range)-2):
-                    all_zenith_values.append(zenith_end)
-
-                for zenith in all_zenith_values:
-                    print(zenith)
-                    # loop over all the unique numbers 
-                    for runIndex in range(self.startNumber, self.endNumber, 1):
-                        #! zenith loop here
-                        # Get the next azimuth value from the list
-                        print("SimMaker using zenith", zenith)
-
-                        #! random azimuth here
-                        # Get random azimuth
-                        azimuth = round(random.uniform(0, 360), 2)
-                        print("SimMaker using azimuth", azimuth)
-
-                        # print runIndex (as double check)
-                        print("runIndex", runIndex)
-
-                        # Create the file name (runNumber) for the simulation
-                        particleID = self.runNumGen.getPrimaryID(self.primary_particle)
-                        zenithID = self.runNumGen.getZenithID(zenith)
-                        azimuthID = self.runNumGen.getAzimuthID(azimuth)
-                        energyID = self.runNumGen.getEnergyID(log10_E1)
-                        runNumber = format(int(particleID * 1E5 + zenithID * 1E4 + azimuthID * 1E3 + energyID * 1E2 + runIndex), '06d')
-                        print("runNumber", runNumber)
-
-                        # Create folders with the structure: primary_particle/energy/theta/runNumber/<files>
-                        folder_path = os.path.join(f"{self.directory}{self.primary_particle}/{log10_E1}/{zenith_start}/{runNumber}/")
-                        os.makedirs(folder_path, exist_ok=True)  # Create folders if they don't already exist
-
-                        # Check if the simulation already exists
-                        if f"SIM{runNumber}_coreas" not in os.listdir(folder_path):
-                            # Write Corsika input file and generate key/string
-                            self.fW.writeFile(runNumber, log10_E1, azimuth, zenith, folder_path)
-                            key = f"{log10_E1}_{runNumber}"
-                            stringToSubmit = self.makeStringToSubmit(log10_E1, runNumber, zenith, folder_path)
-                            yield (key, stringToSubmit)
+        with timer.stage("SimulationMaker"):
+            plan = self.buildPlan()
+            # runs whose output is verified are never written again
+            self.verifiedFolders = self.index.getVerifiedFolders() if self.index is not None else set()
+            # one summary line per energy/zenith bin instead of one line per run
+            progress = ProgressTracker(plan, logger)
+
+        for log10_E1, zenith_start, zenith, azimuth, runIndex, log10_E, weight in zip(
+                plan["log10_E1"], plan["zenith_bin"], plan["zenith"], plan["azimuth"], plan["runIndex"],
+                plan["log10_E"], plan["weight"]):
+            keySubString = self.prepareRun(log10_E1, zenith_start, zenith, azimuth, runIndex, log10_E, weight)
+            progress.update(log10_E1, zenith_start)
+            # the yield is outside of prepareRun, so that the time spent by the caller is not counted here
+            if keySubString is not None:
+                yield keySubString
+
+        # all runs are written, commit the last ones to the index
+        if self.index is not None:
+            self.index.flush()
+
+
+    def runFolder(self, log10_E1, zenith_start, zenith, azimuth, runIndex):
+        """
+        Returns the runNumber and the folder of a run, with the structure: primary_particle/energy/theta/runNumber/
+        """
+        # Create the file name (runNumber) for the simulation
+        particleID = self.runNumGen.getPrimaryID(self.primary_particle)
+        zenithID = self.runNumGen.getZenithID(zenith)
+        azimuthID = self.runNumGen.getAzimuthID(azimuth)
+        energyID = self.runNumGen.getEnergyID(log10_E1)
+        self.runNumGen.checkRunIndex(runIndex)
+        runNumber = format(int(particleID * 1E5 + zenithID * 1E4 + azimuthID * 1E3 + energyID * 1E2 + runIndex), '06d')
+        return runNumber, os.path.join(f"{self.directory}{self.primary_particle}/{log10_E1}/{zenith_start}/{runNumber}/")
+
+
+    def planFolders(self, plan):
+        """
+        Returns the folders of the runs of a plan of this SimulationMaker (see buildPlan)
+        """
+        return np.array([self.runFolder(*run)[1] for run in zip(
+            plan["log10_E1"], plan["zenith_bin"], plan["zenith"], plan["azimuth"], plan["runIndex"])], dtype=str)
+
+
+    @timer.timed("SimulationMaker")
+    def prepareRun(self, log10_E1, zenith_start, zenith, azimuth, runIndex, log10_E=None, weight=None):
+        """
+        Creates the folder and writes all the files of a single run.
+        log10_E is the energy of the run (default the lower edge of the bin, log10_E1), weight its phase space (see buildPlan).
+        Returns the key and the string to submit, or None if the simulation already exists.
+        """
+        logger.debug("SimMaker using zenith %s, azimuth %s, runIndex %s", zenith, azimuth, runIndex)
+
+        runNumber, folder_path = self.runFolder(log10_E1, zenith_start, zenith, azimuth, runIndex)
+        logger.debug("runNumber %s", runNumber)
+        if folder_path in self.verifiedFolders:
+            return None
+        os.makedirs(folder_path, exist_ok=True)  # Create folders if they don't already exist
+
+        # Check if the simulation already exists
+        if f"SIM{runNumber}_coreas" in os.listdir(folder_path):
+            return None
+
+        # Write Corsika input file and generate key/string
+        runInfo = self.fW.writeFile(runNumber, log10_E1, azimuth, zenith, folder_path, log10_E=log10_E,
+                                   zenith_bin=zenith_start)
+        if self.index is not None:
+            self.index.addRun(
+                folder=folder_path,
+                runNumber=runNumber,
+                runIndex=runIndex,
+                primary_particle=self.primary_particle,
+                log10_E1=log10_E1,
+                zenith_bin=zenith_start,
+                zenith=zenith,
+                azimuth=azimuth,
+                log10_E=log10_E1 if log10_E is None else log10_E,
+                weight=weight,
+                site=self.site,
+                state="written",
+                **runInfo,
+            )
+        # the runNumber is the same for the same shower at different sites
+        key = f"{log10_E1}_{runNumber}" if self.site is None else f"{self.site}_{log10_E1}_{runNumber}"
+        stringToSubmit = self.makeStringToSubmit(log10_E1, runNumber, zenith, folder_path)
+        return (key, stringToSubmit)
 
 
 
@@ -143,8 +305,86 @@ class SimulationMaker:
         
         # Makes a temp file for submitting the jobs.
         sub_file = (f"{folder_path}/SIM{runNumber}.sub")
-        print(sub_file)
+        logger.debug(sub_file)
         # The stringToSubmit is basically the execution of the temporary sh file
         subString = sub_file
         return subString
 
+
+def mergePlans(plans):
+    """
+    Concatenates the plans of several SimulationMakers (e.g. one per primary and site) into one plan
+    """
+    return {key: np.concatenate([plan[key] for plan in plans]) for key in plans[0]}
+
+
+def claimedRuns(index, simMakers, owner, batchSize=16, leaseSeconds=3600., check=None):
+    """
+    Yields the keys and strings to submit of the runs of the shared plan in the index (see CampaignIndex.publishPlan),
+    claimed in batches of batchSize runs, so that several drivers can work on the same campaign.
+    Only the runs of the primaries and sites of simMakers are claimed, each is written by its SimulationMaker,
+    the batch is checked with check (e.g. PreflightChecker.check, returns the runs that can be submitted), and the
+    claim of a run is completed once the caller took it (the Submitter submits it before asking for the next one).
+    The leases of the batch are renewed while it is submitted; a run whose lease was lost
+    (the driver waited longer than leaseSeconds for free slots and another driver claimed it) is skipped.
+    """
+    makers = {(simMaker.primary_particle, simMaker.site or ""): simMaker for simMaker in simMakers}
+    verifiedFolders = index.getVerifiedFolders()
+    for simMaker in simMakers:
+        simMaker.verifiedFolders = verifiedFolders
+    # the leases are renewed at most this often, well before they expire
+    renewSeconds = leaseSeconds / 10.
+
+    while True:
+        claims = index.claimRuns(owner, batchSize, leaseSeconds, pairs=list(makers))
+        if not claims:
+            break
+        batch = []
+        for claim in claims:
+            simMaker = makers.get((claim["primary_particle"], claim["site"] or ""))
+            if simMaker is None:
+                # not a run of this driver, for the driver of its primary and site
+                logger.warning(f"No SimulationMaker for primary {claim['primary_particle']} and site {claim['site']!r} "
+                               f"of the shared plan, the run is released")
+                index.releaseClaims(owner, [claim["id"]])
+                continue
+            keySubString = simMaker.prepareRun(claim["log10_E1"], claim["zenith_bin"], claim["zenith"],
+                                               claim["azimuth"], claim["runIndex"], claim["log10_E"], claim["weight"])
+            if keySubString is None:
+                # nothing to submit (verified or existing output)
+                index.completeClaim(owner, claim["id"])
+                continue
+            batch.append((keySubString, claim["id"]))
+        index.flush()
+
+        accepted = set(check([keySubString for keySubString, _ in batch])) if check is not None else None
+        held, renewed = set(), None
+        for keySubString, planId in batch:
+            if accepted is not None and keySubString not in accepted:
+                # rejected by the check, it is not claimed again
+                index.completeClaim(owner, planId)
+                continue
+            if renewed is None or time.monotonic() - renewed > renewSeconds:
+                # the generator may have waited for the submitter since the last renewal
+                held, renewed = index.renewClaims(owner, leaseSeconds), time.monotonic()
+            if planId not in held:
+                logger.warning(f"The lease of {keySubString[0]} was lost before it was submitted, it is left to the other driver")
+                continue
+            yield keySubString
+            if not index.completeClaim(owner, planId):
+                logger.warning(f"The lease of {keySubString[0]} expired before it was submitted, it may run twice")
+
+
+def interleave(generators):
+    """
+    Yields the keys and strings to submit of several generators in turn (round robin),
+    so that all primaries and sites of a campaign advance at the same pace in the submission queue.
+    """
+    generators = list(generators)
+    while generators:
+        for generator in list(generators):
+            keySubString = next(generator, None)
+            if keySubString is None:
+                generators.remove(generator)
+            else:
+                yield keySubString
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+"""
+Timing of the stages of the driver, written in the same format as the IceTray summary.json
+shipped with this repo, so that generation and submission costs can be compared on the same dashboards:
+
+    "FileWriter:ncall": 1000.0,
+    "FileWriter:sys": 0.35,
+    "FileWriter:usr": 2.1,
+    "FileWriter:wall": 2.9,
+
+usr and sys are the CPU times of the driver process (getrusage) in seconds, wall is the elapsed time.
+As in IceTray, the times of a stage do not include the stages called from it
+(e.g. RadioFilesGenerator is not counted again in FileWriter), so they add up to the total.
+
+Usage:
+    from utils.StageTimer import timer
+
+    @timer.timed("FileWriter")
+    def writeFile(...):
+
+    with timer.stage("SimulationMaker"):
+        ...
+
+    timer.writeSummary("summary.json")
+"""
+
+import contextlib
+import functools
+import json
+import resource
+import time
+
+
+class StageTimer:
+    """
+    Collects the number of calls and the usr, sys and wall time of each stage.
+    """
+
+    def __init__(self):
+        self.stats = {}
+        # stack of the running stages, with the time spent in the stages called from them
+        self._stack = []
+
+    @staticmethod
+    def _now():
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return usage.ru_utime, usage.ru_stime, time.perf_counter()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Times the code in the with block as the stage name.
+        """
+        start = self._now()
+        frame = [name, [0., 0., 0.]]
+        self._stack.append(frame)
+        try:
+            yield
+        finally:
+            self._stack.pop()
+            inclusive = [end - begin for end, begin in zip(self._now(), start)]
+            stats = self.stats.setdefault(name, [0, 0., 0., 0.])
+            stats[0] += 1
+            for i in range(3):
+                stats[i + 1] += inclusive[i] - frame[1][i]
+            # the calling stage does not count this time
+            if self._stack:
+                parent = self._stack[-1][1]
+                for i in range(3):
+                    parent[i] += inclusive[i]
+
+    def timed(self, name):
+        """
+        Decorator timing every call of a function as the stage name.
+        """
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.stage(name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def summary(self):
+        """
+        Returns the statistics with the Name:ncall/usr/sys(/wall) keys of summary.json
+        """
+        summary = {}
+        for name in sorted(self.stats):
+            ncall, usr, sys, wall = self.stats[name]
+            summary[f"{name}:ncall"] = float(ncall)
+            summary[f"{name}:sys"] = sys
+            summary[f"{name}:usr"] = usr
+            summary[f"{name}:wall"] = wall
+        return summary
+
+    def writeSummary(self, fileName):
+        with open(fileName, "w") as f:
+            json.dump(self.summary(), f, indent=4)
+
+
+# The timer shared by all the classes of the driver
+timer = StageTimer()
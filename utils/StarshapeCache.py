@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+"""
+Cache for the starshape antenna patterns created with miniradiotools.
+
+Creating a starshape means calling get_starshaped_pattern_radii and create_stshp_list,
+which writes a .list file that then has to be read back with np.genfromtxt.
+The pattern only depends on the shower geometry and the site, not on the single run,
+so it is enough to create it once per geometry and reuse it for every shower.
+
+Two levels of cache are used:
+    in memory:  functools.lru_cache, so repeated geometries in the same driver are free
+    on disk:    one .npz file per geometry in cacheDir, shared between driver invocations
+
+The keys are (zenith, azimuth, obslev, atm_model, inclination) for the pattern
+and (zenith, obslev, atm_model) for the radii.
+The returned arrays are read only, since they are shared between all callers.
+
+miniradiotools is only imported when a pattern has to be created, so the driver does not need it
+(and does not pay for importing it) as long as the starshapes are not used or are already cached.
+"""
+
+import functools
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+
+
+def _roundKey(value):
+    # floats coming from np.arccos etc. are rounded, so that the same geometry gives the same key
+    return round(float(value), 6)
+
+
+def _cacheFile(cacheDir, prefix, key):
+    """
+    Returns the name of the .npz file used to store the cache entry with the given key
+    """
+    keyHash = hashlib.sha1(repr(key).encode()).hexdigest()[:16]
+    return os.path.join(cacheDir, f"{prefix}_{keyHash}.npz")
+
+
+def _saveNpz(fileName, **arrays):
+    """
+    Writes the arrays to a temporary file first and then moves it in place,
+    so that a second driver never reads a half written cache file.
+    """
+    os.makedirs(os.path.dirname(fileName), exist_ok=True)
+    fd, tmpName = tempfile.mkstemp(dir=os.path.dirname(fileName), suffix=".npz")
+    with os.fdopen(fd, "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(tmpName, fileName)
+
+
+def _readOnly(array):
+    array.setflags(write=False)
+    return array
+
+
+@functools.lru_cache(maxsize=256)
+def getStarshapeRadii(zenith, obslev, atm_model, cacheDir):
+    """
+    Returns the radii of the starshape rings for the given zenith, observation level and atmosphere.
+    """
+    key = ("radii", _roundKey(zenith), _roundKey(obslev), int(atm_model))
+    fileName = _cacheFile(cacheDir, "radii", key)
+
+    if os.path.isfile(fileName):
+        with np.load(fileName) as data:
+            return _readOnly(data["radii"])
+
+    from miniradiotools.starshapes import get_starshaped_pattern_radii
+    radii = np.asarray(get_starshaped_pattern_radii(key[1], key[2], atm_model=key[3]), dtype=float)
+    _saveNpz(fileName, radii=radii)
+    return _readOnly(radii)
+
+
+@functools.lru_cache(maxsize=256)
+def getStarshapePattern(zenith, azimuth, obslev, atm_model, inclination, cacheDir):
+    """
+    Returns the starshape pattern for the given geometry as
+        corsika_azimuth, x, y, z, name
+
+    corsika_azimuth is the azimuth returned by create_stshp_list, which has to be used in corsika.
+    azimuth is the radiotools azimuth (see RadioFilesGenerator.get_starshapes).
+    """
+    key = ("pattern", _roundKey(zenith), _roundKey(azimuth), _roundKey(obslev), int(atm_model), _roundKey(inclination))
+    fileName = _cacheFile(cacheDir, "starshape", key)
+
+    if os.path.isfile(fileName):
+        with np.load(fileName) as data:
+            return (float(data["corsika_azimuth"]),
+                    _readOnly(data["x"]), _readOnly(data["y"]), _readOnly(data["z"]), _readOnly(data["name"]))
+
+    from miniradiotools.starshapes import create_stshp_list
+    antenna_rings = getStarshapeRadii(zenith, obslev, atm_model, cacheDir)
+
+    # create_stshp_list can only write a file, so this is done once per geometry in a temporary file
+    os.makedirs(cacheDir, exist_ok=True)
+    fd, listName = tempfile.mkstemp(dir=cacheDir, suffix="_starshape.list")
+    os.close(fd)
+    try:
+        corsika_azimuth = create_stshp_list(key[1], key[2], filename=listName,
+                                            obslevel=int(key[3]),
+                                            obsplane="gp",
+                                            inclination=key[5],
+                                            vxB_plot=False,
+                                            antenna_rings=np.array(antenna_rings),
+                                            )
+        file = np.genfromtxt(listName, dtype="str")
+    finally:
+        os.remove(listName)
+
+    # file[:,0] and file[:,1] are useless (they are simply "AntennaPosition" and "=")
+    x = file[:, 2].astype(float)
+    y = file[:, 3].astype(float)
+    z = file[:, 4].astype(float)
+    name = file[:, 5]
+    _saveNpz(fileName, corsika_azimuth=corsika_azimuth, x=x, y=y, z=z, name=name)
+
+    return float(corsika_azimuth), _readOnly(x), _readOnly(y), _readOnly(z), _readOnly(name)
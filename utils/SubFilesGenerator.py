@@ -3,6 +3,9 @@
 import numpy as np
 import os
 import stat
+from utils.CampaignConfig import loadConfig
+from utils.RankScaling import slurmForRanks
+from utils.StageTimer import timer
 
 class SubFilesGenerator:
 
@@ -13,8 +16,13 @@ class SubFilesGenerator:
         primary,
         directory,
         folder_path,
-        pathCorsika = "/home/hk-project-radiohfi/bg5912/work/soft/corsika-77550/run/",
-        corsikaExe = "/mpi_corsika77550Linux_SIBYLL_urqmd_thin_coreas_parallel_runner",
+        pathCorsika,
+        corsikaExe,
+        slurm = None,               # the [slurm] settings of the CampaignConfig, the defaults are used if None
+        staging = None,             # NodeStaging: the run directory is copied to node-local storage and the executable run from there
+        watchdog = None,            # JobWatchdog: terminates the run if it stops progressing or runs too long
+        expectedWallHours = None,   # the expected wall time of the run for the watchdog, if known
+        ranks = None,               # number of MPI ranks of the run (see RankScaling.py), the [slurm] nodes x ntasksPerNode if None
         
     ):
         self.runNumber = runNumber
@@ -28,6 +36,15 @@ class SubFilesGenerator:
         self.directory = directory
         self.pathCorsika = pathCorsika
         self.corsikaExe = corsikaExe
+        if slurm is None:
+            slurm = loadConfig(None)["slurm"]
+        if ranks is not None:
+            # the nodes and tasks per node of the job follow from the ranks
+            slurm = slurmForRanks(slurm, ranks)
+        self.slurm = slurm
+        self.staging = staging
+        self.watchdog = watchdog
+        self.expectedWallHours = expectedWallHours
 
 
     def subWriter(self):
@@ -43,6 +60,7 @@ class SubFilesGenerator:
         # and the corsika files
         inpFile = f"{self.folder_path}/{sim}.inp" # input file
         logFile = f"{self.folder_path}/{dat}.log" # log file
+        timeFile = f"{self.folder_path}/{dat}.time" # /usr/bin/time output
 
 
         # directory containing the simulation files (input + output)
@@ -70,24 +88,41 @@ class SubFilesGenerator:
             runtime = "08:00:00"
 
 
+        corsikaExec = f"{self.pathCorsika}/{self.corsikaExe}"
+        staging = ""
+        if self.staging is not None:
+            # copy the run directory to the nodes first and run the executable from there
+            corsikaExec = self.staging.stagedPath(corsikaExec)
+            staging = self.staging.scriptLines(self.slurm["nodes"])
+
+        runCorsika = "$TIME_CMD mpirun --bind-to core:overload-allowed --map-by core -report-bindings -np $SLURM_NTASKS $MPI_CORSIKA_EXEC $INPUT_FILE > $LOG_FILE"
+        watchdogExit = ""
+        if self.watchdog is not None:
+            # mpirun runs in the background, next to the watchdog
+            runCorsika += " &\n" + self.watchdog.scriptLines(self.folder_path, self.expectedWallHours)
+            watchdogExit = self.watchdog.exitLines(self.folder_path)
+        else:
+            runCorsika += "\n"
+
         # Opening and writing in the file 
         with open(sub_file, "w") as file:
             ######Things that go into the sub file for Horeka#######
             file.write(""
                 + f"#!/bin/bash\n"
-                + f"#SBATCH --account=\"hk-project-p0022320\"\n"
+                + f"#SBATCH --account=\"{self.slurm['account']}\"\n"
+                + f"#SBATCH --partition={self.slurm['partition']}\n"
                 + f"#SBATCH --job-name={self.runNumber}\n"
                 + f"#SBATCH --output={logdir}_log%j.out\n"
                 + f"#SBATCH --error={logdir}_log%j.err\n"
-                + f"#SBATCH --nodes=1\n"
-                + f"#SBATCH --ntasks-per-node=76\n"
-                + f"#SBATCH --cpus-per-task=1\n"
-                + f"#SBATCH --time=2-00:00:00\n" #{self.runtime}
+                + f"#SBATCH --nodes={self.slurm['nodes']}\n"
+                + f"#SBATCH --ntasks-per-node={self.slurm['ntasksPerNode']}\n"
+                + f"#SBATCH --cpus-per-task={self.slurm['cpusPerTask']}\n"
+                + f"#SBATCH --time={self.slurm['time']}\n" #{self.runtime}
                 + f"\n"
                 + f"# Load MPI module (if necessary)\n"
                 + f"# module load mpi\n"
                 + f"# Set the path to your MPI-Corsika executable\n"
-                + f"MPI_CORSIKA_EXEC='{self.pathCorsika}/{self.corsikaExe}'\n"
+                + f"MPI_CORSIKA_EXEC='{corsikaExec}'\n"
                 # CORSIKA_EXEC='{self.pathCorsika}/{self.corsikaExe}'\n"
                 + f"\n"
                 + f"# Set the path to your input and output files\n"
@@ -97,8 +132,12 @@ class SubFilesGenerator:
                 + f"echo ======================= Conjuring Cosmic Showers  ====================== \n"
                 + f"echo starting job number {self.runNumber} \n"
                 + f"echo time: $(date)\n" # print current time
+                + staging
+                + f"# Memory peak and CPU times for the runtime statistics (see RuntimeAggregator.py)\n"
+                + f"TIME_CMD=''\n"
+                + f"if [ -x /usr/bin/time ]; then TIME_CMD='/usr/bin/time -v -o {timeFile}'; fi\n"
                 + f"# Run the MPI-Corsika executable\n"
-                + f"mpirun --bind-to core:overload-allowed --map-by core -report-bindings -np $SLURM_NTASKS $MPI_CORSIKA_EXEC $INPUT_FILE > $LOG_FILE\n"
+                + runCorsika
                 # $CORSIKA_EXEC < $INPUT_FILE > $LOG_FILE\n d
                 + f"\n"
                 + f"echo job number {self.runNumber} complete\n"
@@ -112,6 +151,7 @@ class SubFilesGenerator:
                 # + f"rm -r {inpdir}/../../data/ \n" # remove the obsolete data directory
                 # + f"rm -r {inpdir}/../../temp/ \n" # remove the obsolete temp directory
                 # + f"rm -r {inpdir}/../../starshapes/ \n" # remove the obsolete starshapes directory # TODO: figure out where this comes from and get rid of it
+                + watchdogExit
                 + f"echo =================== Enchantment Successfully Executed ==================\n"
             )
 
@@ -121,6 +161,7 @@ class SubFilesGenerator:
 
 
 
+    @timer.timed("SubFilesGenerator")
     def writeSubFiles(self):
         # define this to make it easier to call the functions
 
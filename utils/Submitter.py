@@ -3,34 +3,53 @@
 """
 This class can be used to spawns subprocesses for multiple instances instead of multiple job submissions.
 This takes a single CPU and actually performs a busy wait in Popen.communicate function.
+How a run is started (sbatch, local bash, fake) is left to the execution backend (see ExecutionBackends.py).
 
 @author: Federico Bontempo <federico.bontempo@kit.edu> PhD student KIT Germany
 @date: October 2022
 """
 
-import subprocess
+import os
 import time
 import pathlib
 
+from utils.ExecutionBackends import SlurmBackend
+from utils.Logger import getLogger
+from utils.StageTimer import timer
+
+logger = getLogger(__name__)
+
 
 class Submitter:
     """
     Classed used for calling multiple scripts in a single submission (eg. on the Horeka cluster)
     """
 
-    def __init__(self, MakeKeySubString, logDir, parallel_sim=50):
+    def __init__(self, MakeKeySubString, logDir, parallel_sim=50, partition="cpuonly", backend=None, pollInterval=10,
+                 index=None):
         """
         Parameters:
         key_processString_generator: is a function that yields the key and process string needed for the simulation
         logDir: Directory where log files are stored
         parallelRunningSims: number of parallel processes that wants to be executed
+        partition: the slurm partition the jobs are submitted to (if no backend is given)
+        backend: the execution backend starting the processes (see ExecutionBackends.py), default is sbatch on partition
+        pollInterval: seconds between two checks of the running processes
+        index: the CampaignIndex, the runs get the state submitted (failed if the submission fails), None: not tracked
         processDict: Dictionary where all the running processes are stored
         """
 
         self.key_processString_generator = MakeKeySubString()
         self.logDir = logDir
         self.parallelRunningSims = parallel_sim
+        self.partition = partition
+        self.backend = backend if backend is not None else SlurmBackend(partition)
+        self.pollInterval = pollInterval
+        self.index = index
         self.processDict = {}
+        # the run folder of each key, for the state in the index
+        self.folderDict = {}
+        self.nFailed = 0
         # Creates the log directory if it does not exist yet
         pathlib.Path(f"{self.logDir}").mkdir(parents=True, exist_ok=True)
 
@@ -39,10 +58,11 @@ class Submitter:
         It is the first function to be called.
         It starts as many processes as chosen.
         """
-        print("**************** Channeling Celestial Energies ****************")
+        logger.info("**************** Channeling Celestial Energies ****************")
         for _ in range(self.parallelRunningSims):
             self.startSingleProcess()
 
+    @timer.timed("Submitter")
     def startSingleProcess(self, key=None, processString=None):
         """
         It starts a single process.
@@ -60,15 +80,13 @@ class Submitter:
             key, processString = next(self.key_processString_generator, (None, None))
 
         if (key is not None) and (processString is not None):
-            print("Process key:", key)
-            print("\n==================== Conjuring Cosmic Shower ====================")
-            print(processString)
-            self.processDict[key] = subprocess.Popen(
-                f"sbatch -p cpuonly {processString}".split(),
-                # processString.split(),
-                stderr=subprocess.PIPE,
-                stdout=subprocess.PIPE,
-            )
+            logger.debug("==================== Conjuring Cosmic Shower %s ====================", key)
+            logger.debug(processString)
+            self.processDict[key] = self.backend.submit(processString)
+            if self.index is not None:
+                # the processString is the .sub file in the run folder
+                self.folderDict[key] = os.path.join(os.path.dirname(processString), "")
+                self.index.setState(self.folderDict[key], "submitted")
         # else:
         #     print("No more files in yield")
         return
@@ -89,10 +107,10 @@ class Submitter:
             keyToLoop = self.singleCheck()
             # Waits before restarting the loop.
             # This is done to avoid overloading the CPU with useless checks
-            sleepTime = 10  # seconds
-            time.sleep(sleepTime)
+            time.sleep(self.pollInterval)
         return
 
+    @timer.timed("Submitter_poll")
     def singleCheck(self):
         """
         Performs a single loop over all running processes and check if one is completed.
@@ -122,9 +140,15 @@ class Submitter:
         Returns:
         keyToLoop: The updated list of processes keys which has to be in loop
         """
+        returncode = self.processDict[key].poll()
         out, err = self.processDict[key].communicate()
         if out is None or err is None:
             return list(self.processDict.keys())
+        if returncode:
+            self.nFailed += 1
+            logger.warning(f"Shower {key} failed with exit code {returncode}, see {self.logDir}/output_{key}.err")
+            if key in self.folderDict:
+                self.index.setState(self.folderDict[key], "failed")
         with open(f"{self.logDir}/output_{key}.out", "w") as f:
             f.write(str(out))
         with open(f"{self.logDir}/output_{key}.err", "w") as f:
@@ -147,3 +171,4 @@ class Submitter:
         """
         if key in self.processDict.keys():
             self.processDict.pop(key).kill()
+        self.folderDict.pop(key, None)
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+
+"""
+Reader for tables.dat (in the root of the repo).
+
+tables.dat is a Fortran unformatted sequential file: each record is written as
+    <int32 length> <length bytes of data> <int32 length>
+The file has a single record, which starts with two int32 values, 9 and the number of grid points (120),
+followed by float64 values (397768 in the file of the repo). There is no description of the layout in the file, from
+the values:
+    - the first ngrid values are the grid (the abscissa of the tables, increasing)
+    - the values are stored as rows of ngrid points (the last values, which do not fill a row, are kept in tail)
+    - the tabulated functions are pairs of consecutive rows: the values y on the grid and the second derivatives y''
+      of their natural cubic spline (y'' = 0 at both ends, like the spline routine of Numerical Recipes).
+      The pairs are found by checking the spline equations. The other rows are empty slots (zeros), constants, and
+      after the last table about 12000 values of unknown layout (only in rows and tail).
+    - the 9 of the header does not count these tables (291 in the file of the repo), it is kept in header
+A record without spline pairs is read as the grid followed by tables without second derivatives.
+
+Nothing is read when the reader is created. The arrays are numpy memmaps of the file (zero copy),
+created on first access, so several processes share the page cache instead of each loading the full file
+(tables and secondDerivatives gather their rows from the memmap, a copy of 2 x 291 rows).
+
+A cached .npz conversion can be written with writeNpz; loadTables uses it when it is newer than the .dat file.
+The members of an .npz are only read when they are accessed.
+
+Usage:
+    from utils.TablesReader import loadTables
+    tables = loadTables()
+    tables.grid, tables.tables[3], tables.interpolate(3, [0.5, 1.2])
+    tables.values                           # all float64 values of the record
+    tables.rows[tables.tableRows[3]]        # the same table as tables.tables[3]
+"""
+
+import functools
+import os
+
+import numpy as np
+
+DEFAULT_TABLES_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tables.dat")
+
+
+def scanRecords(path):
+    """
+    Returns the (offset of the data, length in bytes) of all records of a Fortran unformatted file.
+    Only the record markers are read.
+    """
+    records = []
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        offset = 0
+        while offset < size:
+            f.seek(offset)
+            length = int(np.frombuffer(f.read(4), dtype="<i4")[0])
+            f.seek(offset + 4 + length)
+            end = f.read(4)
+            if len(end) != 4 or int(np.frombuffer(end, dtype="<i4")[0]) != length:
+                raise ValueError(f"{path} is not a Fortran unformatted file: record markers do not match at byte {offset}")
+            records.append((offset + 4, length))
+            offset += length + 8
+    return records
+
+
+class TablesReader:
+    """
+    Parameters:
+        path:   the tables.dat file
+    """
+
+    nHeader = 2     # int32 values at the beginning of the record
+
+    # relative tolerance of the spline equations for a pair of rows to be a table and its second derivatives
+    splineTolerance = 1e-8
+
+    def __init__(self, path=DEFAULT_TABLES_PATH):
+        self.path = path
+
+    @functools.cached_property
+    def records(self):
+        return scanRecords(self.path)
+
+    @functools.cached_property
+    def header(self):
+        """
+        The int32 values at the beginning of the record: (9, number of grid points)
+        """
+        offset, _ = self.records[0]
+        return tuple(int(value) for value in np.memmap(self.path, dtype="<i4", mode="r", offset=offset, shape=(self.nHeader,)))
+
+    @functools.cached_property
+    def values(self):
+        """
+        All float64 values of the record, memory-mapped
+        """
+        offset, length = self.records[0]
+        headerBytes = 4 * self.nHeader
+        return np.memmap(self.path, dtype="<f8", mode="r", offset=offset + headerBytes, shape=((length - headerBytes) // 8,))
+
+    @property
+    def ngrid(self):
+        return self.header[1]
+
+    @functools.cached_property
+    def rows(self):
+        """
+        The values as rows of ngrid points (a view of the memmap), the first row is the grid
+        """
+        nRows = len(self.values) // self.ngrid
+        return self.values[:nRows * self.ngrid].reshape(nRows, self.ngrid)
+
+    @property
+    def tail(self):
+        """
+        The values after the last complete row
+        """
+        return self.values[len(self.rows) * self.ngrid:]
+
+    @property
+    def grid(self):
+        return self.rows[0]
+
+    @functools.cached_property
+    def tableRows(self):
+        """
+        The indices in rows of the tables whose next row holds the second derivatives of their natural cubic spline
+        """
+        x, y, y2 = self.grid, self.rows[1:-1], self.rows[2:]
+        h = np.diff(x)
+        # the spline equations at the inner grid points
+        lhs = h[:-1] / 6. * y2[:, :-2] + (h[:-1] + h[1:]) / 3. * y2[:, 1:-1] + h[1:] / 6. * y2[:, 2:]
+        rhs = np.diff(y, axis=1)[:, 1:] / h[1:] - np.diff(y, axis=1)[:, :-1] / h[:-1]
+        scale = np.maximum(np.abs(lhs).max(axis=1), np.abs(rhs).max(axis=1))
+        isSpline = ((y2[:, 0] == 0) & (y2[:, -1] == 0) & (scale > 0)
+                    & (np.abs(lhs - rhs).max(axis=1) <= self.splineTolerance * np.where(scale > 0, scale, 1.)))
+        return np.flatnonzero(isSpline) + 1
+
+    @property
+    def ntables(self):
+        return len(self.tableRows) if len(self.tableRows) else len(self.rows) - 1
+
+    @property
+    def tables(self):
+        """
+        The tabulated values, ntables x ngrid
+        """
+        if not len(self.tableRows):
+            return self.rows[1:]
+        return self.rows[self.tableRows]
+
+    @property
+    def secondDerivatives(self):
+        """
+        The second derivatives of the natural cubic splines of the tables, ntables x ngrid (None without spline pairs)
+        """
+        if not len(self.tableRows):
+            return None
+        return self.rows[self.tableRows + 1]
+
+    def interpolate(self, row, x):
+        """
+        Interpolation of the table row (index in self.tables) at the points x of the grid, with its cubic spline
+        (linear without second derivatives). Outside of the grid the first/last value is returned.
+        """
+        grid, y = self.grid, self.tables[row]
+        x = np.clip(np.asarray(x, dtype=float), grid[0], grid[-1])
+        if self.secondDerivatives is None:
+            return np.interp(x, grid, y)
+        y2 = self.secondDerivatives[row]
+        hi = np.clip(np.searchsorted(grid, x, side="right"), 1, len(grid) - 1)
+        lo = hi - 1
+        h = grid[hi] - grid[lo]
+        a, b = (grid[hi] - x) / h, (x - grid[lo]) / h
+        return a * y[lo] + b * y[hi] + ((a**3 - a) * y2[lo] + (b**3 - b) * y2[hi]) * h**2 / 6.
+
+    def writeNpz(self, npzPath=None):
+        """
+        Writes the header, all values and the indices of the tables to an (uncompressed) .npz file
+        """
+        npzPath = npzPath or os.path.splitext(self.path)[0] + ".npz"
+        tmpPath = npzPath + ".tmp.npz"
+        np.savez(tmpPath, header=np.array(self.header), values=self.values, tableRows=self.tableRows)
+        os.replace(tmpPath, npzPath)
+        return npzPath
+
+
+class NpzTables(TablesReader):
+    """
+    The same interface as TablesReader, from the cached .npz conversion.
+    Each array is read from the .npz on first access. There are no Fortran records in an .npz.
+    """
+
+    def __init__(self, npzPath):
+        self.path = npzPath
+        self._npz = np.load(npzPath)
+
+    @functools.cached_property
+    def header(self):
+        return tuple(int(value) for value in self._npz["header"])
+
+    @functools.cached_property
+    def values(self):
+        return self._npz["values"]
+
+    @functools.cached_property
+    def tableRows(self):
+        return self._npz["tableRows"]
+
+    @property
+    def records(self):
+        raise AttributeError(f"{self.path} is an .npz file, it has no Fortran records")
+
+
+@functools.lru_cache(maxsize=None)
+def loadTables(path=DEFAULT_TABLES_PATH, useCache=True):
+    """
+    Returns the tables of path (one reader per process and path).
+    With useCache, the .npz conversion next to the file is used if it is up to date, and written if possible.
+    """
+    if not useCache:
+        return TablesReader(path)
+
+    npzPath = os.path.splitext(path)[0] + ".npz"
+    if os.path.isfile(npzPath) and os.path.getmtime(npzPath) >= os.path.getmtime(path):
+        return NpzTables(npzPath)
+
+    reader = TablesReader(path)
+    try:
+        reader.writeNpz(npzPath)
+    except OSError:
+        # e.g. read-only installation, the memmap of the .dat file is used directly
+        pass
+    return reader
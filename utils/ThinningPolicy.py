@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+
+"""
+This class chooses the thinning level (THIN) and the PARALLEL ECTMAX of each energy/zenith bin,
+so that the predicted CPU time of a shower stays within a given budget.
+
+With a fixed relative thinning level the CPU time grows roughly linearly with the energy,
+so the highest energy bins take days. Here the cost of a shower is modelled as
+
+    coreHours = refCoreHours * 10**(a * (log10_E - 8)) * (sec(zenith) / sec(65))**b
+                * (thin / 1e-6)**c * (ectmax / 1e-3)**d
+
+(energy in log10 GeV, thin and ectmax relative to the primary energy as in the .inp file).
+The parameters are fitted (least squares on the logarithm) to a calibration table of past runs,
+a csv file with the columns
+
+    log10_E,zenith,thin,ectmax,coreHours
+
+Without a table the default exponents below are used.
+For each energy/zenith bin (the cost is predicted at the lower edge of the zenith bin) the lowest thin
+that is within the budget with one of the ECTMAX values is chosen, with the cheapest ECTMAX for it.
+ECTMAX only sets how the shower is split into sub-showers for the MPI ranks, it is not traded against precision.
+If no setting is within the budget, the cheapest one is used.
+"""
+
+import numpy as np
+
+from utils.Logger import getLogger
+
+logger = getLogger(__name__)
+
+
+class ThinningPolicy:
+    """
+    Parameters:
+        budgetCoreHours:    the target CPU budget per shower in core-hours
+        thinLevels:         the relative thinning levels that can be chosen
+        ectmaxLevels:       the ECTMAX values (relative to the primary energy) that can be chosen
+        fixedThin:          the thinning level used without this policy, for the comparison
+        fixedEctmax:        the ECTMAX used without this policy, for the comparison
+        calibrationTable:   csv file of past runs, see above. If None, the default model is used
+    """
+
+    # default model: [log(refCoreHours), a, b, c, d]
+    defaultParameters = np.array([np.log(200.), 1., 1., -1., 0.])
+
+    def __init__(self,
+        budgetCoreHours,
+        thinLevels,
+        ectmaxLevels,
+        fixedThin,
+        fixedEctmax,
+        calibrationTable=None,
+    ):
+        self.budgetCoreHours = budgetCoreHours
+        self.thinLevels = np.sort(np.asarray(thinLevels, dtype=float))
+        self.ectmaxLevels = np.sort(np.asarray(ectmaxLevels, dtype=float))
+        self.fixedThin = fixedThin
+        self.fixedEctmax = fixedEctmax
+        self.parameters = self.defaultParameters
+        if calibrationTable:
+            self.fit(calibrationTable)
+        self._choices = {}
+
+    @staticmethod
+    def _features(log10_E, zenith, thin, ectmax):
+        log10_E, zenith, thin, ectmax = np.broadcast_arrays(
+            np.asarray(log10_E, dtype=float), np.asarray(zenith, dtype=float),
+            np.asarray(thin, dtype=float), np.asarray(ectmax, dtype=float))
+        secRatio = np.cos(np.deg2rad(65.)) / np.cos(np.deg2rad(np.minimum(zenith, 89.)))
+        return np.stack([
+            np.ones(log10_E.shape),
+            (log10_E - 8.) * np.log(10.),
+            np.log(secRatio),
+            np.log(thin / 1e-6),
+            np.log(ectmax / 1e-3),
+        ], axis=-1)
+
+    def fit(self, calibrationTable):
+        """
+        Fits the cost model to the calibration table.
+        Exponents that the table cannot constrain (e.g. only one thinning level was used) keep the default value.
+        """
+        table = np.atleast_1d(np.genfromtxt(calibrationTable, delimiter=",", names=True))
+        features = self._features(table["log10_E"], table["zenith"], table["thin"], table["ectmax"])
+        target = np.log(table["coreHours"])
+
+        # only fit the parameters for which the table has some spread
+        free = np.ones(features.shape[1], dtype=bool)
+        free[1:] = features[:, 1:].std(axis=0) > 0
+        fixedPart = features[:, ~free] @ self.defaultParameters[~free]
+        solution, *_ = np.linalg.lstsq(features[:, free], target - fixedPart, rcond=None)
+
+        self.parameters = self.defaultParameters.copy()
+        self.parameters[free] = solution
+        logger.info(f"Thinning policy fitted to {len(target)} calibration runs, parameters {np.round(self.parameters, 3)}")
+
+    def predict(self, log10_E, zenith, thin, ectmax):
+        """
+        Returns the predicted core-hours of a shower (numpy broadcasting over all arguments).
+        """
+        return np.exp(self._features(log10_E, zenith, thin, ectmax) @ self.parameters)
+
+    def choose(self, log10_E, zenith_bin):
+        """
+        Returns the thin, ectmax and the predicted core-hours chosen for this energy and zenith bin.
+        """
+        key = (round(float(log10_E), 6), round(float(zenith_bin), 6))
+        if key not in self._choices:
+            thin, ectmax = np.meshgrid(self.thinLevels, self.ectmaxLevels, indexing="ij")
+            cost = self.predict(key[0], key[1], thin, ectmax)
+            # for each thinning level the cheapest ECTMAX, the precision only depends on the thinning
+            cheapest = np.argmin(cost, axis=1)
+            levels = np.arange(len(self.thinLevels))
+            thin, ectmax, cost = thin[levels, cheapest], ectmax[levels, cheapest], cost[levels, cheapest]
+            withinBudget = np.flatnonzero(cost <= self.budgetCoreHours)
+            # the thinning levels are sorted, so the first one is the most precise
+            best = withinBudget[0] if len(withinBudget) else np.argmin(cost)
+            self._choices[key] = (thin[best], ectmax[best], cost[best])
+        return self._choices[key]
+
+    def predictPlan(self, plan):
+        """
+        Returns the predicted core-hours of every run of the plan (see SimulationMaker.buildPlan) with the settings
+        chosen for its bin, the same prediction as in the .inp files (see choose)
+        """
+        bins = np.stack([plan["log10_E1"], plan["zenith_bin"]], axis=1)
+        uniqueBins, binIndex = np.unique(bins, axis=0, return_inverse=True)
+        binCost = np.array([self.choose(log10_E, zenith_bin)[2] for log10_E, zenith_bin in uniqueBins])
+        return binCost[binIndex.reshape(-1)] if len(binCost) else np.zeros(0)
+
+    def printReport(self, plan):
+        """
+        Prints the chosen settings per energy/zenith bin of the plan (see SimulationMaker.buildPlan)
+        and the expected speed-up with respect to the fixed settings.
+        """
+        print(f"{'log10_E':>8} {'zenith':>7} {'thin':>9} {'ectmax':>9} {'core-h':>9} {'fixed core-h':>13} {'speed-up':>9}")
+        totalPolicy, totalFixed = 0., 0.
+        bins = np.stack([plan["log10_E1"], plan["zenith_bin"]], axis=1)
+        uniqueBins, counts = np.unique(bins, axis=0, return_counts=True)
+        for (log10_E, zenith_bin), count in zip(uniqueBins, counts):
+            # the same prediction as for the runs (see choose)
+            thin, ectmax, cost = self.choose(log10_E, zenith_bin)
+            fixedCost = float(self.predict(log10_E, zenith_bin, self.fixedThin, self.fixedEctmax))
+            totalPolicy += cost * count
+            totalFixed += fixedCost * count
+            print(f"{log10_E:>8.1f} {zenith_bin:>7.1f} {thin:>9.1E} {ectmax:>9.1E} {cost:>9.1f} {fixedCost:>13.1f} {fixedCost / cost:>9.2f}")
+        print(f"Expected core-hours: {totalPolicy:.1f} instead of {totalFixed:.1f} with fixed settings "
+              f"(speed-up {totalFixed / max(totalPolicy, 1e-12):.2f})")
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+
+"""
+This class chooses the time settings of the .reas file for each run from the distances of its antennas,
+so that far-out antennas are not sampled as densely as the ones near the core.
+
+The size of the output is the number of antennas times the samples per trace (window / resolution).
+With the fixed [radio] settings every antenna gets the full window at the full resolution.
+Here, for each run (the detector antennas are moved for every run, see RadioFilesGenerator):
+    ResolutionReductionScale
+        CoREAS coarsens the time resolution linearly with the distance r from the core,
+        by a factor 1 + floor(r / scale). The scale is chosen so that
+        - the antennas within fullResolutionRadius Cherenkov radii of the axis (shower plane) keep the full resolution
+        - the farthest antenna is still sampled at 2 x maxFrequency (Nyquist), the upper end of the band of interest
+        It is 0 (off) if no antenna can be coarsened.
+    AutomaticTimeBoundaries
+        the pulse (minTimeWindow) plus the delay of the curved wavefront from Xmax at the farthest antenna,
+        r^2 / (2 D c) with the shower-plane distance r and the distance D to Xmax (see FootprintModel.py).
+        Inclined showers (large D) get a shorter window. It never exceeds the window of the [radio] section.
+
+The policy is switched on and set in the [timeResolutionPolicy] section of the config file, per bin with [[overrides]].
+printReport prints the expected output reduction per energy/zenith bin of the runs written so far.
+
+The reduced settings can be validated against full-resolution reference showers (the same showers,
+simulated with the fixed settings): peak amplitude, peak time and fluence of every antenna, after limiting both traces
+to the band below maxFrequency, are compared.
+
+How to run the validation:
+    python3 -m utils.TimeResolutionPolicy --reference /path/ref/run/folder/ --reduced /path/reduced/run/folder/
+"""
+
+import collections
+import glob
+import os
+
+import numpy as np
+
+from utils.CoreasReader import readList, readTrace
+from utils.FootprintModel import FootprintModel
+from utils.Logger import getLogger
+
+logger = getLogger(__name__)
+
+SPEED_OF_LIGHT = 29979245800.   # cm/s
+
+
+def showerPlaneDistance(x, y, zenith, azimuth):
+    """
+    Returns the distances (cm) of the antennas at (x, y) on the ground (core in 0, 0) to the shower axis
+    """
+    theta, phi = np.deg2rad(zenith), np.deg2rad(azimuth)
+    axis = np.array([np.sin(theta) * np.cos(phi), np.sin(theta) * np.sin(phi), np.cos(theta)])
+    along = x * axis[0] + y * axis[1]
+    return np.sqrt(np.maximum(x**2 + y**2 - along**2, 0.))
+
+
+def reductionFactors(r, scale):
+    """
+    Returns the factor by which CoREAS coarsens the time resolution at the distances r from the core
+    """
+    if scale <= 0:
+        return np.ones(np.shape(r))
+    return 1. + np.floor(np.asarray(r) / scale)
+
+
+class TimeResolutionPolicy:
+    """
+    The settings of the policy ([timeResolutionPolicy] of the CampaignConfig) are given for each run,
+    so that they can differ per bin. The object collects the report of all runs.
+    """
+
+    def __init__(self):
+        # (log10_E1, zenith_bin): [runs, samples with the fixed settings, samples with the policy]
+        self.report = collections.defaultdict(lambda: [0, 0., 0.])
+
+    @staticmethod
+    def choose(policy, radio, x, y, zenith, azimuth, log10_E, obslev):
+        """
+        Returns the TimeResolution, AutomaticTimeBoundaries and ResolutionReductionScale for a run
+        with the antennas at (x, y) in cm and the number of samples they give (summed over the antennas).
+
+        Parameters:
+            policy:     the [timeResolutionPolicy] settings
+            radio:      the [radio] settings, the fixed resolution and the maximal window
+        """
+        resolution = radio["timeResolution"]
+        window = radio["automaticTimeBoundaries"]
+        settings = {
+            "timeResolution": resolution,
+            "automaticTimeBoundaries": window,
+            "resolutionReductionScale": 0.,
+            "fullSamples": len(x) * window / resolution,
+        }
+        if len(x) == 0:
+            settings["samples"] = 0.
+            return settings
+
+        footprint = FootprintModel(zenith=zenith, azimuth=azimuth, log10_E1=log10_E, obslev=obslev)
+        distanceXmax, _ = footprint.getDistanceToXmax()
+        r = np.hypot(x, y)
+        rPlane = showerPlaneDistance(x, y, zenith, azimuth)
+
+        # the time window: the pulse and the curvature of the wavefront at the farthest antenna
+        curvature = rPlane.max()**2 / (2. * distanceXmax * SPEED_OF_LIGHT)
+        window = min(window, policy["minTimeWindow"] + curvature)
+
+        # the coarsest resolution still resolving maxFrequency
+        maxFactor = int(np.floor(1. / (2. * policy["maxFrequency"] * resolution)))
+        scale = 0.
+        if maxFactor > 1:
+            inside = rPlane <= policy["fullResolutionRadius"] * footprint.getCherenkovRadius()
+            # the scale is rounded up to a meter, so that it is a bit larger than the limits
+            scale = np.ceil(max(r.max() / maxFactor, r[inside].max() if inside.any() else 0.) / 100. + 1e-9) * 100.
+            if scale >= r.max():
+                scale = 0.
+
+        settings["automaticTimeBoundaries"] = float(f"{window:.3g}")
+        settings["resolutionReductionScale"] = float(scale)
+        settings["samples"] = float(np.sum(settings["automaticTimeBoundaries"] / (resolution * reductionFactors(r, scale))))
+        return settings
+
+    def record(self, log10_E1, zenith_bin, settings):
+        stats = self.report[(float(log10_E1), float(zenith_bin))]
+        stats[0] += 1
+        stats[1] += settings["fullSamples"]
+        stats[2] += settings["samples"]
+
+    def printReport(self):
+        """
+        Prints the expected number of samples (the output size) per energy/zenith bin, with and without the policy
+        """
+        print(f"{'log10_E':>8} {'zenith':>7} {'runs':>6} {'fixed samples':>14} {'samples':>12} {'reduction':>10}")
+        totalFixed, total = 0., 0.
+        for (log10_E1, zenith_bin), (nRuns, fullSamples, samples) in sorted(self.report.items()):
+            totalFixed += fullSamples
+            total += samples
+            print(f"{log10_E1:>8.1f} {zenith_bin:>7.1f} {nRuns:>6d} {fullSamples:>14.3g} {samples:>12.3g} "
+                  f"{fullSamples / max(samples, 1e-12):>10.2f}")
+        print(f"Expected trace samples: {total:.3g} instead of {totalFixed:.3g} with fixed settings "
+              f"(reduction {totalFixed / max(total, 1e-12):.2f})")
+
+
+def bandLimited(trace, maxFrequency, resolution):
+    """
+    Returns the time and the three field components of a trace (see CoreasReader.readTrace),
+    limited to frequencies below maxFrequency and resampled to the given resolution
+    """
+    time, field = trace[:, 0], trace[:, 1:]
+    dt = time[1] - time[0]
+    spectrum = np.fft.rfft(field, axis=0)
+    spectrum[np.fft.rfftfreq(len(time), dt) > maxFrequency] = 0.
+    nSamples = int(round(len(time) * dt / resolution))
+    # the rfft normalisation changes with the number of samples
+    field = np.fft.irfft(spectrum, n=nSamples, axis=0) * nSamples / len(time)
+    return time[0] + resolution * np.arange(nSamples), field
+
+
+def signalMetrics(time, field):
+    """
+    Returns the peak amplitude of |E|, its time and the fluence (sum of |E|^2 dt) of a trace
+    """
+    amplitude = np.linalg.norm(field, axis=1)
+    peak = np.argmax(amplitude)
+    return amplitude[peak], time[peak], np.sum(amplitude**2) * (time[1] - time[0])
+
+
+def compareRuns(reference, reduced, maxFrequency=2.5e8):
+    """
+    Compares the traces of all antennas of two run folders (the same shower, full and reduced time settings).
+    Returns a dictionary of arrays: name, peak and fluence ratio (reduced / reference) and peak time difference in s.
+    """
+    def findOne(pattern):
+        found = sorted(glob.glob(pattern))
+        if not found:
+            raise FileNotFoundError(f"No {pattern}")
+        return found[0]
+
+    listFile = findOne(f"{reference}/SIM*.list")
+    referenceCoreas = findOne(f"{reference}/SIM*_coreas")
+    reducedCoreas = findOne(f"{reduced}/SIM*_coreas")
+    result = collections.defaultdict(list)
+    for name in readList(listFile)["name"]:
+        referenceTrace = readTrace(f"{referenceCoreas}/raw_{name}.dat")
+        reducedTrace = readTrace(f"{reducedCoreas}/raw_{name}.dat")
+        # both on the grid of the reference, in the same band
+        resolution = referenceTrace[1, 0] - referenceTrace[0, 0]
+        peak1, time1, fluence1 = signalMetrics(*bandLimited(referenceTrace, maxFrequency, resolution))
+        peak2, time2, fluence2 = signalMetrics(*bandLimited(reducedTrace, maxFrequency, resolution))
+        result["name"].append(name)
+        result["peakRatio"].append(peak2 / peak1 if peak1 > 0 else np.nan)
+        result["fluenceRatio"].append(fluence2 / fluence1 if fluence1 > 0 else np.nan)
+        result["peakTimeShift"].append(time2 - time1)
+    return {key: np.array(values) for key, values in result.items()}
+
+
+def printComparison(comparison):
+    """
+    Prints the median and the 90% quantile of the deviations of the metrics over all antennas, and the worst antennas
+    """
+    deviations = {
+        "peak amplitude": np.abs(comparison["peakRatio"] - 1.),
+        "fluence": np.abs(comparison["fluenceRatio"] - 1.),
+        "peak time (ns)": np.abs(comparison["peakTimeShift"]) * 1e9,
+    }
+    print(f"{len(comparison['name'])} antennas")
+    print(f"{'metric':>16} {'median':>10} {'90%':>10} {'max':>10} {'worst antenna':>14}")
+    for metric, deviation in deviations.items():
+        worst = np.nanargmax(deviation)
+        print(f"{metric:>16} {np.nanmedian(deviation):>10.3g} {np.nanquantile(deviation, 0.9):>10.3g} "
+              f"{deviation[worst]:>10.3g} {comparison['name'][worst]:>14}")
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Compares the traces of reduced time settings with a full-resolution reference shower"
+    )
+    parser.add_argument(
+        "--reference",
+        type=str,
+        required=True,
+        help="folder of the reference run (the fixed [radio] time settings)",
+    )
+    parser.add_argument(
+        "--reduced",
+        type=str,
+        required=True,
+        help="folder of the same shower simulated with the time resolution policy",
+    )
+    parser.add_argument(
+        "--maxFrequency",
+        type=float,
+        default=2.5e8,
+        help="upper end of the frequency band compared, in Hz",
+    )
+    args = parser.parse_args()
+
+    for folder in (args.reference, args.reduced):
+        if not os.path.isdir(folder):
+            raise SystemExit(f"{folder} is not a folder")
+    printComparison(compareRuns(args.reference, args.reduced, args.maxFrequency))
@@ -19,9 +19,14 @@ RunNumber: <012345>
 <3>: azimuth: 0-9
     in ranges (see below)
 
-<4>: empty (0)
+<4><5>: index of the run in its energy/zenith bin: 0-99 (see MAX_RUN_INDEX)
 
-<5>: shower variation: 0-9
+The runNumber is only used within the folder of a bin (primary/energy/zenith bin), so the runIndex numbers all runs
+of the bin: the zenith and azimuth digits do not tell apart the zenith values of a bin, nor (being random) its runs.
+On the grid, run r of the zenith value j of a bin with nZ zenith values has runIndex r * nZ + j (see
+SimulationMaker.buildPlan), the samplers number the runs of each bin (see Samplers.py).
+The runIndex has to stay below MAX_RUN_INDEX, above it it would overwrite the energy digit and the runs of the bin
+would share their folders.
 
 *********
 
@@ -30,6 +35,10 @@ RunNumber: <012345>
 
 """
 
+# the runIndex has the last two digits of the runNumber
+MAX_RUN_INDEX = 100
+
+
 class runNumberGenerator:
     """
     This class has functions that are used to create the runNumber in SimulationMaker.py.
@@ -107,6 +116,11 @@ class runNumberGenerator:
     def getPrimaryID(self, primary_particle):
         return self.primaryDict[primary_particle]
     
+    def checkRunIndex(self, runIndex):
+        if not 0 <= runIndex < MAX_RUN_INDEX:
+            raise ValueError(f"runIndex {runIndex} does not fit in the runNumber, "
+                             f"a bin can have at most {MAX_RUN_INDEX} runs (runIndex 0-{MAX_RUN_INDEX - 1})")
+
     def getEnergyID(self, log10_E1):
         for (lower, upper), category in self.energyDict.items():
             if lower <= log10_E1 <= upper: